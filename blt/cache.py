@@ -0,0 +1,88 @@
+"""
+Small on-disk caches that keep blt fast between invocations.
+
+Cache files live under ``~/.blt/cache`` unless the BLT_CACHE_DIR environment
+variable points somewhere else. They are plain JSON (unless a caller picks another
+serializer) and always safe to delete, blt rebuilds whatever it needs on the
+next run.
+
+Note that this module must only import from the standard library, it is used
+on code paths that need to start quickly.
+"""
+import errno
+import hashlib
+import json
+import os
+
+
+def cache_dir():
+    """Returns the root directory for blt's cache files."""
+    return (os.environ.get('BLT_CACHE_DIR') or
+            os.path.join(os.path.expanduser('~'), '.blt', 'cache'))
+
+def cache_path(*parts):
+    """
+    Builds the path to a cache file, creating parent directories as needed.
+
+    Args:
+        parts: path components relative to the cache directory
+
+    Returns:
+        A string representing the absolute path to the cache file.
+    """
+    path = os.path.join(cache_dir(), *parts)
+    dirname = os.path.dirname(path)
+
+    try:
+        os.makedirs(dirname)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+    return path
+
+def file_key(path):
+    """
+    Returns a cache file name component unique to a file, for caches that
+    hold data derived from it.
+    """
+    return hashlib.md5(os.path.abspath(path)).hexdigest()
+
+def load(path, default=None, serializer=json):
+    """
+    Loads a cache file.
+
+    A missing or corrupt cache is not an error, ``default`` is returned in
+    both cases.
+
+    Args:
+        path: path to the cache file
+        default: returned when the cache can't be loaded
+        serializer: module with json-style load and dump functions, marshal
+            works too
+    """
+    try:
+        with open(path, 'rb') as f:
+            return serializer.load(f)
+    except (IOError, ValueError, EOFError, TypeError):
+        return default
+
+def dump(path, data, serializer=json):
+    """
+    Writes a cache file.
+
+    The data is written to a temporary file first and renamed into place, so
+    concurrent blt processes never see a half written cache.
+    """
+    # only needed when writing, which most runs never do
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            serializer.dump(data, f)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,164 @@
+"""
+Fast shell tab completion for blt.
+
+Completion runs on every TAB press, so it answers from the persisted command
+index (see ``blt.index``) and imports nothing outside the standard library:
+no bltenv file, no clint, no tool modules. Only when the index is missing or
+stale does it fall back to a full command discovery, which rebuilds the index
+for the next TAB press.
+
+Completes command names, ``e:`` environment names from CONFIG, --options
+declared by the command's Commander and positional args that have a fixed set
+of values on the Usage line of the command's docstring.
+
+Usage:
+    blt-complete [words]
+    blt-complete --line "[command line]"
+    blt-complete --bash
+
+Examples:
+    blt-complete e:sta - prints e:staging
+    blt-complete heroku.config "" - prints set, get and unset
+    blt-complete --line "blt heroku.co" - completes the last word of a
+        command line, as given by the shell
+    eval "$(blt-complete --bash)" - installs completion for bash, add it to
+        your ~/.bashrc
+"""
+import os
+import sys
+
+from blt.index import load_index
+
+# same as blt.main.DEFAULT_BLT_FILE, importing blt.main would pull in clint
+DEFAULT_BLT_FILE = 'bltenv.py'
+
+# commands handled by blt.main rather than a Commander
+SPECIAL_COMMANDS = ['help', 'list']
+
+BASH_SCRIPT = r'''
+_blt_complete() {
+    local line="${COMP_LINE:0:$COMP_POINT}" IFS=$'\n'
+    COMPREPLY=( $(blt-complete --line "$line" 2>/dev/null) )
+
+    # bash splits words on ":", so it only wants the part of "e:staging"
+    # that comes after the colon
+    local word="${line##*[[:space:]]}"
+    if [[ "$word" == *:* && "$COMP_WORDBREAKS" == *:* ]]; then
+        COMPREPLY=( "${COMPREPLY[@]#${word%:*}:}" )
+    fi
+}
+complete -o default -F _blt_complete blt
+'''
+
+
+def get_index(env_file=DEFAULT_BLT_FILE):
+    """
+    Returns the command index for a bltenv file, rebuilding it if needed.
+
+    Returns:
+        The index dict, or None if there is no bltenv file.
+    """
+    if not os.path.isfile(env_file):
+        return None
+
+    index = load_index(env_file)
+    if index is None:
+        # slow path, discovery imports the bltenv file and the tools and
+        # writes a fresh index as a side effect
+        from blt.environment import CommandCenter
+        CommandCenter(env_file)
+        index = load_index(env_file)
+
+    return index
+
+def complete(words, index):
+    """
+    Completes the last word of a blt command line.
+
+    Args:
+        words: the words typed after "blt", the last one is the word being
+            completed (an empty string if the cursor is after a space)
+        index: the command index dict
+
+    Returns:
+        A sorted list of the candidates that start with the last word.
+    """
+    words = list(words) or ['']
+    current = words[-1]
+    commands = index['commands']
+
+    if current.startswith('e:'):
+        # complete the last of a comma separated list of environments
+        prefix = current[:current.rfind(',') + 1] or 'e:'
+        names = index['environments'] + ['all']
+        candidates = [prefix + name for name in names]
+        return _matching(candidates, current)
+
+    positionals = [word for word in words[:-1]
+        if not word.startswith('e:') and not word.startswith('--')]
+
+    if not positionals:
+        candidates = list(commands) + SPECIAL_COMMANDS
+    elif positionals[0] == 'help':
+        candidates = list(commands)
+    elif positionals[0] == 'list':
+        candidates = set(name.split('.')[0] for name in commands if '.' in name)
+    elif positionals[0] in commands:
+        entry = commands[positionals[0]]
+
+        if current.startswith('--'):
+            candidates = ['--' + name.replace('_', '-')
+                for name in entry['options']]
+        else:
+            position = len(positionals) - 1
+            arguments = entry['arguments']
+            candidates = arguments[position] if position < len(arguments) else []
+    else:
+        candidates = []
+
+    return _matching(candidates, current)
+
+def split_line(line):
+    """
+    Splits a command line from the shell into the words after "blt".
+
+    The last word is the one being completed, an empty string if the line
+    ends in whitespace.
+    """
+    words = line.split()
+    if not line or line[-1].isspace():
+        words.append('')
+
+    return words[1:]
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv[:1] == ['--bash']:
+        sys.stdout.write(BASH_SCRIPT.lstrip())
+        return 0
+
+    if argv[:1] == ['--line']:
+        words = split_line(argv[1] if len(argv) > 1 else '')
+    else:
+        words = argv
+
+    # whatever goes wrong, a traceback is never what the user wants to see
+    # after hitting TAB
+    try:
+        index = get_index()
+    except Exception:
+        return 1
+
+    if index is not None:
+        for candidate in complete(words, index):
+            sys.stdout.write(candidate + '\n')
+
+    return 0
+
+def _matching(candidates, prefix):
+    return sorted(candidate for candidate in candidates
+        if candidate.startswith(prefix))
+
+if __name__ == '__main__':
+    sys.exit(main())
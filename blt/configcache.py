@@ -0,0 +1,286 @@
+"""
+Cache of the resolved CONFIG of a bltenv file.
+
+Building CONFIG means importing the bltenv file, along with everything it
+imports. The cache keeps the resulting dict in marshal format, which loads
+faster than anything else the standard library offers, so commands that only
+need configuration values can run without importing the bltenv file at all.
+
+While the bltenv file is imported everything CONFIG may depend on is
+recorded (see ``recording_import``): the environment variables it reads (API
+keys and the like), the modules it imports, whether or not they were already
+imported, and the files it opens (secrets, json settings). The cache is stale
+as soon as one of them changes.
+
+Skipping the import also skips its side effects. Changes the bltenv file
+makes to ``os.environ`` and ``sys.path`` are recorded too, and replayed when
+the cached CONFIG is loaded. Anything else the import does (configuring
+logging, patching other modules) is not, set ``BLT_CONFIG_CACHE=0`` to turn
+the cache off if your commands rely on that.
+
+CONFIG values marshal can't handle (datetimes, instances of your own classes)
+simply aren't cached, the bltenv file is imported on every run like before.
+
+Note that this module must only import from the standard library, it is used
+on code paths that need to start quickly.
+"""
+import __builtin__
+from contextlib import contextmanager
+import io
+import marshal
+import os
+import sys
+import UserDict
+
+from blt import cache
+from blt.index import file_signature, source_file
+
+# bump this whenever the layout of the cache changes
+CONFIG_CACHE_VERSION = 2
+
+
+class RecordingEnviron(os._Environ):
+    """
+    Stand-in for ``os.environ`` that records which variables are read and
+    written.
+
+    It shares its data with the real environment, so writes go through to
+    it (and to the environment of child processes) like they would on
+    ``os.environ``. Anything that looks at the environment as a whole
+    (iterating, copying) sets ``read_all``.
+    """
+    def __init__(self, environ):
+        UserDict.UserDict.__init__(self)
+        self.data = environ.data
+        self.initial = dict(environ.data)
+        self.read = {}
+        self.written = {}
+        self.read_all = False
+
+    def _record(self, key):
+        # what the bltenv set itself isn't something CONFIG depends on
+        if key not in self.written:
+            self.read.setdefault(key, self.initial.get(key))
+
+    def __getitem__(self, key):
+        self._record(key)
+        return self.data[key]
+
+    def __contains__(self, key):
+        self._record(key)
+        return key in self.data
+
+    has_key = __contains__
+
+    def get(self, key, failobj=None):
+        self._record(key)
+        return self.data.get(key, failobj)
+
+    def __setitem__(self, key, value):
+        os._Environ.__setitem__(self, key, value)
+        self.written[key] = value
+
+    def __delitem__(self, key):
+        os._Environ.__delitem__(self, key)
+        self.written[key] = None
+
+    def pop(self, key, *args):
+        self._record(key)
+        self.written[key] = None
+        return os._Environ.pop(self, key, *args)
+
+    def clear(self):
+        self.written.update((key, None) for key in self.data)
+        os._Environ.clear(self)
+
+    def dependencies(self):
+        """
+        Returns the variables read, mapped to the values they had before the
+        import (or None).
+        """
+        if self.read_all:
+            return dict(self.initial)
+
+        return dict(self.read)
+
+
+def _reads_all(name):
+    method = getattr(os._Environ, name)
+
+    def reads_all(self, *args):
+        self.read_all = True
+        return method(self, *args)
+
+    reads_all.__name__ = name
+    return reads_all
+
+for _name in ('keys', 'items', 'values', 'iterkeys', 'iteritems',
+              'itervalues', '__iter__', '__len__', 'copy'):
+    setattr(RecordingEnviron, _name, _reads_all(_name))
+
+
+class ImportRecord(object):
+    """
+    What importing a bltenv file depended on, and what it changed.
+
+    Attributes:
+        environ: the ``RecordingEnviron`` the bltenv file was imported with
+        files: source files of the modules it imported, and the files it
+            opened for reading
+        sys_path: entries added to sys.path, as a tuple of (prepended,
+            appended)
+    """
+    def __init__(self, environ):
+        self.environ = environ
+        self.files = set()
+        self.sys_path = ([], [])
+
+
+@contextmanager
+def recording_import():
+    """
+    Records what the bltenv import inside the block depends on and changes.
+
+    Usage:
+        with recording_import() as record:
+            imported = import_file(env_file)
+        save_config(env_file, imported.CONFIG, record)
+    """
+    record = ImportRecord(RecordingEnviron(os.environ))
+    modules = {}
+    path_before = list(sys.path)
+    modules_before = set(sys.modules)
+
+    def recording_open(opener):
+        def opened(name, mode='r', *args, **kwargs):
+            if isinstance(name, basestring) and mode[:1] not in ('w', 'a'):
+                record.files.add(os.path.abspath(name))
+            return opener(name, mode, *args, **kwargs)
+        return opened
+
+    def recorded_import(name, globals=None, locals=None, fromlist=None,
+                        level=-1):
+        module = original[3](name, globals, locals, fromlist, level)
+
+        # modules imported before are recorded too, the import statement
+        # depends on them all the same
+        imported = [module, sys.modules.get(name)]
+        imported.extend(getattr(module, attr, None) for attr in fromlist or ())
+        for value in imported:
+            if isinstance(value, type(sys)):
+                modules[value.__name__] = value
+
+        return module
+
+    original = (os.environ, __builtin__.open, io.open, __builtin__.__import__)
+
+    os.environ = record.environ
+    __builtin__.open = recording_open(original[1])
+    io.open = recording_open(original[2])
+    __builtin__.__import__ = recorded_import
+    try:
+        yield record
+    finally:
+        (os.environ, __builtin__.open, io.open,
+            __builtin__.__import__) = original
+
+        for name in set(sys.modules) - modules_before:
+            if sys.modules[name] is not None:
+                modules[name] = sys.modules[name]
+
+        for module in modules.values():
+            path = source_file(module)
+            if path:
+                record.files.add(path)
+
+        # entries ahead of everything that was on sys.path before were
+        # prepended, the rest appended
+        first = next((i for i, entry in enumerate(sys.path)
+            if entry in path_before), len(sys.path))
+        record.sys_path = (
+            [entry for entry in sys.path[:first] if entry not in path_before],
+            [entry for entry in sys.path[first:] if entry not in path_before])
+
+def config_path(env_file):
+    """Returns the path of the cached CONFIG for a bltenv file."""
+    return cache.cache_path('config', '%s.marshal' % cache.file_key(env_file))
+
+def load_config(env_file):
+    """
+    Loads the cached CONFIG for a bltenv file.
+
+    The changes importing the bltenv file made to ``os.environ`` and
+    ``sys.path`` are replayed, as the import is skipped.
+
+    Returns:
+        The CONFIG dict, or None if there is no cache, it is stale or it is
+        turned off with BLT_CONFIG_CACHE=0.
+    """
+    if os.environ.get('BLT_CONFIG_CACHE') == '0':
+        return None
+
+    cached = cache.load(config_path(env_file), serializer=marshal)
+
+    if not cached or cached.get('version') != CONFIG_CACHE_VERSION:
+        return None
+
+    for path, signature in cached['files'].items():
+        if file_signature(path) != signature:
+            return None
+
+    environ = cached['environ']
+    if cached['environ_all']:
+        if environ != dict(os.environ):
+            return None
+    else:
+        for key, value in environ.items():
+            if os.environ.get(key) != value:
+                return None
+
+    for key, value in cached['environ_written'].items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+    prepended, appended = cached['sys_path']
+    sys.path[0:0] = [entry for entry in prepended if entry not in sys.path]
+    sys.path.extend(entry for entry in appended if entry not in sys.path)
+
+    return cached['config']
+
+def save_config(env_file, config, record):
+    """
+    Writes the cached CONFIG for a bltenv file.
+
+    Args:
+        env_file: path to the bltenv file
+        config: the CONFIG dict
+        record: the ``ImportRecord`` of importing the bltenv file
+
+    Returns:
+        True if the config was cached, False if it can't be marshalled.
+    """
+    files = set(record.files)
+    files.add(os.path.abspath(env_file))
+    path = config_path(env_file)
+
+    cached = {
+        'version': CONFIG_CACHE_VERSION,
+        'files': dict((name, file_signature(name)) for name in files),
+        'environ': record.environ.dependencies(),
+        'environ_all': record.environ.read_all,
+        'environ_written': record.environ.written,
+        'sys_path': list(record.sys_path),
+        'config': config,
+    }
+
+    try:
+        cache.dump(path, cached, serializer=marshal)
+    except ValueError:
+        # unmarshallable values, make sure an older cache isn't used either
+        if os.path.exists(path):
+            os.unlink(path)
+        return False
+
+    return True
@@ -0,0 +1,592 @@
+"""
+Optional long-lived blt server that keeps a project warm between runs.
+
+Every blt invocation is a fresh python process that imports clint, the bltenv
+file and all of its tools before it can do anything. ``blt daemon start``
+starts a server for the bltenv file in the current directory that does all of
+that once and then listens on a unix socket. While it runs, ``blt`` hands its
+argv, working directory and environment to the server instead, which forks a
+copy of its warm self to run the command and reports back the exit status.
+
+The forked command talks to the client's terminal: streams that are a tty are
+opened by name, anything else (pipes, files) is relayed by the client through
+named pipes. python 2 can't pass file descriptors over a unix socket, so that
+is the closest we get. Ctrl-C on the client is relayed to the command as
+SIGINT.
+
+The server reloads the bltenv file and the project modules it imports as soon
+as one of them changes. Restart it after upgrading blt or a tool package.
+
+Usage:
+    blt daemon [start|stop|status|run]
+
+Examples:
+    blt daemon start - starts a server for ./bltenv.py in the background
+    blt daemon run - runs the server in the foreground, handy for debugging
+    BLT_NO_DAEMON=1 blt e:staging heroku.info - bypasses a running server
+"""
+import errno
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from blt import cache
+from blt.completion import DEFAULT_BLT_FILE
+from blt.index import file_signature, load_index, source_file
+
+# set in the forked process that runs a command, so it doesn't forward the
+# command to the server all over again
+IN_DAEMON = False
+
+STREAMS = ('stdin', 'stdout', 'stderr')
+
+# seconds "blt daemon start" waits for the server to come up
+START_TIMEOUT = 30
+
+
+class Channel(object):
+    """
+    Newline delimited JSON messages over a socket.
+
+    Strings travel as latin-1 so any bytes (argv, environment variables) make
+    the round trip unchanged.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ''
+
+    def send(self, message):
+        self.sock.sendall(json.dumps(message, encoding='latin-1') + '\n')
+
+    def receive(self):
+        """Returns the next message, or None if the other end hung up."""
+        while '\n' not in self.buffer:
+            try:
+                data = self.sock.recv(2**16)
+            except socket.error as e:
+                # a signal handler ran (the client relaying ctrl-c)
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not data:
+                return None
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split('\n', 1)
+        return _to_bytes(json.loads(line))
+
+
+class StreamRelay(object):
+    """
+    Makes the client's stdin, stdout and stderr available to the command.
+
+    ``paths`` maps each stream to a path the command opens: the tty itself,
+    or a named pipe that a thread copies to or from the client's stream.
+    """
+    def __init__(self):
+        self.paths = {}
+        self.outputs = []
+        self.tmpdir = None
+
+        for fd, name in enumerate(STREAMS):
+            if not _is_open(fd):
+                self.paths[name] = os.devnull
+            elif os.isatty(fd):
+                self.paths[name] = os.ttyname(fd)
+            else:
+                self.paths[name] = self._relay(fd, name)
+
+    def wait(self):
+        """Waits until the command's output has been copied."""
+        for thread in self.outputs:
+            thread.join()
+
+    def cleanup(self):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _relay(self, fd, name):
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.mkdtemp(prefix='blt-')
+
+        path = os.path.join(self.tmpdir, name)
+        os.mkfifo(path, 0600)
+
+        target = self._copy_in if fd == 0 else self._copy_out
+        thread = threading.Thread(target=target, args=(fd, path))
+        thread.daemon = True
+        thread.start()
+
+        if fd != 0:
+            self.outputs.append(thread)
+
+        return path
+
+    def _copy_in(self, fd, path):
+        pipe = os.open(path, os.O_WRONLY)
+        try:
+            _copy(fd, pipe)
+        except OSError as e:
+            # the command exited without reading all of its input
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            os.close(pipe)
+
+    def _copy_out(self, fd, path):
+        pipe = os.open(path, os.O_RDONLY)
+        try:
+            _copy(pipe, fd)
+        finally:
+            os.close(pipe)
+
+
+class Server(object):
+    """
+    Serves blt commands for a bltenv file from a warm process.
+
+    Args:
+        env_file: path to the bltenv file
+    """
+    def __init__(self, env_file=DEFAULT_BLT_FILE):
+        self.env_file = os.path.abspath(env_file)
+        self.env_dir = os.path.dirname(self.env_file)
+        self.path = socket_path(self.env_file)
+        self.children = set()
+        self.files = {}
+        self.listener = None
+
+    def serve(self):
+        """Warms up and handles requests until stopped."""
+        self.warm()
+        self.listener = listen(self.path)
+
+        # stopping the server shouldn't leave the socket behind
+        signal.signal(signal.SIGTERM, _raise_exit)
+
+        try:
+            while self.accept():
+                pass
+        finally:
+            self.listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def warm(self):
+        """
+        Imports everything a command could need: clint, the bltenv file, the
+        tool modules and their lazily imported dependencies.
+        """
+        # imported here, the client side of this module has to stay light
+        import blt.main
+        from blt.environment import CommandCenter
+        from blt.helpers import preload
+
+        center = CommandCenter(self.env_file)
+        center.loaded_env
+        center.config
+
+        for command in center.commands.values():
+            module = sys.modules[command.klass.__module__]
+            for value in vars(module).values():
+                try:
+                    preload(value)
+                except ImportError:
+                    pass
+
+        self.files = dict((path, file_signature(path))
+            for path in self._watched_files())
+
+    def accept(self):
+        """
+        Waits for the next request and handles it.
+
+        Returns:
+            False once the server was asked to stop.
+        """
+        self._reap()
+        try:
+            ready, _, _ = select.select([self.listener], [], [], 1.0)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return True
+            raise
+
+        if not ready:
+            return True
+
+        conn, _ = self.listener.accept()
+        channel = Channel(conn)
+        try:
+            return self.handle(channel)
+        finally:
+            conn.close()
+
+    def handle(self, channel):
+        request = channel.receive()
+        if request is None:
+            return True
+
+        control = request.get('control')
+        if control == 'status':
+            channel.send({'pid': os.getpid(), 'env_file': self.env_file,
+                          'running': len(self.children)})
+            return True
+        elif control == 'stop':
+            channel.send({'pid': os.getpid()})
+            return False
+
+        if self.stale():
+            self.reload()
+
+        pid = os.fork()
+        if pid == 0:
+            self.listener.close()
+            self.run(channel, request)
+
+        self.children.add(pid)
+        return True
+
+    def run(self, channel, request):
+        """
+        Runs a command in the forked process, this never returns.
+        """
+        global IN_DAEMON
+        IN_DAEMON = True
+
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        code = 1
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['environ'])
+            redirect_streams(request['streams'])
+            channel.send({'pid': os.getpid()})
+
+            # the warm CONFIG was built with the server's environment, start
+            # over if the client's makes a difference
+            from blt.configcache import load_config
+            if load_config(self.env_file) is None:
+                self.purge()
+
+            code = run_main(request['argv'])
+        except Exception:
+            traceback.print_exc()
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except IOError:
+                    pass
+
+            try:
+                channel.send({'exit': code})
+            finally:
+                os._exit(0)
+
+    def stale(self):
+        """Determine if a watched file changed since the server warmed up."""
+        if load_index(self.env_file) is None:
+            return True
+
+        return any(file_signature(path) != signature
+            for path, signature in self.files.items())
+
+    def reload(self):
+        self.purge()
+        self.warm()
+
+    def purge(self):
+        """Forgets the bltenv file and the project modules it imported."""
+        for name, module in sys.modules.items():
+            if module is None or name == 'blt' or name.startswith('blt.'):
+                continue
+
+            path = source_file(module)
+            if path and path.startswith(self.env_dir + os.sep):
+                del sys.modules[name]
+
+    def _watched_files(self):
+        index = load_index(self.env_file) or {'files': {}}
+        files = set(index['files'])
+        files.add(self.env_file)
+
+        for module in sys.modules.values():
+            path = module is not None and source_file(module)
+            if path and path.startswith(self.env_dir + os.sep):
+                files.add(path)
+
+        return files
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                self.children.clear()
+                break
+
+            if not pid:
+                break
+            self.children.discard(pid)
+
+
+def socket_path(env_file=DEFAULT_BLT_FILE):
+    """Returns the path of the server socket for a bltenv file."""
+    key = cache.file_key(env_file)[:16]
+    return cache.cache_path('daemon', '%s.sock' % key)
+
+def log_path(env_file=DEFAULT_BLT_FILE):
+    """Returns the path of the log of a server started in the background."""
+    key = cache.file_key(env_file)[:16]
+    return cache.cache_path('daemon', '%s.log' % key)
+
+def connect(env_file=DEFAULT_BLT_FILE):
+    """
+    Connects to the server for a bltenv file.
+
+    Returns:
+        A Channel, or None if no server is running.
+    """
+    path = socket_path(env_file)
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    return Channel(sock)
+
+def listen(path):
+    """Returns a listening unix socket, replacing a stale socket file."""
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            os.unlink(path)
+        else:
+            raise RuntimeError('a blt daemon is already listening on %s' % path)
+        finally:
+            sock.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0600)
+    listener.listen(16)
+    return listener
+
+def forward(argv, env_file=DEFAULT_BLT_FILE):
+    """
+    Runs a blt command on the server for a bltenv file.
+
+    Args:
+        argv: the command line args, without the program name
+        env_file: path to the bltenv file
+
+    Returns:
+        The exit status of the command, or None if there is no server to
+        forward it to.
+    """
+    if IN_DAEMON or os.environ.get('BLT_NO_DAEMON'):
+        return None
+
+    channel = connect(env_file)
+    if channel is None:
+        return None
+
+    relay = StreamRelay()
+    try:
+        channel.send({
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'environ': dict(os.environ),
+            'streams': relay.paths,
+        })
+
+        started = channel.receive()
+        if started is None:
+            sys.stderr.write('blt daemon hung up, see %s\n' % log_path(env_file))
+            return 1
+        elif 'exit' in started:
+            # the command couldn't even set up its streams
+            return started['exit']
+
+        # ctrl-c only reaches the client, pass it on
+        interrupt = lambda signum, frame: _kill(started['pid'], signum)
+        previous = signal.signal(signal.SIGINT, interrupt)
+        try:
+            finished = channel.receive()
+        finally:
+            signal.signal(signal.SIGINT, previous)
+
+        relay.wait()
+        return finished['exit'] if finished else 1
+    finally:
+        channel.sock.close()
+        relay.cleanup()
+
+def redirect_streams(paths):
+    """Points the process's stdin, stdout and stderr at the given paths."""
+    for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+
+    for fd, name in enumerate(STREAMS):
+        flags = os.O_RDONLY if fd == 0 else os.O_WRONLY
+        opened = os.open(paths[name], flags | os.O_NOCTTY)
+        os.dup2(opened, fd)
+        os.close(opened)
+
+def run_main(argv):
+    """Runs blt.main and returns its exit status."""
+    from blt.main import main
+
+    try:
+        main(argv)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+
+        sys.stderr.write('%s\n' % e.code)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+
+    return 0
+
+def control(args, env_file=DEFAULT_BLT_FILE):
+    """
+    Handles ``blt daemon [start|stop|status|run]``.
+
+    Returns:
+        The exit status.
+    """
+    action = args[0] if args else 'status'
+
+    if action == 'run':
+        Server(env_file).serve()
+        return 0
+    elif action == 'start':
+        return start(env_file)
+    elif action in ('stop', 'status'):
+        channel = connect(env_file)
+        if channel is None:
+            print 'blt daemon is not running'
+            return 1 if action == 'status' else 0
+
+        channel.send({'control': action})
+        reply = channel.receive() or {}
+        channel.sock.close()
+
+        if action == 'stop':
+            print 'blt daemon stopped (pid %s)' % reply.get('pid')
+        else:
+            print 'blt daemon running (pid %s) for %s' % (reply.get('pid'),
+                reply.get('env_file'))
+        return 0
+
+    print 'usage: blt daemon [start|stop|status|run]'
+    return 1
+
+def start(env_file=DEFAULT_BLT_FILE):
+    """
+    Starts a server in the background and waits until it accepts requests.
+    """
+    if connect(env_file) is not None:
+        print 'blt daemon is already running'
+        return 0
+
+    if not os.path.isfile(env_file):
+        print 'bltenv.py not found in cwd, please create one.'
+        return 1
+
+    log = log_path(env_file)
+    pid = os.fork()
+    if pid == 0:
+        _daemonize(log)
+        try:
+            Server(env_file).serve()
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+
+    os.waitpid(pid, 0)
+
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        channel = connect(env_file)
+        if channel is not None:
+            channel.sock.close()
+            print 'blt daemon started for %s' % os.path.abspath(env_file)
+            return 0
+        time.sleep(0.05)
+
+    print 'blt daemon failed to start, see %s' % log
+    return 1
+
+def _daemonize(log):
+    """Detaches the forked process from the terminal, logging to ``log``."""
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    output = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+    os.dup2(devnull, 0)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+    os.close(devnull)
+    os.close(output)
+
+def _copy(src, dst):
+    while True:
+        data = os.read(src, 2**16)
+        if not data:
+            break
+
+        while data:
+            data = data[os.write(dst, data):]
+
+def _is_open(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError:
+        pass
+
+def _raise_exit(signum, frame):
+    raise SystemExit(0)
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    elif isinstance(value, list):
+        return [_to_bytes(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((_to_bytes(k), _to_bytes(v)) for k, v in value.items())
+
+    return value
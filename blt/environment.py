@@ -1,14 +1,21 @@
 from collections import namedtuple
 import datetime
-from inspect import getmembers, ismodule, isclass
+import functools
+from inspect import ismodule
 import os
 import sys
 import types
 
+from blt import parallel, timing
+from blt.configcache import load_config, recording_import, save_config
 from blt.helpers import prompt, abort
+from blt.index import load_index, save_index, source_file, usage_arguments
 from clint.textui import puts, indent
 from clint.textui.colored import red, cyan, green
 
+# environment name that stands for every environment in CONFIG
+ALL_ENVIRONMENTS = 'all'
+
 def iscommander(obj):
     """
     Determine if the provided value is a ``Command`` object.
@@ -23,8 +30,28 @@ def iscommander(obj):
     except TypeError:
         return False
 
+def has_commanders(module):
+    """
+    Determine if a module holds ``Commander`` subclasses, or is a package
+    containing a module that defines some.
+
+    Modules that define them are known from ``CommanderMeta.modules``. A
+    module that only re-exports a Commander defined elsewhere (e.g.
+    ``from blt.tools.south import SouthCommands``) isn't recorded there, so
+    the module's own members are checked too. Modules further down its
+    import graph are not.
+    """
+    prefix = module.__name__ + '.'
+
+    if any(name == module.__name__ or name.startswith(prefix)
+            for name in CommanderMeta.modules):
+        return True
+
+    return any(iscommander(value) for value in vars(module).values())
+
 def iscommandmethod(obj):
-    if isinstance(obj, types.MethodType):
+    # plain functions are what CommanderMeta sees while the class is created
+    if isinstance(obj, (types.FunctionType, types.MethodType)):
 
         # we skip any methods that begin with "_"
         if obj.__name__[0] == '_':
@@ -33,6 +60,40 @@ def iscommandmethod(obj):
         return True
     return False
 
+def summarize(docstring):
+    """Returns the first non-empty line of a docstring."""
+    lines = [line.strip() for line in (docstring or '').split('\n')]
+    return next((line for line in lines if line), '')
+
+def command(func=None, name=None, aliases=()):
+    """
+    Registers a Commander method as a command.
+
+    Public methods of a Commander are commands even without the decorator,
+    it is needed to give a command a different name than its method, or to
+    add aliases. The registration happens when the class is created, see
+    ``CommanderMeta``.
+
+    Args:
+        func: the method, when the decorator is used without arguments
+        name: the command name (optional, defaults to the method name)
+        aliases: other names the command can be called by
+
+    Usage:
+        @command(aliases=['cfg'])
+        def config(self, action=None, *configs):
+
+    Examples:
+        @command(name='up') - runs as tool.up, whatever the method is called
+        @command(aliases=['siamese', 'twin']) - runs as tool.command_with_aliases,
+            tool.siamese and tool.twin
+    """
+    def decorator(method):
+        method.blt_command = {'name': name, 'aliases': list(aliases)}
+        return method
+
+    return decorator(func) if func is not None else decorator
+
 def prod_check(cmd):
     puts('****************************************')
     puts(red('         P R O D U C T I O N            '))
@@ -67,6 +128,21 @@ def import_file(filepath):
 
     return imported
 
+def import_module(name, directory):
+    """
+    Imports a module by name, with the bltenv directory on PYTHONPATH.
+
+    This is how indexed commands load their Commander class, the directory
+    is needed for modules that live next to the bltenv file.
+    """
+    sys.path.insert(0, directory)
+    try:
+        __import__(name)
+    finally:
+        del sys.path[0]
+
+    return sys.modules[name]
+
 # Module recursion cache
 class _ModuleCache(object):
     """
@@ -89,9 +165,10 @@ class Command(object):
     """
     Class that encapsulates a blt command.
 
-    This is really just a method within a Commander class, blt does module and
-    class introspection to figure out all of the defined methods on a Commander
-    and creates a wrapped ``Command`` to easily be called during runtime.
+    This is really just a method within a Commander class. The commands of a
+    Commander are registered when the class is created (see ``CommanderMeta``)
+    and blt wraps each one in a ``Command`` to easily be called during
+    runtime.
     """
     def __init__(self, klass, name):
         """
@@ -99,57 +176,313 @@ class Command(object):
 
         Args:
             klass: the Commander class the method belongs to
-            name: a string representing the name of the method ("command" in
-                blt parlence)
+            name: a string representing the name of the command, as
+                registered on the class
         """
+        spec = klass._commands[name]
+
         self.klass = klass
         self.name = name
+        self.method = spec.method
+        self.aliases = spec.aliases
+        self.summary_docstring = spec.summary
 
     def execute(self, config, args=[]):
+        # pull out any --options the Commander declares before we hand the
+        # rest of the args to the method as positionals
+        options, args = split_options(self.klass.options, args)
+
         # instantiate the class for the requested command
-        class_instance = self.klass(config)
+        class_instance = self.klass(config, options)
 
         # call the method requested
-        getattr(class_instance, self.name)(*args)
+        getattr(class_instance, self.method)(*args)
 
     @property
-    def summary_docstring(self):
-        retstr = self.docstring or ''
+    def docstring(self):
+        return getattr(self.klass, self.method).__doc__ or ''
+
+    def index_entry(self):
+        """Returns the dict that describes this command in the index."""
+        return {
+            'module': self.klass.__module__,
+            'class': self.klass.__name__,
+            'name': self.name,
+            'method': self.method,
+            'aliases': self.aliases,
+            'summary': self.summary_docstring,
+            'docstring': self.docstring,
+            'options': sorted(self.klass.options),
+            'arguments': usage_arguments(self.docstring, self.name),
+        }
+
+
+class IndexedCommand(Command):
+    """
+    A Command loaded from the persisted command index.
+
+    Everything needed for listing and help comes straight from the index, the
+    module that defines the Commander class is only imported when the command
+    is executed.
+    """
+    def __init__(self, entry, env_dir):
+        """
+        Initializes an IndexedCommand object
+
+        Args:
+            entry: the dict describing the command in the index
+            env_dir: the directory of the bltenv file
+        """
+        self.entry = entry
+        self.env_dir = env_dir
+        self.name = entry['name']
+        self.method = entry['method']
+        self.aliases = entry['aliases']
+        self._klass = None
+
+    @property
+    def klass(self):
+        if self._klass is None:
+            module = import_module(self.entry['module'], self.env_dir)
+            self._klass = getattr(module, self.entry['class'])
 
-        if retstr:
-            retstr = [line for line in retstr.split('\n') if line != ''][0].strip()
+        return self._klass
 
-        return retstr
+    @property
+    def summary_docstring(self):
+        return self.entry['summary']
 
     @property
     def docstring(self):
-        return getattr(self.klass, self.name).__doc__ or ''
+        return self.entry['docstring']
+
+
+CommandSpec = namedtuple('CommandSpec', 'name method aliases summary')
+
+
+class CommanderMeta(type):
+    """
+    Metaclass of ``Commander`` that registers commands as classes are created.
+
+    Every subclass gets a ``_commands`` dict of command name => CommandSpec,
+    built from the public methods (renamed or aliased with the ``command``
+    decorator) of every class in its MRO, so methods of plain mixin classes
+    are commands as well. Its module name is added to
+    ``CommanderMeta.modules``, which lets command discovery skip the (much
+    larger) part of the import graph that can't contain any commands.
+    """
+    modules = set()
+
+    def __init__(cls, name, bases, attrs):
+        super(CommanderMeta, cls).__init__(name, bases, attrs)
+
+        registry = {}
+        for klass in reversed(cls.__mro__):
+            # object and the Commander base class provide no commands
+            if klass is object or klass.__dict__.get('_commander_base'):
+                continue
+
+            _register_commands(registry, vars(klass))
+
+        cls._commands = registry
+
+        # the Commander base class itself doesn't provide commands
+        if any(isinstance(base, CommanderMeta) for base in bases):
+            CommanderMeta.modules.add(cls.__module__)
+
+
+def _register_commands(registry, attrs):
+    """
+    Adds the commands among a class's attributes to a command registry.
+
+    Called for each class of an MRO, base classes first, so that overrides
+    replace what they override.
+    """
+    for attr, value in sorted(attrs.items()):
+        if not iscommandmethod(value):
+            continue
+
+        # an override keeps the name and aliases it was registered with
+        inherited = [spec for spec in registry.values() if spec.method == attr]
+        options = getattr(value, 'blt_command', None)
+
+        if options is None and inherited:
+            spec = inherited[0]._replace(summary=summarize(value.__doc__))
+        else:
+            options = options or {}
+            spec = CommandSpec(options.get('name') or attr, attr,
+                options.get('aliases', []), summarize(value.__doc__))
+
+        for old in inherited:
+            del registry[old.name]
+
+        registry[spec.name] = spec
 
 
 class Commander(object):
-    def __init__(self, configuration):
+    __metaclass__ = CommanderMeta
+
+    # CommanderMeta looks for this among a class's own attributes to skip
+    # the base class when it walks an MRO
+    _commander_base = True
+
+    # --options accepted by every command on the Commander, mapped to their
+    # default values. an option given without a value (--stats) is set to
+    # True, otherwise to the given string (--metrics=out.json).
+    options = {}
+
+    def __init__(self, configuration, options=None):
         self.cfg = configuration
+        self.opts = dict(self.options, **(options or {}))
+
+    @property
+    def session(self):
+        """
+        Dict shared by all the commands of one blt invocation.
+
+        Commands chained together (or run from a batch file) can keep
+        connections and caches here for the commands that follow.
+        """
+        return self.cfg.setdefault('blt_session', {})
 
 
 class CommandCenter(object):
     def __init__(self, env_file):
         self.module_cache = _ModuleCache()
         self.env_file = env_file
-        self.loaded_env = import_file(self.env_file)
-        self.commands = self._extract_commands(self.loaded_env)
-        self.config = self._extract_config(self.loaded_env)
+        self.env_dir = os.path.dirname(os.path.abspath(env_file))
+        self._loaded_env = None
+        self._config = None
+        self.session = {}
+        self.commands = self._load_commands()
+
+    @property
+    def loaded_env(self):
+        """
+        The imported bltenv module, imported on first access.
+
+        The import also refreshes the cached CONFIG, recording the files and
+        environment variables it depends on, see ``recording_import``.
+        """
+        if self._loaded_env is None:
+            name = os.path.splitext(os.path.basename(self.env_file))[0]
+            before = set(sys.modules)
+
+            with recording_import() as record:
+                self._loaded_env = import_file(self.env_file)
+
+            # an already imported bltenv wasn't executed, so we don't know
+            # what its CONFIG depends on
+            config = getattr(self._loaded_env, 'CONFIG', None)
+            if name not in before and config is not None:
+                save_config(self.env_file, config, record)
+
+        return self._loaded_env
+
+    @property
+    def config(self):
+        """
+        The CONFIG dict from the bltenv file, loaded on first access.
+
+        Comes from the config cache when it is up to date, in which case the
+        bltenv file isn't imported at all.
+        """
+        if self._config is None:
+            config = load_config(self.env_file)
+            if config is None:
+                config = self.loaded_env.CONFIG
+
+            self._config = self._extract_config(config)
+
+        return self._config
 
     def run(self, env_type, command, args=[]):
-        self._precheck(env_type, command)
-        cfg = self.config[env_type]
+        self.run_all([(env_type, command, args)])
 
-        # add in the environment we are using
-        cfg['blt_envtype'] = env_type
+    def run_all(self, steps):
+        """
+        Runs a list of commands, one after the other.
+
+        Every command is checked before the first one runs, and the
+        production check is done once for all of them. The commands share
+        the loaded environment, the config and the session (see
+        ``Commander.session``). An aborting command stops the rest.
 
-        cmd = self.commands[command]
+        A command can target several environments at once, e.g.
+        "staging,production" or "all". The commands of each environment then
+        run in a process of their own, concurrently with the other
+        environments, and their output is prefixed with the environment name.
+        blt exits with an error if any of the environments failed.
+
+        Args:
+            steps: list of (env_type, command, args) tuples
+        """
+        steps = [(self.environments(env_type), command, args)
+            for env_type, command, args in steps]
+
+        with timing.span('checks'):
+            for env_types, command, args in steps:
+                for env_type in env_types:
+                    self._precheck(env_type, command)
+
+            production = [command for env_types, command, args in steps
+                if 'production' in env_types]
+            if production:
+                prod_check(', '.join(production))
+
+        if all(len(env_types) == 1 for env_types, command, args in steps):
+            self._execute([(env_types[0], command, args)
+                for env_types, command, args in steps])
+            return
+
+        ordered = []
+        for env_types, command, args in steps:
+            ordered.extend(env for env in env_types if env not in ordered)
+
+        jobs = [(env_type, functools.partial(self._execute,
+                    [(env_type, command, args)
+                        for env_types, command, args in steps
+                        if env_type in env_types]))
+            for env_type in ordered]
+
+        # timings recorded by the environments' processes stay there, the
+        # fan out is timed as a whole
+        with timing.span('e:' + ','.join(ordered)):
+            statuses = parallel.run_forked(jobs)
+
+        puts()
+        for env_type in ordered:
+            status = statuses[env_type]
+            if status:
+                puts('%s: %s' % (env_type, red('failed (exit %d)' % status)))
+            else:
+                puts('%s: %s' % (env_type, green('ok')))
+
+        failed = [env_type for env_type in ordered if statuses[env_type]]
+        if failed:
+            abort('%d of %d environments failed: %s.'
+                % (len(failed), len(ordered), ', '.join(failed)))
+
+    def environments(self, env_type):
+        """
+        Expands an environment given on the command line.
 
-        # call the execute method on the Command class
-        cmd.execute(cfg, args)
+        Args:
+            env_type: an environment name, a comma separated list of them,
+                or "all" for every environment in CONFIG
+
+        Returns:
+            A list of environment names.
+        """
+        if env_type == ALL_ENVIRONMENTS:
+            env_types = sorted(name for name in self.config if name != 'blt')
+        else:
+            env_types = [name for name in env_type.split(',') if name]
+
+        if not env_types:
+            abort('no environments found for [%s].' % env_type)
+
+        return env_types
 
     def help(self, cmds=[]):
         """
@@ -190,22 +523,25 @@ class CommandCenter(object):
         toolgroups = group_commands(tool, self.commands)
 
         for tool, short_cmd, command_name in group_commands(tool, self.commands):
+            cmd = self.commands[command_name]
+
+            # aliases are listed along with the command they point at
+            if command_name.split('.')[-1] != cmd.name:
+                continue
+
             if prev_tool != tool:
                 prev_tool = tool
                 puts(green('\n[' + tool +']'))
 
-            # get the summarized docstring
-            summary = self.commands[command_name].summary_docstring
+            if cmd.aliases:
+                short_cmd += ' (%s)' % ', '.join(cmd.aliases)
 
             with indent(2):
-                puts("- {0:30} {1}".format(short_cmd,summary))
+                puts("- {0:30} {1}".format(short_cmd, cmd.summary_docstring))
 
         puts('\n')
 
     def _precheck(self, env_type, command):
-        if env_type == 'production':
-            prod_check(command)
-
         if env_type not in self.config:
             abort('environment [%s] not defined in your beltenv file.'
                     % env_type)
@@ -217,14 +553,53 @@ class CommandCenter(object):
             abort('command [%s] not found in your beltenv file.'
                     % command)
 
+    def _execute(self, steps):
+        for env_type, command, args in steps:
+            # add in the environment we are using, on a copy so CONFIG
+            # itself stays untouched
+            cfg = dict(self.config[env_type], blt_envtype=env_type,
+                blt_session=self.session)
 
-    def _extract_config(self, imported_python):
-        # make sure that:
-        # a) CONFIG is defined on imported file, and
-        # b) the environment is a key
-        #
-        # an exception will be thrown if not
-        cfg = imported_python.CONFIG
+            cmd = self.commands[command]
+
+            # call the execute method on the Command class
+            with timing.span('e:%s %s' % (env_type, command), kind='command'):
+                cmd.execute(cfg, args)
+
+
+    def _load_commands(self):
+        """
+        Loads the commands for the bltenv file.
+
+        Commands come from the persisted index when it is up to date, which
+        means nothing needs to be imported. Otherwise the bltenv file is
+        imported, the commands are discovered and the index is rebuilt.
+
+        Returns:
+            A dict of command names to Command objects.
+        """
+        index = load_index(self.env_file)
+        if index is not None:
+            return dict((name, IndexedCommand(entry, self.env_dir))
+                for name, entry in index['commands'].items())
+
+        commands = self._extract_commands(self.loaded_env)
+        files = [source_file(sys.modules[cmd.klass.__module__])
+            for cmd in commands.values()]
+
+        environments = list(getattr(self.loaded_env, 'CONFIG', {}))
+
+        save_index(self.env_file,
+            dict((name, cmd.index_entry()) for name, cmd in commands.items()),
+            [path for path in files if path],
+            environments)
+
+        return commands
+
+    def _extract_config(self, config):
+        # the CONFIG from the bltenv file (or the cache) is left alone, blt's
+        # own settings go on a copy
+        cfg = dict(config)
         cfg.update({
             "blt": {
                   "env_file": self.env_file
@@ -235,34 +610,83 @@ class CommandCenter(object):
         return cfg
 
     def _extract_commands(self, imported_python, base_name=''):
+        """
+        Discovers the commands reachable from a module.
+
+        Commander classes defined in (or imported into) the module provide
+        the commands registered on them, along with their aliases, prefixed
+        with ``base_name``. The module's namespace still has to be walked:
+        which Commanders a bltenv exposes, and the prefix each is listed
+        under, is decided by what it imports and under which names, which
+        ``CommanderMeta`` can't know.
+        Submodules are only descended into when they define Commander
+        subclasses themselves or contain a module that does, see
+        ``has_commanders``. Everything else the module happens to import
+        (os, json, the tool's dependencies) is never looked at, so discovery
+        scales with the number of commands rather than the import graph.
+
+        Args:
+            imported_python: the module to discover commands in
+            base_name: prefix for the names of the discovered commands
+
+        Returns:
+            A dict of command names to Command objects.
+        """
         loaded_commands = {}
-        modules = getmembers(imported_python, ismodule)
-        cmd_classes = getmembers(imported_python, iscommander)
+        members = sorted(vars(imported_python).items())
+
+        for module_name, module in members:
+            if not ismodule(module) or module in self.module_cache:
+                continue
 
-        for module_name, module in modules:
-            if module not in self.module_cache:
+            if has_commanders(module):
                 self.module_cache.add(module)
                 new_base = base_name + module_name + '.'
-                commands = self._extract_commands(module, new_base)
+                loaded_commands.update(self._extract_commands(module, new_base))
 
-                loaded_commands.update(commands)
-                # for command_name, command_tup in commands.items():
-                #     if module_name not in loaded_commands:
-                #         loaded_commands[module_name] = {}
+        for klass_name, klass in members:
+            if not iscommander(klass):
+                continue
 
-                #     loaded_commands[module_name][command_name] = command_tup
+            # commands were registered on the class when it was created,
+            # aliases point at the same Command
+            for name in klass._commands:
+                cmd = Command(klass, name)
 
-        for klass_name, klass in cmd_classes:
-            # get all of the methods in the class
-            commands = getmembers(klass, iscommandmethod)
-
-            # need to create a generator here...
-            for name, method in commands:
-                command_name = ''.join([base_name, name])
-                loaded_commands[command_name] = Command(klass, name)
+                for command_name in [name] + cmd.aliases:
+                    loaded_commands[base_name + command_name] = cmd
 
         return loaded_commands
 
+def split_options(declared, args):
+    """
+    Separates declared --options from the positional args of a command.
+
+    Only options named in ``declared`` are pulled out, anything else starting
+    with "--" is left in place for commands that pass flags through to other
+    programs (django.test for instance).
+
+    Args:
+        declared: dict of option names to default values
+        args: the list of args from the command line
+
+    Returns:
+        A tuple of (dict of given options, list of remaining args).
+    """
+    options = {}
+    remaining = []
+
+    for arg in args:
+        name, sep, value = arg[2:].partition('=')
+        name = name.replace('-', '_')
+
+        if arg.startswith('--') and name in declared:
+            options[name] = value if sep else True
+        else:
+            remaining.append(arg)
+
+    return options, remaining
+
 def group_commands(toolname, commands):
     for command in sorted(commands):
         cmdsplit = command.split('.')
@@ -1,7 +1,9 @@
+import importlib
 import os
-from subprocess import call, check_output, CalledProcessError
+from subprocess import CalledProcessError
 import sys
 
+from blt import runner, timing
 from clint.textui import puts, indent, colored
 
 def abort(msg):
@@ -9,25 +11,114 @@ def abort(msg):
     puts(colored.red("Aborting.\n"))
     sys.exit(1)
 
-def local(command, collect_output=False, abort_on_stderr=True):
-    try:
-        if collect_output:
-            return check_output(command, shell=True)
-        else:
-            retcode = call(command, shell=True)
+def local(command, collect_output=False, abort_on_stderr=True, shell=None,
+          env=None):
+    """
+    Runs a command, aborting if it fails.
 
-            if retcode !=0:
-                raise CalledProcessError(retcode, command)
-    except CalledProcessError as e:
-        msg = [ "local() encountered an error while executing '{0}'".format(command),
-                "    Error: {0}".format(e.output or e),
-                "    Exit Code: {0}".format(e.returncode) ]
+    Args:
+        command: a list of arguments, or a command line string that is run
+            through /bin/sh
+        collect_output: return the command's stdout instead of printing it
+            (optional)
+        abort_on_stderr: abort if the command fails, when False the output
+            is returned regardless (optional)
+        shell: force running through /bin/sh or not (optional, decided by
+            the type of command by default)
+        env: the environment to run the command with (optional, defaults to
+            blt's own)
+
+    Returns:
+        The command's stdout if collect_output is set, None otherwise.
+
+    Usage:
+        local(['git', 'push', remote, 'master'])
+        local('find . -name "*.pyc" | wc -l')
+    """
+    line = runner.command_line(command)
+
+    with timing.span(line, kind='subprocess'):
+        result = runner.run(command, capture=collect_output, shell=shell,
+                            env=env)
+
+    if result.returncode != 0:
+        msg = [ "local() encountered an error while executing '{0}'".format(line),
+                "    Error: {0}".format(result.output or result.error or
+                    CalledProcessError(result.returncode, line)),
+                "    Exit Code: {0}".format(result.returncode) ]
 
         if not abort_on_stderr:
-            return e.output
+            return result.output
 
         abort('\n'.join(msg))
 
+    return result.output
+
+def local_lines(command, abort_on_stderr=True, shell=None, merge_stderr=False):
+    """
+    Runs a command, yielding the lines of its stdout as they arrive.
+
+    Unlike ``local(command, collect_output=True)`` the output is never held
+    in memory as a whole, so callers can parse it incrementally.
+
+    Args:
+        command: a list of arguments, or a command line string that is run
+            through /bin/sh
+        abort_on_stderr: abort once the output is exhausted if the command
+            failed (optional)
+        shell: force running through /bin/sh or not (optional)
+        merge_stderr: yield the lines of stderr too (optional)
+
+    Usage:
+        for line in local_lines(['python', 'manage.py', 'migrate', '--list']):
+            puts(line.rstrip())
+    """
+    line = runner.command_line(command)
+
+    with timing.span(line, kind='subprocess'):
+        output = runner.stream(command, shell, merge_stderr)
+        for out in output:
+            yield out
+
+    if output.returncode != 0 and abort_on_stderr:
+        abort('\n'.join([
+            "local_lines() encountered an error while executing '{0}'".format(line),
+            "    Exit Code: {0}".format(output.returncode) ]))
+
+def local_many(commands, limit=runner.DEFAULT_LIMIT, labels=None,
+               collect_output=False, shell=None, after=None):
+    """
+    Runs several commands concurrently, without aborting when one fails.
+
+    Args:
+        commands: list of commands to run, see ``local``
+        limit: how many of them may run at once (optional)
+        labels: list of labels to prefix the output of each command with
+            (optional, defaults to the command lines themselves)
+        collect_output: collect each command's stdout (optional)
+        shell: force running through /bin/sh or not (optional)
+        after: for each command, the indexes of the commands that must
+            succeed before it starts (optional, see ``blt.runner.run_many``)
+
+    Returns:
+        A list of ``blt.runner.CommandResult``, one for each command.
+
+    Usage:
+        results = local_many([['heroku', 'addons:add', addon, '--app', app]
+                              for addon in addons], labels=addons)
+    """
+    labels = labels or [runner.command_line(command) for command in commands]
+
+    with timing.span('%d commands' % len(commands), kind='subprocess'):
+        results = runner.run_many(commands, limit=limit, labels=labels,
+            capture=collect_output, shell=shell, after=after)
+
+        for result in results:
+            if result.duration is not None:
+                timing.record(result.label, result.duration, kind='subprocess')
+
+    return results
+
 def prompt(text, default=''):
 
     # Set up default display
@@ -58,3 +149,55 @@ class cd(object):
     def __exit__(self, etype, value, traceback):
         os.chdir(self.saved_path)
 
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is imported the first time it is used.
+
+    Every bltenv file imports its tools, so anything a tool imports at module
+    level slows down every blt command, ``blt list`` and ``blt help``
+    included. Tools bind their heavy dependencies with ``lazy_import`` so they
+    are only loaded once a command actually needs them.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        # introspection (command discovery's issubclass checks for instance)
+        # looks up special attributes, that alone must not trigger the import
+        if attr.startswith('__') and attr.endswith('__'):
+            raise AttributeError(attr)
+
+        return getattr(preload(self), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module %r (%s)>' % (self._name, state)
+
+def lazy_import(name):
+    """
+    Returns a module that is imported on first attribute access.
+
+    An ImportError for a missing module is raised on that first access, not
+    here.
+
+    Usage:
+        boto = lazy_import('boto')
+    """
+    return LazyModule(name)
+
+def preload(module):
+    """
+    Imports a module bound with ``lazy_import`` right away.
+
+    Anything that isn't a lazy module is returned as is, which makes it easy
+    to preload everything a tool module references (see blt.daemon).
+    """
+    if not isinstance(module, LazyModule):
+        return module
+
+    if module._module is None:
+        module.__dict__['_module'] = importlib.import_module(module._name)
+
+    return module._module
@@ -0,0 +1,144 @@
+"""
+Persisted index of the commands defined by a bltenv file.
+
+Discovering commands means importing the bltenv file and every tool module it
+references. The index records what discovery found (command name => module,
+class, method, aliases and docstring) along with the mtime and size of every
+file that contributed a command, so ``list``, ``help`` and ``completion`` can
+answer straight from disk. The index is rebuilt whenever one of those files changes.
+
+For shell completion the index also records the environment names defined in
+CONFIG, the --options of every command and the choices of its positional
+args, as documented on the Usage line of its docstring.
+
+Note that this module must only import from the standard library, it is used
+on code paths that need to start quickly.
+"""
+import os
+import re
+
+from blt import cache
+
+# bump this whenever the layout of the index changes
+INDEX_VERSION = 3
+
+# splits a Usage line into words, keeping quoted and bracketed args together
+USAGE_TOKEN = re.compile(r'"[^"]*"|\[[^\]]*\]|\([^)]*\)|\S+')
+
+
+def index_path(env_file):
+    """Returns the path of the cached index for a bltenv file."""
+    return cache.cache_path('index', '%s.json' % cache.file_key(env_file))
+
+def file_signature(path):
+    """
+    Returns the [mtime, size] signature of a file, or None if it is missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_mtime, stat.st_size]
+
+def source_file(module):
+    """
+    Returns the source file of a module, preferring .py over compiled files.
+    """
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+
+    base, ext = os.path.splitext(path)
+    if ext in ('.pyc', '.pyo') and os.path.exists(base + '.py'):
+        path = base + '.py'
+
+    return os.path.abspath(path)
+
+def usage_arguments(docstring, command):
+    """
+    Parses the positional args of a command from the Usage line of its
+    docstring.
+
+    Args:
+        docstring: the docstring of the command method
+        command: the method name of the command
+
+    Returns:
+        A list with one entry per positional arg, each a list of the values
+        the arg accepts (empty if the Usage line doesn't spell them out).
+
+    Examples:
+        blt e:[env] heroku.config [set|get|unset] ["Key=Value"]
+            => [['set', 'get', 'unset'], []]
+    """
+    lines = [line.strip() for line in (docstring or '').split('\n')]
+
+    for previous, line in zip(lines, lines[1:]):
+        if previous != 'Usage:':
+            continue
+
+        words = USAGE_TOKEN.findall(line)
+        names = [word.split('.')[-1] for word in words]
+        if command not in names:
+            continue
+
+        arguments = []
+        for word in words[names.index(command) + 1:]:
+            inner = word.strip('[]()')
+            if inner.startswith('--'):
+                continue
+
+            arguments.append(inner.split('|') if '|' in inner else [])
+
+        return arguments
+
+    return []
+
+def load_index(env_file):
+    """
+    Loads the index for a bltenv file.
+
+    Returns:
+        The index dict, or None if there is no index or it is stale.
+    """
+    index = cache.load(index_path(env_file))
+
+    if not index or index.get('version') != INDEX_VERSION:
+        return None
+
+    for path, signature in index['files'].items():
+        if file_signature(path) != signature:
+            return None
+
+    return index
+
+def save_index(env_file, commands, files, environments=()):
+    """
+    Writes the index for a bltenv file.
+
+    Args:
+        env_file: path to the bltenv file
+        commands: dict of command name (or alias) => dict with the module,
+            class, name, method, aliases, summary, docstring, options and
+            arguments of the command
+        files: the source files the commands were discovered from, the index
+            goes stale as soon as one of them changes
+        environments: the environment names defined in CONFIG
+
+    Returns:
+        The index dict that was written.
+    """
+    files = set(files)
+    files.add(os.path.abspath(env_file))
+
+    index = {
+        'version': INDEX_VERSION,
+        'env_file': os.path.abspath(env_file),
+        'files': dict((path, file_signature(path)) for path in files),
+        'commands': commands,
+        'environments': sorted(environments),
+    }
+
+    cache.dump(index_path(env_file), index)
+    return index
@@ -0,0 +1,27 @@
+"""
+Entry point of the blt executable.
+
+When a daemon is running for the project (see ``blt.daemon``) the whole
+invocation is handed to it, before clint, the bltenv file or the tools are
+imported. Otherwise this runs ``blt.main`` as usual. Keep the imports here to
+the standard library and blt's own light modules.
+"""
+import sys
+
+from blt import daemon
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # "blt daemon stop" and friends always talk to the daemon themselves
+    if argv[:1] != ['daemon']:
+        status = daemon.forward(argv)
+        if status is not None:
+            sys.exit(status)
+
+    from blt.main import main as run
+    run(argv)
+
+if __name__ == '__main__':
+    main()
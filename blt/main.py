@@ -1,21 +1,32 @@
-import sys
 import logging
+import os
+import shlex
+import sys
 
+from blt import completion, daemon, timing
 from blt.environment import CommandCenter
+from blt.helpers import abort
 from clint.arguments import Args
 from clint.textui import puts, indent
 from clint.textui.colored import red, blue, cyan, white, green, yellow, magenta
 
 
 DEFAULT_BLT_FILE = 'bltenv.py'
+
+# separates chained commands on the command line
+CHAIN_SEPARATOR = '+'
+
+# flags of blt itself, they go before the command (what follows the command
+# is its own)
+TIMINGS_FLAG = '--timings'
+PROFILE_FLAG = '--profile'
+
 env_shortcut_map = {
       'p': 'production'
     , 's': 'staging'
     , 'l': 'local'
 }
 
-args = Args()
-
 def usage():
     puts(white('\nGeneral blt usage:\n'))
     with indent(4):
@@ -51,15 +62,23 @@ def usage():
         puts('blt help - this screen')
         puts('blt help [command] - detailed command help')
         puts('blt list - list all available commands')
+        puts('blt [command] + [command] - run several commands in one go')
+        puts('blt e:staging,production [command] - run on several environments at once')
+        puts('blt batch [file] - run the commands listed in a file')
+        puts('blt daemon [start|stop|status] - keep this project warm between runs')
+        puts('blt --timings [command] - show where the time went')
+        puts('blt --profile[=file] [command] - also write flame graph data')
 
     puts(white('\nHelpful hints:\n'))
     with indent(4):
         puts('- Environment is optional, will default to local if none given.')
         puts('- Environment shortcuts: (p)roduction, (s)taging, (l)ocal.')
+        puts('- e:all runs a command on every environment in your bltenv file.')
         puts('- Tab completion works on tools/commands, give it a shot.')
+        puts('  (bash: eval "$(blt-complete --bash)")')
         puts('- Now, go make yerself a sandwich!\n')
 
-def determine_envtype():
+def determine_envtype(args):
     # find out if the environment was passed in, note that a call to
     # clint.args.get_with('e:') *should* work here, but sadly there is a bug
     # in clint and it doesn't handle when the argument is not passed correctly
@@ -78,46 +97,179 @@ def determine_envtype():
     # - (p)roduction
     # - (s)taging
     # - (l)ocal
-    envtype = envtype.split('e:', 1)[1]
+    # several environments can be given at once, separated by commas
+    envtypes = envtype.split('e:', 1)[1].split(',')
+
+    return ','.join(env_shortcut_map.get(name, name) for name in envtypes)
+
+def main(argv=None):
+    """
+    Runs blt.
+
+    Args:
+        argv: the command line args, without the program name (optional,
+            defaults to sys.argv)
+    """
+    args = Args(argv, no_argv=argv is not None)
 
-    if envtype in env_shortcut_map:
-        envtype = env_shortcut_map[envtype]
+    argv, profile = pop_timing_flags(args.all)
+    if profile is not None:
+        timing.enable()
+        args = Args(argv, no_argv=True)
 
-    return envtype
+    if args.get(0) == 'daemon':
+        exit(daemon.control(args.all[1:]))
 
-def main():
     # take care of the new user trying to figure wtf is going on here
     if not args or args.get(0) == 'help' and len(args) == 1:
         usage()
         exit(0)
 
+    # completion has its own fast path that doesn't load the bltenv file
+    if args.get(0) == 'completion':
+        exit(completion.main(args.all[1:]))
+
     try:
-        center = CommandCenter(DEFAULT_BLT_FILE)
+        with timing.span('load bltenv'):
+            center = CommandCenter(DEFAULT_BLT_FILE)
     except IOError as e:
         print red('[ERROR]') + ' %s' % e
         exit(1)
 
-    # figure out our environment
-    envtype = determine_envtype()
+    # figure out our environment and split up chained commands
+    steps = parse_steps(args.all)
+    envtype, first = steps[0]
 
     # user is requesting help on a specific command
-    if args.get(0) == 'help':
+    if first.get(0) == 'help':
         # call the commandcenter help method, we skip past index 0 which
         # is just the "help" arg.
-        center.help(args[1:])
+        center.help(first[1:])
         exit(0)
 
     # check if the user is requesting a list:
-    if args.get(0) == 'list':
-        center.list(args[1:])
-    elif args.get(0) == 'completion':
-        print '\n'.join(sorted(center.commands.keys()))
-    else:
-        cmd = args.pop(0)
-        try:
-            center.run(envtype, cmd, args.all)
-        except KeyboardInterrupt:
-            print '\nCancelled.'
+    if first.get(0) == 'list':
+        center.list(first[1:])
+        return
+
+    if first.get(0) == 'batch':
+        steps = read_batch(first.get(1), envtype)
+
+    try:
+        center.run_all([(envtype, cmd.get(0), cmd[1:])
+            for envtype, cmd in steps])
+    except KeyboardInterrupt:
+        print '\nCancelled.'
+    finally:
+        if timing.is_enabled():
+            timing.report(profile or None)
+
+def pop_timing_flags(argv):
+    """
+    Takes the --timings and --profile flags out of the command line.
+
+    They are only looked for ahead of the first command, with the
+    environment. Everything from the command on is passed through as is,
+    commands like django.test hand their args to other programs, which have
+    flags of their own.
+
+    Args:
+        argv: the command line args
+
+    Returns:
+        A tuple of (remaining args, profile). profile is None if timing
+        wasn't asked for, an empty string for --timings and the path of the
+        flame graph file for --profile.
+
+    Examples:
+        blt --timings e:staging heroku.create - prints a summary table
+        blt --profile=create.folded e:staging heroku.create - also writes
+            flame graph data to create.folded (blt-profile.folded if no
+            file is given)
+    """
+    remaining = []
+    profile = None
+
+    for index, arg in enumerate(argv):
+        if not arg.startswith(('--', 'e:')):
+            # the command, it and everything after it is left alone
+            remaining.extend(argv[index:])
+            break
+        elif arg == TIMINGS_FLAG:
+            profile = profile or ''
+        elif arg == PROFILE_FLAG:
+            profile = timing.DEFAULT_PROFILE
+        elif arg.startswith(PROFILE_FLAG + '='):
+            profile = arg.split('=', 1)[1] or timing.DEFAULT_PROFILE
+        else:
+            remaining.append(arg)
+
+    return remaining, profile
+
+def parse_steps(argv, envtype=None):
+    """
+    Splits the command line into the commands to run.
+
+    Commands are chained with a "+" between them. An environment given
+    with a command applies to it and the commands that follow, the first
+    command defaults to local.
+
+    Args:
+        argv: the command line args
+        envtype: environment of commands without one (optional)
+
+    Returns:
+        A list of (envtype, Args) tuples, one for each command.
+
+    Examples:
+        blt e:staging heroku.push + heroku.migrate - both run on staging
+        blt aws.sync_s3 + e:production aws.sync_s3 - syncs local first,
+            then production
+    """
+    segments = [[]]
+    for arg in argv:
+        if arg == CHAIN_SEPARATOR:
+            segments.append([])
+        else:
+            segments[-1].append(arg)
+
+    steps = []
+    for segment in segments:
+        args = Args(segment, no_argv=True)
+
+        if envtype is None or args.first_with('e:') is not None:
+            envtype = determine_envtype(args)
+
+        if args or not steps:
+            steps.append((envtype, args))
+
+    return steps
+
+def read_batch(filename, envtype):
+    """
+    Reads the commands of a batch file.
+
+    Every line holds one command, written just like on the command line
+    (minus the "blt"). Blank lines and anything after a # are ignored.
+
+    Args:
+        filename: path to the batch file
+        envtype: environment of commands without one
+
+    Returns:
+        A list of (envtype, Args) tuples, one for each command.
+    """
+    if not filename or not os.path.isfile(filename):
+        abort('batch file [%s] not found.' % filename)
+
+    argv = []
+    with open(filename) as f:
+        for line in f:
+            words = shlex.split(line, comments=True)
+            if words:
+                argv.extend(words + [CHAIN_SEPARATOR])
+
+    return parse_steps(argv, envtype)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,274 @@
+"""
+Runs blt jobs side by side in forked processes.
+
+Commands print straight to stdout (clint's ``puts`` holds on to the original
+stream), so threads can't tell their output apart. Every job gets a process
+of its own instead, with its stdout and stderr going to a pipe. The parent
+reads all the pipes and writes whole lines only, each prefixed with the label
+of its job, so output from concurrent jobs never gets mixed up mid-line.
+
+``run_graph`` also lets jobs wait for others, a job is started once the jobs
+it comes after have succeeded. Jobs that may need to ask the user something
+(a git push prompting for credentials) can run in the foreground instead:
+in blt's own process, on the terminal, while the forked jobs carry on.
+
+Note that this module must only import from the standard library.
+"""
+import errno
+import os
+import select
+import sys
+import time
+import traceback
+
+
+class Job(object):
+    """
+    A job run by ``run_graph``.
+
+    Attributes:
+        label: the label its output is prefixed with
+        func: what it runs
+        after: labels of the jobs it waits for
+        status: its exit status, None if it was skipped
+        started: when it was forked, in seconds since the epoch (or None)
+        ended: when it exited (or None)
+    """
+    def __init__(self, label, func, after=()):
+        self.label = label
+        self.func = func
+        self.after = list(after)
+        self.status = None
+        self.started = None
+        self.ended = None
+        self.pid = None
+        self.done = False
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return '<Job %s exit %r>' % (self.label, self.status)
+
+
+def run_forked(jobs, out=None):
+    """
+    Runs each job in a forked process, all at the same time.
+
+    Args:
+        jobs: list of (label, func) tuples, func is called without arguments
+            in the child process
+        out: stream the prefixed output is written to (optional, defaults to
+            sys.stdout)
+
+    Returns:
+        A dict of label => exit status of its job. A job that returns
+        normally exits with 0, ``sys.exit`` (and ``abort``) work as usual.
+
+    Usage:
+        statuses = run_forked([('staging', deploy_staging),
+                               ('production', deploy_production)])
+    """
+    return dict((job.label, job.status) for job in run_graph(jobs, out=out))
+
+def run_graph(jobs, after=None, out=None, foreground=()):
+    """
+    Runs each job in a forked process, as soon as the jobs it waits for have
+    succeeded.
+
+    Jobs that don't wait for anything all start right away. A job is skipped
+    if a job it waits for fails (or is skipped itself).
+
+    Foreground jobs aren't forked, they run in this process with the
+    terminal's stdin, stdout and stderr. The forked jobs keep running in the
+    meantime, their output is held back until the foreground job is done.
+
+    Args:
+        jobs: list of (label, func) tuples, see ``run_forked``
+        after: dict of label => labels of the jobs it waits for (optional)
+        out: stream the prefixed output is written to (optional, defaults to
+            sys.stdout)
+        foreground: labels of the jobs to run in the foreground (optional)
+
+    Returns:
+        A list of ``Job``, in the order of ``jobs``.
+
+    Raises:
+        ValueError: a job waits for an unknown job, or jobs wait for each
+            other in a cycle.
+
+    Usage:
+        jobs = run_graph([('create', create), ('push', push),
+                          ('migrate', migrate)],
+                         after={'push': ['create'], 'migrate': ['push']})
+    """
+    out = out or sys.stdout
+    after = after or {}
+    jobs = [Job(label, func, after.get(label, ())) for label, func in jobs]
+    by_label = dict((job.label, job) for job in jobs)
+
+    for job in jobs:
+        unknown = [label for label in job.after if label not in by_label]
+        if unknown:
+            raise ValueError('%s waits for unknown jobs: %s' % (job.label,
+                ', '.join(unknown)))
+
+    pending = list(jobs)
+    readers = {}
+
+    try:
+        while pending or readers:
+            ready = []
+            for job in list(pending):
+                waits = [by_label[label] for label in job.after]
+                if not all(wait.done for wait in waits):
+                    continue
+
+                pending.remove(job)
+                if not all(wait.ok for wait in waits):
+                    job.done = True
+                elif job.label in foreground:
+                    ready.append(job)
+                else:
+                    _start(job, readers)
+
+            # the jobs that could be forked are, so they overlap with the
+            # foreground ones
+            if ready:
+                for job in ready:
+                    _run_foreground(job)
+                continue
+
+            if not readers:
+                if pending:
+                    raise ValueError('jobs wait for each other: %s' %
+                        ', '.join(job.label for job in pending))
+                break
+
+            for fd in _select(list(readers)):
+                job = readers[fd][2]
+                if not _relay(fd, readers, out):
+                    _finish(job)
+    finally:
+        for fd, (label, pending_line, job) in readers.items():
+            os.close(fd)
+            _finish(job)
+
+    return jobs
+
+def exit_status(func):
+    """Calls ``func`` and returns the exit status it amounts to."""
+    try:
+        func()
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+
+        sys.stderr.write('%s\n' % e.code)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+    return 0
+
+def _run_child(func, write_fd):
+    """Runs a job in the forked process, this never returns."""
+    code = 1
+    try:
+        # jobs run unattended, there is nobody to answer a prompt
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(devnull)
+        os.close(write_fd)
+
+        code = exit_status(func)
+    finally:
+        _flush()
+        os._exit(code)
+
+def _run_foreground(job):
+    """Runs a job in this process."""
+    _flush()
+    job.started = time.time()
+    job.status = exit_status(job.func)
+    job.ended = time.time()
+    job.done = True
+
+def _start(job, readers):
+    """Forks the process for a job."""
+    read_fd, write_fd = os.pipe()
+    _flush()
+
+    job.started = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        for fd in readers:
+            os.close(fd)
+        _run_child(job.func, write_fd)
+
+    os.close(write_fd)
+    readers[read_fd] = [job.label, '', job]
+    job.pid = pid
+
+def _finish(job):
+    job.status = _wait(job.pid)
+    job.ended = time.time()
+    job.done = True
+
+def _relay(fd, readers, out):
+    """Writes the complete lines a job has output, False once it is done."""
+    label, pending = readers[fd][:2]
+    data = os.read(fd, 2**16)
+
+    if not data:
+        # the job is done, flush whatever is left of its last line
+        if pending:
+            out.write('[%s] %s\n' % (label, pending))
+            out.flush()
+        os.close(fd)
+        del readers[fd]
+        return False
+
+    lines = (pending + data).split('\n')
+    readers[fd][1] = lines.pop()
+
+    for line in lines:
+        out.write('[%s] %s\n' % (label, line))
+    out.flush()
+    return True
+
+def _select(fds):
+    while True:
+        try:
+            return select.select(fds, [], [])[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+def _wait(pid):
+    while True:
+        try:
+            _, status = os.waitpid(pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+def _flush():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (IOError, ValueError):
+            pass
@@ -0,0 +1,476 @@
+"""
+Runs subprocesses, several at a time if asked to.
+
+``helpers.local`` runs its commands through here, and ``run_many`` launches a
+batch of commands concurrently, with a limit on how many run at once. A
+single event loop (``select`` over the pipes of every running command) does
+the work, so there are no threads involved.
+
+Output is streamed line by line as it arrives. Commands given a label have
+their lines prefixed with it, which keeps the output of concurrent commands
+apart, and read their stdin from /dev/null, as they can't all share the
+terminal's. Unlabelled commands that don't capture anything are connected to
+the terminal directly, so interactive commands work as usual.
+
+Commands may also wait for others: ``run_many`` starts a command once the
+commands it comes ``after`` have succeeded, and skips it if one of them
+failed.
+
+Ctrl-C is passed on to every running command, commands that haven't started
+yet never do, and the KeyboardInterrupt is raised once they are all gone.
+
+Captured output is kept in memory up to ``SPILL_SIZE`` bytes per command and
+spills to a temporary file beyond that. ``stream`` goes one step further and
+hands out the lines of a single command as they arrive, so however chatty the
+command, memory stays flat.
+
+Commands are either a list of arguments, run as is, or a command line string
+that goes through /bin/sh (pipes, redirects and globs work, but so do quoting
+mistakes). Lists are preferred, they save spawning a shell for every command.
+
+Note that this module must only import from the standard library.
+"""
+import errno
+import os
+import pipes
+import select
+import signal
+import subprocess
+import sys
+import time
+
+# how many commands run_many runs at once by default
+DEFAULT_LIMIT = 4
+
+# seconds a cancelled command gets to exit before it is killed
+CANCEL_TIMEOUT = 5
+
+# how often the event loop checks on commands that have no pipes
+POLL_INTERVAL = 0.05
+
+# captured output beyond this many bytes goes to a temporary file
+SPILL_SIZE = 2**20
+
+
+class CommandResult(object):
+    """
+    The outcome of a command run by ``run`` or ``run_many``.
+
+    Attributes:
+        command: the command that ran
+        label: the label its output was prefixed with (or None)
+        returncode: its exit status, 127 if it couldn't be started, None if
+            it was skipped
+        error: why the command couldn't be started or was skipped (or None)
+        started: when it started, in seconds since the epoch (or None)
+        ended: when it was done (or None)
+    """
+    def __init__(self, command, label=None):
+        self.command = command
+        self.label = label
+        self.returncode = None
+        self.error = None
+        self.captured = None
+        self.started = None
+        self.ended = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    @property
+    def duration(self):
+        """Seconds the command ran for, None if it never started."""
+        if self.started is None or self.ended is None:
+            return None
+
+        return self.ended - self.started
+
+    @property
+    def output(self):
+        """The captured stdout as a string, None unless capture was asked for."""
+        if self.captured is None:
+            return None
+
+        return ''.join(self.lines())
+
+    def lines(self):
+        """Iterates over the captured stdout without reading it all in."""
+        if self.captured is None:
+            return iter(())
+
+        return self.captured.lines()
+
+    def __repr__(self):
+        return '<CommandResult %r exit %r>' % (self.command, self.returncode)
+
+
+class CaptureBuffer(object):
+    """
+    Collects output in memory, spilling to a temporary file once it grows
+    beyond ``spill_size`` bytes.
+    """
+    def __init__(self, spill_size=SPILL_SIZE):
+        import tempfile
+
+        self.file = tempfile.SpooledTemporaryFile(max_size=spill_size)
+        self.size = 0
+
+    @property
+    def spilled(self):
+        return self.file._rolled
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def lines(self):
+        self.file.seek(0)
+        for line in iter(self.file.readline, ''):
+            yield line
+
+
+class OutputStream(object):
+    """
+    The stdout of a running command, line by line.
+
+    ``returncode`` is set once all lines have been read. Closing the stream
+    early (or breaking out of a loop over ``stream()`` and dropping it) stops
+    the command.
+    """
+    def __init__(self, command, shell=None, merge_stderr=False):
+        self.command = command
+        self.returncode = None
+        self.exhausted = False
+
+        _flush()
+        self.proc = subprocess.Popen(command, shell=use_shell(command, shell),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else None)
+
+    def __iter__(self):
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                yield line
+            self.exhausted = True
+        finally:
+            self.close()
+
+    def close(self):
+        if self.returncode is not None:
+            return
+
+        if not self.exhausted and self.proc.poll() is None:
+            # the reader gave up early, nobody wants the rest
+            self.proc.kill()
+
+        self.proc.stdout.close()
+        self.returncode = self.proc.wait()
+
+
+def use_shell(command, shell=None):
+    """
+    Tells whether a command runs through /bin/sh.
+
+    Args:
+        command: a command line string or a list of arguments
+        shell: True or False to decide explicitly, None (the default) runs
+            strings through the shell and lists without it
+    """
+    if shell is None:
+        return isinstance(command, basestring)
+
+    return shell
+
+def command_line(command):
+    """Returns a command as a string, for messages and timings."""
+    if isinstance(command, basestring):
+        return command
+
+    return ' '.join(pipes.quote(arg) for arg in command)
+
+def run(command, capture=False, shell=None, env=None):
+    """
+    Runs a single command and waits for it.
+
+    Args:
+        command: a list of arguments or a command line string
+        capture: collect stdout instead of printing it (optional)
+        shell: run the command through /bin/sh (optional, see ``use_shell``)
+        env: the environment to run the command with (optional, defaults to
+            blt's own)
+
+    Returns:
+        A ``CommandResult``.
+    """
+    return run_many([command], capture=capture, shell=shell, env=env)[0]
+
+def stream(command, shell=None, merge_stderr=False):
+    """
+    Runs a command, handing out its stdout line by line as it arrives.
+
+    Args:
+        command: a list of arguments or a command line string
+        shell: run the command through /bin/sh (optional, see ``use_shell``)
+        merge_stderr: hand out the lines of stderr too (optional)
+
+    Returns:
+        An ``OutputStream``, its ``returncode`` is set once it is exhausted.
+
+    Usage:
+        output = stream(['python', 'manage.py', 'migrate', '--list'])
+        for line in output:
+            parse(line)
+        if output.returncode != 0:
+            ...
+    """
+    return OutputStream(command, shell, merge_stderr)
+
+def run_many(commands, limit=DEFAULT_LIMIT, capture=False, labels=None,
+             shell=None, after=None, env=None):
+    """
+    Runs commands concurrently, at most ``limit`` of them at a time.
+
+    Commands start in the order given, except that a command with entries in
+    ``after`` waits until those commands have succeeded. If one of them
+    fails (or is skipped itself) the command is skipped.
+
+    Args:
+        commands: list of commands (lists of arguments or strings)
+        limit: how many commands may run at once (optional)
+        capture: collect the stdout of every command (optional)
+        labels: list of labels to prefix the output of each command with
+            (optional)
+        shell: run the commands through /bin/sh (optional, see
+            ``use_shell``)
+        after: list holding, for each command, the indexes of the commands
+            it has to wait for (optional)
+        env: the environment to run the commands with (optional, defaults
+            to blt's own)
+
+    Returns:
+        A list of ``CommandResult``, in the order of ``commands``. A failing
+        command doesn't stop the others, only the commands that wait for it.
+
+    Raises:
+        ValueError: the commands wait for each other in a cycle.
+
+    Usage:
+        results = run_many([['heroku', 'addons:add', name, '--app', app]
+                            for name in addons], labels=addons)
+        failed = [result for result in results if not result.ok]
+    """
+    labels = labels or [None] * len(commands)
+    jobs = [_Job(command, label, capture, shell, env)
+        for command, label in zip(commands, labels)]
+    for job, indexes in zip(jobs, after or []):
+        job.after = [jobs[index] for index in indexes]
+
+    pending = list(jobs)
+    running = []
+
+    try:
+        while pending or running:
+            _schedule(pending, running, limit)
+
+            if not running:
+                if pending:
+                    raise ValueError('commands wait for each other: %s' %
+                        ', '.join(command_line(job.result.command)
+                                  for job in pending))
+                break
+
+            _pump(running)
+
+            for job in list(running):
+                if job.finished():
+                    running.remove(job)
+    except KeyboardInterrupt:
+        _cancel(running)
+        raise
+
+    return [job.result for job in jobs]
+
+class _Job(object):
+    def __init__(self, command, label, capture, shell, env=None):
+        self.result = CommandResult(command, label)
+        self.capture = capture
+        self.shell = shell
+        self.env = env
+        self.proc = None
+        self.streams = {}
+        self.after = []
+        self.done = False
+
+        if capture:
+            self.result.captured = CaptureBuffer(SPILL_SIZE)
+
+    def blocked(self):
+        """Tells whether a command it waits for hasn't finished yet."""
+        return not all(job.done for job in self.after)
+
+    def skip(self):
+        """Tells whether a command it waits for failed."""
+        return any(not job.result.ok for job in self.after)
+
+    def start(self):
+        if self.skip():
+            failed = [job.result.label or command_line(job.result.command)
+                for job in self.after if not job.result.ok]
+            self.result.error = 'skipped, %s failed' % ', '.join(failed)
+            self.done = True
+            return False
+
+        piped = self.result.label is not None
+        stdout = subprocess.PIPE if self.capture or piped else None
+        stderr = subprocess.PIPE if piped else None
+
+        # concurrent commands reading the terminal would steal each other's
+        # input, labelled ones get none
+        stdin = open(os.devnull) if piped else None
+
+        _flush()
+        self.result.started = time.time()
+        try:
+            self.proc = subprocess.Popen(self.result.command,
+                shell=use_shell(self.result.command, self.shell),
+                stdin=stdin, stdout=stdout, stderr=stderr, env=self.env)
+        except OSError as e:
+            self.result.returncode = 127
+            self.result.error = str(e)
+            self.result.ended = time.time()
+            self.done = True
+            self._write(sys.stderr, '%s: %s\n' % (
+                command_line(self.result.command), e))
+            return False
+        finally:
+            if stdin is not None:
+                stdin.close()
+
+        for pipe, target in ((self.proc.stdout, sys.stdout),
+                             (self.proc.stderr, sys.stderr)):
+            if pipe is not None:
+                self.streams[pipe.fileno()] = [pipe, target, '']
+
+        return True
+
+    def fds(self):
+        return list(self.streams)
+
+    def read(self, fd):
+        pipe, target, pending = self.streams[fd]
+        data = _read(fd)
+
+        if not data:
+            if pending:
+                self._emit(pipe, target, pending)
+            pipe.close()
+            del self.streams[fd]
+            return
+
+        lines = (pending + data).split('\n')
+        self.streams[fd][2] = lines.pop()
+
+        for line in lines:
+            self._emit(pipe, target, line + '\n')
+
+    def finished(self):
+        if self.streams or self.proc.poll() is None:
+            return False
+
+        self.result.returncode = self.proc.returncode
+        self.result.ended = time.time()
+        self.done = True
+        return True
+
+    def interrupt(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.send_signal(signal.SIGINT)
+            except OSError:
+                pass
+
+    def _emit(self, pipe, target, line):
+        if self.capture and pipe is self.proc.stdout:
+            self.result.captured.write(line)
+        else:
+            self._write(target, line)
+
+    def _write(self, target, line):
+        if self.result.label is not None:
+            line = '[%s] %s' % (self.result.label, line)
+        target.write(line)
+        target.flush()
+
+def _schedule(pending, running, limit):
+    """Starts (or skips) every pending command that can go."""
+    progress = True
+    while progress:
+        progress = False
+        for job in list(pending):
+            if job.blocked():
+                continue
+            if not job.skip() and len(running) >= max(limit, 1):
+                continue
+
+            pending.remove(job)
+            progress = True
+            if job.start():
+                running.append(job)
+
+def _pump(running):
+    """Relays whatever output the running commands have ready."""
+    owners = dict((fd, job) for job in running for fd in job.fds())
+
+    # commands without pipes can only be polled for their exit
+    timeout = None
+    if not all(job.fds() for job in running):
+        timeout = POLL_INTERVAL
+
+    if not owners:
+        # nothing to relay. a lone command can simply be waited for, several
+        # are polled so that whichever exits first frees its slot right away
+        if len(running) == 1:
+            running[0].proc.wait()
+        elif running:
+            time.sleep(POLL_INTERVAL)
+        return
+
+    for fd in _select(list(owners), timeout):
+        owners[fd].read(fd)
+
+def _cancel(running):
+    for job in running:
+        job.interrupt()
+
+    deadline = time.time() + CANCEL_TIMEOUT
+    for job in running:
+        while job.proc.poll() is None and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+
+        if job.proc.poll() is None:
+            job.proc.kill()
+            job.proc.wait()
+
+def _select(fds, timeout):
+    try:
+        return select.select(fds, [], [], timeout)[0]
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return []
+
+def _read(fd):
+    while True:
+        try:
+            return os.read(fd, 2**16)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+def _flush():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (IOError, ValueError):
+            pass
@@ -1,4 +1,4 @@
-from blt.environment import Commander
+from blt.environment import Commander, command
 import importedtest
 
 
@@ -10,9 +10,11 @@ class TestCommands(Commander):
     def default_command(self):
         pass
 
+    @command(aliases=['srl'])
     def some_really_long_aliased_command(self):
         pass
 
+    @command(aliases=['siamese', 'twin'])
     def command_with_aliases(self):
         pass
 
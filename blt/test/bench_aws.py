@@ -0,0 +1,244 @@
+"""
+Benchmark harness for the aws tool.
+
+Runs ``sync_s3``, ``list_changes`` and ``pull_s3`` against an in-process
+``FakeBucket`` and reports wall time, request counts and bytes transferred
+for every phase. The source tree is synthetic: lots of small files, a few
+huge ones and a mix of compressible and incompressible content types.
+
+Usage:
+    python -m blt.test.bench_aws [options]
+
+Examples:
+    python -m blt.test.bench_aws - default, 10k small files and 3 huge ones
+    python -m blt.test.bench_aws --small 500 --huge 0 - quick run
+    python -m blt.test.bench_aws --latency 20 --bandwidth 10 - simulates 20ms
+        round trips and 10MB/s of bandwidth
+"""
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from blt.test.fakes3 import FakeBucket
+from blt.tools import aws
+
+# extensions used for the small files, cycled through in order. the .txt and
+# .png files are filled with random bytes and won't compress.
+SMALL_FILE_TYPES = [
+    ('css', 'compressible'),
+    ('js', 'compressible'),
+    ('json', 'compressible'),
+    ('html', 'compressible'),
+    ('svg', 'compressible'),
+    ('txt', 'random'),
+    ('png', 'random'),
+]
+
+WORDS = ['blt', 'bacon', 'lettuce', 'tomato', 'toast', 'mayo', 'sandwich',
+         'heroku', 'bucket', 'static', 'asset', 'deploy', 'staging']
+
+
+def make_tree(root, small=10000, huge=3, small_size=2048, huge_size=64 * 2**20,
+              seed=0):
+    """
+    Generates a synthetic source tree.
+
+    Args:
+        root: directory to create the files in
+        small: number of small files
+        huge: number of huge files
+        small_size: approximate size of each small file in bytes
+        huge_size: size of each huge file in bytes
+        seed: random seed, so runs are comparable
+
+    Returns:
+        The total number of bytes written.
+    """
+    rnd = random.Random(seed)
+    total = 0
+
+    for i in range(small):
+        ext, kind = SMALL_FILE_TYPES[i % len(SMALL_FILE_TYPES)]
+        name = os.path.join(root, 'dir%03d' % (i % 100), 'file%05d.%s' % (i, ext))
+        size = rnd.randint(small_size // 2, small_size * 2)
+        total += write_file(name, size, kind, rnd)
+
+    for i in range(huge):
+        # alternate between a huge compressible log and a huge binary blob
+        kind = 'compressible' if i % 2 == 0 else 'random'
+        ext = 'csv' if kind == 'compressible' else 'bin'
+        name = os.path.join(root, 'huge', 'huge%02d.%s' % (i, ext))
+        total += write_file(name, huge_size, kind, rnd)
+
+    return total
+
+def write_file(name, size, kind, rnd, block_size=2**20):
+    aws.prep_path(name)
+
+    # compressible content is a block of random words, repeated as needed
+    words = ' '.join(rnd.choice(WORDS) for _ in range(1000)) + '\n'
+
+    with open(name, 'wb') as f:
+        written = 0
+        while written < size:
+            chunk = min(block_size, size - written)
+            if kind == 'random':
+                data = os.urandom(chunk)
+            else:
+                data = (words * (chunk // len(words) + 1))[:chunk]
+
+            f.write(data)
+            written += chunk
+
+    return size
+
+@contextmanager
+def quiet(enabled=True):
+    """
+    Silences stdout while the commands print their progress.
+
+    clint's ``puts`` holds on to the original ``sys.stdout.write``, so we
+    redirect the file descriptor rather than swapping ``sys.stdout``.
+    """
+    if not enabled:
+        yield
+        return
+
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+def measure(name, bucket, func, verbose=False):
+    """
+    Runs ``func`` and returns a result dict for the report.
+    """
+    bucket.stats.reset()
+    start = time.time()
+
+    with quiet(not verbose):
+        func()
+
+    return {
+        'phase': name,
+        'seconds': time.time() - start,
+        'requests': dict(bucket.stats.requests),
+        'total_requests': bucket.stats.total_requests,
+        'bytes_sent': bucket.stats.bytes_sent,
+        'bytes_received': bucket.stats.bytes_received,
+    }
+
+def run(small=10000, huge=3, huge_size=64 * 2**20, latency=0.0,
+        bandwidth=None, workers=4, verbose=False, config=None):
+    """
+    Runs the benchmark suite.
+
+    Args:
+        small: number of small files in the synthetic tree
+        huge: number of huge files in the synthetic tree
+        huge_size: size of each huge file in bytes
+        latency: simulated seconds per request
+        bandwidth: simulated bytes per second, None for unlimited
+        workers: UPLOAD_WORKERS setting for the run
+        verbose: if True, show the output of the commands
+        config: extra aws settings for the environment
+
+    Returns:
+        A list of result dicts, one per phase.
+    """
+    workdir = tempfile.mkdtemp(prefix='blt-bench-')
+    source = os.path.join(workdir, 'source')
+    target = os.path.join(workdir, 'target')
+    saved_cache_dir = os.environ.get('BLT_CACHE_DIR')
+    os.environ['BLT_CACHE_DIR'] = os.path.join(workdir, 'cache')
+
+    aws_cfg = {
+        'AWS_ACCESS_KEY_ID': 'fake',
+        'AWS_SECRET_ACCESS_KEY': 'fake',
+        'AWS_BUCKET_NAME': 'blt-bench',
+        'SOURCE_FOLDER': source,
+        'UPLOAD_WORKERS': workers,
+    }
+    aws_cfg.update(config or {})
+
+    bucket = FakeBucket('blt-bench', latency=latency, bandwidth=bandwidth)
+    cmds = aws.AmazonCommands({'aws': aws_cfg})
+    cmds._get_s3_bucket = lambda: bucket
+
+    try:
+        os.makedirs(source)
+        os.makedirs(target)
+        make_tree(source, small, huge, huge_size=huge_size)
+
+        return [
+            measure('sync_s3 (cold)', bucket, cmds.sync_s3, verbose),
+            measure('sync_s3 (no changes)', bucket, cmds.sync_s3, verbose),
+            measure('list_changes', bucket, cmds.list_changes, verbose),
+            measure('pull_s3 (empty target)', bucket,
+                    lambda: cmds.pull_s3(target), verbose),
+        ]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if saved_cache_dir is None:
+            del os.environ['BLT_CACHE_DIR']
+        else:
+            os.environ['BLT_CACHE_DIR'] = saved_cache_dir
+
+def report(results, stream=sys.stdout):
+    header = '{0:24} {1:>9} {2:>9} {3:>30} {4:>12} {5:>12}'
+    stream.write(header.format('phase', 'seconds', 'requests', 'by type',
+                               'sent', 'received') + '\n')
+
+    for result in results:
+        by_type = ' '.join('%s=%d' % item
+                           for item in sorted(result['requests'].items()))
+        stream.write('{0:24} {1:>9.3f} {2:>9} {3:>30} {4:>12} {5:>12}\n'.format(
+            result['phase'],
+            result['seconds'],
+            result['total_requests'],
+            by_type,
+            aws.format_bytes(result['bytes_sent']),
+            aws.format_bytes(result['bytes_received'])))
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmarks the blt aws tool against '
+                                        'an in-process fake S3 bucket.')
+    parser.add_argument('--small', type=int, default=10000,
+                        help='number of small files (default 10000)')
+    parser.add_argument('--huge', type=int, default=3,
+                        help='number of huge files (default 3)')
+    parser.add_argument('--huge-size', type=int, default=64,
+                        help='size of each huge file in MB (default 64)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated latency per request in ms')
+    parser.add_argument('--bandwidth', type=float, default=0.0,
+                        help='simulated bandwidth in MB/s, 0 for unlimited')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='UPLOAD_WORKERS setting (default 4)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of the aws commands')
+    opts = parser.parse_args(argv)
+
+    results = run(small=opts.small,
+                  huge=opts.huge,
+                  huge_size=opts.huge_size * 2**20,
+                  latency=opts.latency / 1000.0,
+                  bandwidth=opts.bandwidth * 2**20 or None,
+                  workers=opts.workers,
+                  verbose=opts.verbose)
+    report(results)
+
+if __name__ == '__main__':
+    main()
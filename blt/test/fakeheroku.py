@@ -0,0 +1,238 @@
+"""
+Local stand-in for the parts of the Heroku Platform API that blt uses.
+
+The fake serves the API over HTTP on localhost, keeps apps in memory and
+records every request, along with the number of connections the client
+opened. Point blt at it with HEROKU_API_URL.
+
+Example:
+
+    api = FakeHerokuAPI(token='secret')
+    api.add_app('pubweb-staging', config={'DEBUG': 'True'})
+    api.start()
+    os.environ['HEROKU_API_URL'] = api.url
+    ...
+    print api.requests
+    api.stop()
+"""
+import BaseHTTPServer
+import itertools
+import json
+import re
+import SocketServer
+import threading
+import urllib
+
+ROUTES = [
+      ('GET', r'/apps/([^/]+)', 'get_app')
+    , ('DELETE', r'/apps/([^/]+)', 'delete_app')
+    , ('GET', r'/apps/([^/]+)/config-vars', 'get_config')
+    , ('PATCH', r'/apps/([^/]+)/config-vars', 'patch_config')
+    , ('GET', r'/apps/([^/]+)/addons', 'get_addons')
+    , ('POST', r'/apps/([^/]+)/addons', 'post_addon')
+    , ('PATCH', r'/apps/([^/]+)/addons/([^/]+)', 'patch_addon')
+    , ('DELETE', r'/apps/([^/]+)/addons/([^/]+)', 'delete_addon')
+    , ('GET', r'/apps/([^/]+)/domains', 'get_domains')
+    , ('POST', r'/apps/([^/]+)/domains', 'post_domain')
+    , ('DELETE', r'/apps/([^/]+)/domains/([^/]+)', 'delete_domain')
+]
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class FakeHerokuAPI(object):
+    """
+    An in-memory Heroku Platform API.
+
+    Args:
+        token: the API token requests must carry
+    """
+    def __init__(self, token='fake-token'):
+        self.token = token
+        self.apps = {}
+        self.requests = []
+        self.connections = 0
+        self.server = None
+        self._ids = itertools.count(1)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server.server_address
+
+    def add_app(self, name, config=None, addons=(), domains=()):
+        """
+        Creates an app. Addons are given as "service:plan" strings, every
+        app also gets its herokuapp.com domain.
+        """
+        self.apps[name] = {
+              'config': dict(config or {})
+            , 'addons': []
+            , 'domains': [{'hostname': '%s.herokuapp.com' % name,
+                           'kind': 'heroku'}]
+        }
+
+        for plan in addons:
+            self.post_addon(name, {'plan': plan})
+        for hostname in domains:
+            self.post_domain(name, {'hostname': hostname})
+
+    def start(self):
+        fake = self
+
+        class Handler(RequestHandler):
+            api = fake
+
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, body, authorization):
+        self.requests.append((method, path, body))
+
+        if authorization != 'Bearer %s' % self.token:
+            raise APIError(401, 'Invalid credentials provided.')
+
+        for route_method, pattern, name in ROUTES:
+            match = re.match(pattern + '$', path)
+            if route_method == method and match:
+                args = [urllib.unquote(arg) for arg in match.groups()]
+                if body is not None:
+                    args.append(body)
+                return getattr(self, name)(*args)
+
+        raise APIError(404, 'The requested API endpoint was not found.')
+
+    # -- API endpoints --------------------------------------------------------
+    def get_app(self, name):
+        self._app(name)
+        return {
+              'name': name
+            , 'git_url': 'https://git.heroku.com/%s.git' % name
+            , 'web_url': 'https://%s.herokuapp.com/' % name
+            , 'owner': {'email': 'owner@example.com'}
+            , 'region': {'name': 'us'}
+            , 'stack': {'name': 'heroku-18'}
+        }
+
+    def delete_app(self, name):
+        self._app(name)
+        del self.apps[name]
+        return {'name': name}
+
+    def get_config(self, name):
+        return self._app(name)['config']
+
+    def patch_config(self, name, changes):
+        config = self._app(name)['config']
+        for key, value in changes.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+
+        return config
+
+    def get_addons(self, name):
+        return self._app(name)['addons']
+
+    def post_addon(self, name, body):
+        service, _, level = body['plan'].partition(':')
+        if level == 'broken':
+            raise APIError(422, "Couldn't find either the add-on service or "
+                "the add-on plan of %s." % body['plan'])
+
+        addon = {
+              'id': 'addon-%d' % next(self._ids)
+            , 'name': '%s-%d' % (service, len(self._app(name)['addons']) + 1)
+            , 'addon_service': {'name': service}
+            , 'plan': {'name': body['plan']}
+        }
+        self._app(name)['addons'].append(addon)
+        return addon
+
+    def patch_addon(self, name, addon_id, body):
+        addon = self._addon(name, addon_id)
+        addon['plan'] = {'name': body['plan']}
+        return addon
+
+    def delete_addon(self, name, addon_id):
+        addon = self._addon(name, addon_id)
+        self._app(name)['addons'].remove(addon)
+        return addon
+
+    def get_domains(self, name):
+        return self._app(name)['domains']
+
+    def post_domain(self, name, body):
+        domain = {'hostname': body['hostname'], 'kind': 'custom'}
+        self._app(name)['domains'].append(domain)
+        return domain
+
+    def delete_domain(self, name, hostname):
+        domains = self._app(name)['domains']
+        for domain in domains:
+            if domain['hostname'] == hostname:
+                domains.remove(domain)
+                return domain
+
+        raise APIError(404, "Couldn't find that domain.")
+
+    def _app(self, name):
+        if name not in self.apps:
+            raise APIError(404, "Couldn't find that app.")
+
+        return self.apps[name]
+
+    def _addon(self, name, addon_id):
+        for addon in self._app(name)['addons']:
+            if addon_id in (addon['id'], addon['name']):
+                return addon
+
+        raise APIError(404, "Couldn't find that add-on.")
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, so tests can count the connections a client opens
+    protocol_version = 'HTTP/1.1'
+    api = None
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.api.connections += 1
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        try:
+            status, data = 200, self.api.handle(self.command, self.path, body,
+                self.headers.get('Authorization'))
+        except APIError as e:
+            status, data = e.status, {'id': 'error', 'message': str(e)}
+
+        payload = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = respond
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,207 @@
+"""
+In-process stand-in for the parts of boto's S3 api that blt uses.
+
+The fake keeps objects in memory and counts every request by type, along with
+the bytes sent to and received from the "bucket". Latency and bandwidth can be
+simulated so the numbers from the benchmark harness (see ``bench_aws``) look
+like a run against the real service, without needing credentials or a
+network.
+
+Example:
+
+    bucket = FakeBucket('assets', latency=0.02, bandwidth=5 * 2**20)
+    cmds = aws.AmazonCommands(config)
+    cmds._get_s3_bucket = lambda: bucket
+    cmds.sync_s3()
+    print bucket.stats.requests
+"""
+import base64
+from collections import defaultdict
+import hashlib
+import threading
+import time
+
+# S3 returns at most this many keys per LIST request
+PAGE_SIZE = 1000
+
+# downloads are handed to the caller's file object in chunks of this size
+CHUNK_SIZE = 2**16
+
+
+class BadDigest(Exception):
+    """Raised when an upload doesn't match the Content-MD5 it was sent with."""
+
+
+class FakeS3Stats(object):
+    """Request counters and byte totals for a ``FakeBucket``."""
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def record(self, method, sent=0, received=0):
+        """
+        Records a request.
+
+        Args:
+            method: the HTTP method of the request (GET, PUT, HEAD, LIST)
+            sent: bytes sent from the client to S3
+            received: bytes received by the client from S3
+        """
+        with self._lock:
+            self.requests[method] += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+
+class ResultSet(list):
+    """A page of a listing, like boto's."""
+    is_truncated = False
+
+
+class FakeBucket(object):
+    """
+    An in-memory S3 bucket.
+
+    Args:
+        name: the bucket name
+        latency: seconds of simulated round trip time per request
+        bandwidth: simulated transfer rate in bytes per second, None for
+            unlimited
+    """
+    def __init__(self, name='blt-fake', latency=0.0, bandwidth=None):
+        self.name = name
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = FakeS3Stats()
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def list(self, prefix=''):
+        names = sorted(n for n in self.objects if n.startswith(prefix))
+
+        # like the real thing, listings come back a page at a time
+        for start in range(0, max(len(names), 1), PAGE_SIZE):
+            page = names[start:start + PAGE_SIZE]
+            self._request('LIST')
+
+            for name in page:
+                stored = self.objects.get(name)
+                if stored is not None:
+                    yield FakeKey(self, name, stored, with_metadata=False)
+
+    def get_all_keys(self, prefix='', marker='', max_keys=PAGE_SIZE):
+        """A single page of the listing, the keys after ``marker``."""
+        self._request('LIST')
+        names = sorted(n for n in self.objects
+                       if n.startswith(prefix) and n > marker)
+
+        page = ResultSet(FakeKey(self, name, self.objects[name],
+                                 with_metadata=False)
+                         for name in names[:max_keys])
+        page.is_truncated = len(names) > max_keys
+        return page
+
+    def get_key(self, name):
+        self._request('HEAD')
+        stored = self.objects.get(name)
+        if stored is None:
+            return None
+
+        return FakeKey(self, name, stored)
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def _request(self, method, sent=0, received=0):
+        delay = self.latency
+        if self.bandwidth:
+            delay += float(sent + received) / self.bandwidth
+
+        if delay:
+            time.sleep(delay)
+
+        self.stats.record(method, sent, received)
+
+    def _store(self, name, data, headers, metadata, md5=None):
+        self._request('PUT', sent=len(data))
+        digest = hashlib.md5(data)
+        headers = dict(headers or {})
+
+        # boto sends the md5 argument as the Content-MD5 header, and S3
+        # rejects the upload if the body doesn't match it
+        if md5 is not None:
+            headers['Content-MD5'] = md5[1]
+            if base64.b64encode(digest.digest()) != md5[1]:
+                raise BadDigest('Content-MD5 mismatch for %s' % name)
+
+        stored = {
+            'data': data,
+            'etag': '"%s"' % digest.hexdigest(),
+            'headers': headers,
+            'metadata': dict(metadata),
+        }
+
+        with self._lock:
+            self.objects[name] = stored
+
+        return stored
+
+
+class FakeKey(object):
+    """
+    An S3 key living in a ``FakeBucket``.
+
+    Keys that come out of a listing don't carry metadata, just like boto's.
+    """
+    def __init__(self, bucket, name, stored=None, with_metadata=True):
+        self.bucket = bucket
+        self.key = self.name = name
+        self.metadata = {}
+        self.etag = None
+        self.size = None
+
+        if stored is not None:
+            self.etag = stored['etag']
+            self.size = len(stored['data'])
+            if with_metadata:
+                self.metadata = dict(stored['metadata'])
+
+    def __repr__(self):
+        return '<Key: %s,%s>' % (self.bucket.name, self.key)
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_string(self, data, headers=None, md5=None, **kwargs):
+        stored = self.bucket._store(self.key, data, headers, self.metadata, md5)
+        self.etag = stored['etag']
+        self.size = len(data)
+
+    def set_contents_from_file(self, fp, headers=None, **kwargs):
+        self.set_contents_from_string(fp.read(), headers, **kwargs)
+
+    def get_contents_as_string(self, **kwargs):
+        stored = self.bucket.objects[self.key]
+        self.bucket._request('GET', received=len(stored['data']))
+        self.metadata = dict(stored['metadata'])
+        return stored['data']
+
+    def get_contents_to_file(self, fp, **kwargs):
+        data = self.get_contents_as_string()
+        for start in range(0, len(data), CHUNK_SIZE):
+            fp.write(data[start:start + CHUNK_SIZE])
@@ -1,6 +1,12 @@
+import gzip
+import json
+import os
 import pytest
-from mock import patch, call, Mock, MagicMock
+from mock import patch, call, Mock, MagicMock, ANY
+from StringIO import StringIO
 
+from blt.test import bench_aws
+from blt.test.fakes3 import FakeBucket, FakeKey, ResultSet
 from blt.tools import aws
 
 @pytest.fixture
@@ -49,30 +55,368 @@ def test_sync_s3(cmds):
     cmds._get_s3_bucket = Mock()
     bucket = Mock()
     cmds._get_s3_bucket.return_value = bucket
+    cmds._get_hash_cache = Mock()
 
-    # these need to be switched to patches...they affect *all* test methods
-    aws.get_hashes_from_dirtree = Mock(return_value=source_hashes())
-    aws.get_hashes_from_s3bucket = Mock(return_value=target_hashes())
-    aws.upload_file = Mock()
+    with patch.object(aws, 'get_hashes_from_dirtree', Mock(return_value=source_hashes())), \
+         patch.object(aws, 'get_hashes_from_s3bucket', Mock(return_value=target_hashes())), \
+         patch.object(aws, 'upload_file') as upload_file:
+        cmds.sync_s3()
 
-    cmds.sync_s3()
     calls = [
         call('/Users/coldwd/data/pubweb/static_assets/'
             , 'images/dne.jpg'
             , bucket
-            , 'dencold/'),
+            , 'dencold/'
+            , ANY
+            , cmds._get_hash_cache.return_value
+            , ANY),
         call('/Users/coldwd/data/pubweb/static_assets/'
             , 'images/diff_hash.jpg'
             , bucket
-            , 'dencold/')
+            , 'dencold/'
+            , ANY
+            , cmds._get_hash_cache.return_value
+            , ANY)
     ]
 
-    assert len(aws.upload_file.mock_calls) == 2
-    aws.upload_file.assert_has_calls(calls)
+    # uploads run on a worker pool, so there is no guaranteed ordering
+    assert len(upload_file.mock_calls) == 2
+    upload_file.assert_has_calls(calls, any_order=True)
+    cmds._get_hash_cache.return_value.save.assert_called_once_with()
 
 def test_get_changed_files(source_hashes, target_hashes):
     changed_files = aws.get_changed_files(source_hashes, target_hashes)
 
     assert sorted(changed_files) == [ 'images/diff_hash.jpg', 'images/dne.jpg']
 
+def test_compression_policy_from_config():
+    policy = aws.CompressionPolicy.from_config({
+        'COMPRESS_TYPES': ['application/json'],
+        'COMPRESS_MIN_SIZE': '1024',
+        'GZIP_LEVEL': 6,
+        'UPLOAD_WORKERS': 8
+    })
+
+    assert policy.types == ['application/json']
+    assert policy.gzip_level == 6
+    assert policy.workers == 8
+    assert policy.should_compress('application/json', 2048)
+    assert not policy.should_compress('application/json', 512)
+    assert not policy.should_compress('text/css', 2048)
+
+def test_compression_policy_defaults():
+    policy = aws.CompressionPolicy.from_config({})
+
+    assert policy.types == aws.COMPRESSIBLE
+    assert policy.gzip_level == 9
+    assert not policy.brotli
+    assert policy.should_compress('image/svg+xml', 0)
+
+def uploaded_contents(key):
+    """records the body and headers of every upload to a mocked key"""
+    uploads = []
+    key.set_contents_from_file.side_effect = \
+        lambda fp, headers, **kw: uploads.append((fp.read(), headers))
+    return uploads
+
+def test_upload_file_gzip_level(tmpdir):
+    tmpdir.join('app.json').write('{"a": 1}' * 100)
+    bucket = Mock()
+    key = bucket.new_key.return_value
+    uploads = uploaded_contents(key)
+    policy = aws.CompressionPolicy(gzip_level=1)
+
+    aws.upload_file(str(tmpdir), 'app.json', bucket, 'dencold/', policy)
+
+    bucket.new_key.assert_called_once_with('dencold/app.json')
+    body, headers = uploads[0]
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.GzipFile(fileobj=StringIO(body)).read() == '{"a": 1}' * 100
+    key.set_metadata.assert_any_call('gzipped', 'true')
+
+def test_upload_file_below_min_size(tmpdir):
+    tmpdir.join('tiny.css').write('a{}')
+    bucket = Mock()
+    key = bucket.new_key.return_value
+
+    uploads = uploaded_contents(key)
+
+    aws.upload_file(str(tmpdir), 'tiny.css', bucket, '',
+        aws.CompressionPolicy(min_size=1024))
+
+    assert uploads == [('a{}', {'Content-Type': 'text/css',
+                                'x-amz-acl': 'public-read'})]
+
+def test_upload_file_brotli_variant(tmpdir):
+    brotli = pytest.importorskip('brotli')
+    tmpdir.join('site.css').write('body { color: red; }' * 100)
+    bucket = Mock()
+    keys = {}
+    bucket.new_key.side_effect = lambda name: keys.setdefault(name, Mock())
+
+    aws.upload_file(str(tmpdir), 'site.css', bucket, '',
+        aws.CompressionPolicy(brotli=True))
+
+    assert sorted(keys) == ['site.css', 'site.css.br']
+    body, headers = keys['site.css.br'].set_contents_from_string.call_args[0]
+    assert headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(body) == 'body { color: red; }' * 100
+
+def test_get_hashes_from_s3bucket_skips_brotli_variants():
+    plain = Mock(key='img/logo.png', etag='"abc"')
+    variant = Mock(key='img/logo.png.br', etag='"def"')
+    archive = Mock(key='archive.br', etag='"123"')
+    bucket = Mock()
+    bucket.get_all_keys.return_value = ResultSet([plain, variant, archive])
+
+    hashes = aws.get_hashes_from_s3bucket(bucket)
+
+    assert sorted(hashes) == ['archive.br', 'img/logo.png']
+
+def test_get_hashes_from_s3bucket_counts_list_pages(monkeypatch):
+    monkeypatch.setattr(aws, 'LIST_PAGE_SIZE', 2)
+    bucket = FakeBucket()
+    for name in 'abcde':
+        bucket.new_key(name).set_contents_from_string(name)
+    stats = aws.TransferStats()
+
+    hashes = aws.get_hashes_from_s3bucket(bucket, stats=stats)
+
+    assert sorted(hashes) == list('abcde')
+    assert stats.requests['LIST'] == bucket.stats.requests['LIST'] == 3
+
+def test_upload_file_skips_gzip_without_savings(tmpdir):
+    dense = os.urandom(4096)
+    tmpdir.join('noise.txt').write(dense, mode='wb')
+    bucket = Mock()
+    key = bucket.new_key.return_value
+    uploads = uploaded_contents(key)
+    hash_cache = aws.HashCache()
+    stats = aws.TransferStats()
+
+    with patch.object(aws, 'compute_md5') as compute_md5:
+        aws.upload_file(str(tmpdir), 'noise.txt', bucket, '',
+            aws.CompressionPolicy(min_savings=0.1), hash_cache, stats)
+
+    # the md5 came from the compression attempt, each byte was read once
+    assert not compute_md5.called
+    assert stats.as_dict()['bytes'] == {'read': 4096, 'sent': 4096}
+
+    body, headers = uploads[0]
+    assert body == dense
+    assert 'Content-Encoding' not in headers
+    key.set_metadata.assert_called_once_with('gzipped', 'false')
+    md5 = aws.compute_md5(str(tmpdir.join('noise.txt')))
+    assert hash_cache.lookup(md5) == {'md5': md5, 'encoding': 'identity'}
+
+def test_gzip_file_bails_out_early(tmpdir):
+    tmpdir.join('noise.txt').write(os.urandom(4096), mode='wb')
+
+    result = aws.gzip_file(str(tmpdir.join('noise.txt')),
+        min_savings=0.1, block_size=1024)
+
+    # the source is still hashed, so an uncompressed upload needn't re-read it
+    assert (result.fileobj, result.md5) == (None, None)
+    assert result.source_size == 4096
+    assert result.source_md5 == aws.compute_md5(str(tmpdir.join('noise.txt')))
+
+def test_gzip_file_measures_savings(tmpdir):
+    tmpdir.join('data.csv').write('a,b,c\n' * 1000)
+
+    result = aws.gzip_file(str(tmpdir.join('data.csv')), min_savings=0.5)
+
+    assert result.source_size == 6000
+    assert aws.savings(result.source_size, result.size) > 0.5
+    assert result.source_md5 == aws.compute_md5(str(tmpdir.join('data.csv')))
+    assert gzip.GzipFile(fileobj=result.fileobj, mode='rb').read() == 'a,b,c\n' * 1000
+
+def test_get_hashes_from_s3bucket_uses_hash_cache():
+    key = Mock(key='css/site.css', etag='"9e107d9d372bb6826bd81d3542a419d6"')
+    bucket = Mock()
+    bucket.get_all_keys.return_value = ResultSet([key])
+    hash_cache = aws.HashCache()
+    hash_cache.record(key.etag, 'e4d909c290d0fb1ca068ffaddf22cbd0', 'gzip')
+
+    hashes = aws.get_hashes_from_s3bucket(bucket, hash_cache=hash_cache)
+
+    assert not bucket.get_key.called
+    assert hashes['css/site.css']['hash'] == 'e4d909c290d0fb1ca068ffaddf22cbd0'
+    assert hashes['css/site.css']['is_compressed']
+
+def test_get_hashes_from_s3bucket_records_metadata():
+    key = Mock(key='css/site.css', etag='"9e107d9d372bb6826bd81d3542a419d6"')
+    bucket = Mock()
+    bucket.get_all_keys.return_value = ResultSet([key])
+    bucket.get_key.return_value.get_metadata.return_value = 'false'
+    hash_cache = aws.HashCache()
+
+    hashes = aws.get_hashes_from_s3bucket(bucket, hash_cache=hash_cache)
+
+    bucket.get_key.assert_called_once_with('css/site.css')
+    assert not hashes['css/site.css']['is_compressed']
+    assert hash_cache.lookup(key.etag) == {
+        'md5': '9e107d9d372bb6826bd81d3542a419d6', 'encoding': 'identity'}
+
+def test_hash_cache_persists(tmpdir):
+    path = str(tmpdir.join('bucket.json'))
+    hash_cache = aws.HashCache(path)
+    hash_cache.record('"abc"', 'def', 'gzip')
+    hash_cache.save()
+
+    assert aws.HashCache(path).lookup('abc') == {'md5': 'def',
+                                                 'encoding': 'gzip'}
+
+def test_sync_and_pull_round_trip(tmpdir, monkeypatch):
+    monkeypatch.setenv('BLT_CACHE_DIR', str(tmpdir.join('cache')))
+    source = tmpdir.mkdir('source')
+    source.join('css', 'site.css').write('body { color: red; }\n' * 50,
+                                         ensure=True)
+    source.join('img', 'logo.png').write(os.urandom(512), mode='wb',
+                                         ensure=True)
+    bucket = FakeBucket()
+    cmds = aws.AmazonCommands({'aws': {'SOURCE_FOLDER': str(source)}})
+    cmds._get_s3_bucket = Mock(return_value=bucket)
+
+    cmds.sync_s3()
+    assert bucket.stats.requests == {'LIST': 1, 'PUT': 2}
+    assert bucket.objects['css/site.css']['metadata']['gzipped'] == 'true'
+
+    # a second sync finds nothing to do, and needs no metadata requests
+    bucket.stats.reset()
+    cmds.sync_s3()
+    assert bucket.stats.requests == {'LIST': 1}
+
+    target = tmpdir.mkdir('target')
+    cmds.pull_s3(str(target))
+    assert target.join('css', 'site.css').read() == \
+        source.join('css', 'site.css').read()
+    assert target.join('img', 'logo.png').read(mode='rb') == \
+        source.join('img', 'logo.png').read(mode='rb')
+
+def test_benchmark_smoke():
+    results = bench_aws.run(small=20, huge=1, huge_size=2**16)
+
+    assert [r['phase'] for r in results] == ['sync_s3 (cold)',
+                                             'sync_s3 (no changes)',
+                                             'list_changes',
+                                             'pull_s3 (empty target)']
+    assert results[0]['requests']['PUT'] == 21
+    assert results[1]['requests'] == {'LIST': 1}
+    assert results[3]['requests']['GET'] == 21
+
+def test_transfer_stats_exclusive_phases():
+    stats = aws.TransferStats()
+
+    with stats.phase('walk'):
+        with stats.phase('hash'):
+            pass
+
+    assert sorted(stats.phases) == ['hash', 'walk']
+    assert stats.phases['walk'] >= 0
+
+def test_transfer_stats_as_dict():
+    stats = aws.TransferStats()
+    stats.request('PUT', 2)
+    stats.add_bytes('sent', 100)
+    stats.cache_lookup('etag', True)
+    stats.cache_lookup('etag', True)
+    stats.cache_lookup('etag', False)
+    stats.cache_lookup('cold', False)
+
+    result = stats.as_dict()
+
+    assert result['requests'] == {'PUT': 2}
+    assert result['bytes'] == {'sent': 100}
+    assert result['caches']['etag'] == {'hits': 2, 'misses': 1,
+                                        'hit_rate': 2 / 3.0}
+    assert result['caches']['cold']['hit_rate'] == 0.0
+    assert 'etag cache   2 hits, 1 misses (67%)' in stats.summary()
+
+def test_sync_s3_stats_and_metrics(tmpdir, monkeypatch):
+    monkeypatch.setenv('BLT_CACHE_DIR', str(tmpdir.join('cache')))
+    source = tmpdir.mkdir('source')
+    source.join('app.js').write('var blt = true;\n' * 100)
+    metrics = tmpdir.join('metrics.json')
+    bucket = FakeBucket()
+    cmds = aws.AmazonCommands({'aws': {'SOURCE_FOLDER': str(source)},
+                               'blt_envtype': 'staging'},
+                              {'stats': True, 'metrics': str(metrics)})
+    cmds._get_s3_bucket = Mock(return_value=bucket)
+
+    cmds.sync_s3()
+
+    record = json.loads(metrics.read())
+    assert record['command'] == 'aws.sync_s3'
+    assert record['environment'] == 'staging'
+    assert record['requests'] == bucket.stats.requests
+    assert record['bytes']['sent'] == bucket.stats.bytes_sent
+    assert record['bytes']['read'] == 1600 * 2
+    assert set(record['phases']) == set(['walk', 'hash', 'list',
+                                         'compress', 'upload'])
+
+def test_upload_file_sends_content_md5(tmpdir):
+    tmpdir.join('site.css').write('body { color: red; }\n' * 50)
+    tmpdir.join('logo.png').write(os.urandom(256), mode='wb')
+    bucket = FakeBucket()
+
+    aws.upload_file(str(tmpdir), 'site.css', bucket)
+    aws.upload_file(str(tmpdir), 'logo.png', bucket)
+
+    for name in ['site.css', 'logo.png']:
+        stored = bucket.objects[name]
+        assert stored['headers']['Content-MD5'] == \
+            aws.md5_header(stored['etag'].strip('"'))[1]
+
+def test_download_file_verifies_and_records_hash(tmpdir):
+    bucket = FakeBucket()
+    source = tmpdir.mkdir('source')
+    source.join('data.csv').write('a,b,c\n' * 500)
+    aws.upload_file(str(source), 'data.csv', bucket)
+    key = list(bucket.list())[0]
+    md5 = aws.compute_md5(str(source.join('data.csv')))
+    hash_cache = aws.HashCache()
+
+    aws.download_file(str(tmpdir), 'data.csv', key, True, md5, hash_cache)
+
+    assert tmpdir.join('data.csv').read() == 'a,b,c\n' * 500
+    assert hash_cache.lookup_file(str(tmpdir.join('data.csv'))) == md5
+
+def test_download_file_rejects_corrupt_data(tmpdir):
+    bucket = FakeBucket()
+    tmpdir.join('app.js').write('var blt = true;\n' * 100)
+    aws.upload_file(str(tmpdir), 'app.js', bucket)
+    key = list(bucket.list())[0]
+    bucket.objects['app.js']['data'] = 'garbage'
+
+    target = tmpdir.mkdir('target')
+    with pytest.raises(IOError):
+        aws.download_file(str(target), 'app.js', key, True)
+
+    assert target.listdir() == []
+
+def test_get_hashes_from_dirtree_uses_file_cache(tmpdir):
+    tmpdir.join('a.txt').write('aaa')
+    tmpdir.join('b.txt').write('bbb')
+    hash_cache = aws.HashCache()
+    aws.get_hashes_from_dirtree(str(tmpdir), hash_cache=hash_cache)
+
+    tmpdir.join('b.txt').write('bbbb')
+    stats = aws.TransferStats()
+    with patch.object(aws, 'compute_md5', wraps=aws.compute_md5) as md5:
+        hashes = aws.get_hashes_from_dirtree(str(tmpdir), stats, hash_cache)
+
+    md5.assert_called_once_with(str(tmpdir.join('b.txt')))
+    assert hashes['b.txt']['hash'] == aws.compute_md5(str(tmpdir.join('b.txt')))
+    assert stats.caches['file'] == {'hits': 1, 'misses': 1}
+
+def test_bucket_and_hash_cache_shared_by_session(cmds, tmpdir, monkeypatch):
+    monkeypatch.setenv('BLT_CACHE_DIR', str(tmpdir))
+    session = {}
+    first = aws.AmazonCommands(dict(cmds.cfg, blt_session=session))
+    second = aws.AmazonCommands(dict(cmds.cfg, blt_session=session))
+
+    bucket = first._get_s3_bucket()
+    assert second._get_s3_bucket() is bucket
+    assert aws.boto.connect_s3.call_count == 1
 
+    assert second._get_hash_cache(bucket) is first._get_hash_cache(bucket)
@@ -39,20 +39,20 @@ def test_dump(cmds):
     bundle.cd.assert_called_once_with('djangoproj')
     bundle.makedirs.assert_called_once_with('/tmp/bundles/scotch-scotch-scotch/db')
     assert os.environ.get('DATABASE_URL') == 'sqlite://///Users/laphroaig/.virtualenvs/payinstr/db.sqlite3'
-    bundle.local.assert_called_once_with('python manage.py bundle dump scotch-scotch-scotch /tmp/bundles/scotch-scotch-scotch/db/fixture.xml')
+    bundle.local.assert_called_once_with(['python', 'manage.py', 'bundle', 'dump', 'scotch-scotch-scotch', '/tmp/bundles/scotch-scotch-scotch/db/fixture.xml'])
 
 def test_load(cmds):
     cmds.load('scotch-scotch-scotch', 'STAGING')
 
     bundle.cd.assert_called_once_with('djangoproj')
     assert os.environ.get('DATABASE_URL') == 'sqlite://///Users/lagavulin/.virtualenvs/payinstr/db.sqlite3'
-    bundle.local.assert_called_once_with('python manage.py bundle load /tmp/bundles/scotch-scotch-scotch/db/fixture.xml')
+    bundle.local.assert_called_once_with(['python', 'manage.py', 'bundle', 'load', '/tmp/bundles/scotch-scotch-scotch/db/fixture.xml'])
 
 def test_delete(cmds):
     cmds.delete('scotch-scotch-scotch', 'STAGING')
 
     bundle.cd.assert_called_once_with('djangoproj')
     assert os.environ.get('DATABASE_URL') == 'sqlite://///Users/lagavulin/.virtualenvs/payinstr/db.sqlite3'
-    bundle.local.assert_called_once_with('python manage.py bundle delete scotch-scotch-scotch')
+    bundle.local.assert_called_once_with(['python', 'manage.py', 'bundle', 'delete', 'scotch-scotch-scotch'])
 
 
@@ -0,0 +1,127 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from blt import completion
+from blt.index import usage_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+# runs the blt-complete script the shell calls and reports the imported
+# modules on exit (the script itself exits through sys.exit)
+SCRIPT = '''
+import atexit, sys
+atexit.register(lambda: sys.stderr.write(" ".join(sys.modules)))
+sys.argv = ["blt-complete"] + sys.argv[1:]
+execfile(%r)
+''' % os.path.abspath(os.path.join(ROOT, 'bin', 'blt-complete'))
+
+BLTENV = '''
+from blt.tools import heroku
+
+CONFIG = {
+    "staging": {},
+    "production": {},
+}
+'''
+
+# -- Set Fixtures -------------------------------------------------------------
+@pytest.fixture
+def index():
+    return {
+        'environments': ['local', 'production', 'staging'],
+        'commands': {
+            'heroku.config': {
+                'options': [],
+                'arguments': [['set', 'get', 'unset'], []],
+            },
+            'heroku.push': {'options': [], 'arguments': [[]]},
+            'aws.sync_s3': {'options': ['metrics', 'stats'], 'arguments': []},
+            'standard_command': {'options': [], 'arguments': []},
+        },
+    }
+
+@pytest.fixture
+def project(tmpdir):
+    tmpdir.join('bltenv.py').write(BLTENV)
+    return tmpdir
+
+def run_completion(project, *argv):
+    """Runs completion in a fresh interpreter, the way the shell does."""
+    env = dict(os.environ,
+               PYTHONPATH=ROOT,
+               BLT_CACHE_DIR=str(project.join('cache')))
+    proc = subprocess.Popen([sys.executable, '-c', SCRIPT] + list(argv),
+                            cwd=str(project), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+
+    assert proc.returncode == 0, err
+    return out.split(), err.split()
+
+# -- Test Cases! --------------------------------------------------------------
+def test_complete_commands(index):
+    assert completion.complete(['heroku.'], index) == ['heroku.config',
+                                                       'heroku.push']
+    assert 'help' in completion.complete([''], index)
+
+def test_complete_environments(index):
+    assert completion.complete(['e:'], index) == ['e:all', 'e:local',
+                                                  'e:production', 'e:staging']
+    assert completion.complete(['e:st'], index) == ['e:staging']
+    assert completion.complete(['e:staging,p'], index) == [
+        'e:staging,production']
+
+def test_complete_skips_environment_word(index):
+    assert completion.complete(['e:staging', 'heroku.c'], index) == [
+        'heroku.config']
+
+def test_complete_argument_choices(index):
+    assert completion.complete(['heroku.config', ''], index) == ['get', 'set',
+                                                                 'unset']
+    assert completion.complete(['heroku.config', 'set', ''], index) == []
+    assert completion.complete(['heroku.push', ''], index) == []
+
+def test_complete_options(index):
+    assert completion.complete(['aws.sync_s3', '--'], index) == ['--metrics',
+                                                                 '--stats']
+
+def test_complete_help_and_list(index):
+    assert completion.complete(['help', 'aws'], index) == ['aws.sync_s3']
+    assert completion.complete(['list', ''], index) == ['aws', 'heroku']
+
+def test_split_line():
+    assert completion.split_line('blt e:sta') == ['e:sta']
+    assert completion.split_line('blt heroku.config ') == ['heroku.config', '']
+
+def test_usage_arguments():
+    doc = '''
+        Usage:
+            blt e:[env] heroku.config [set|get|unset] ["Key=Value"] [--stats]
+        '''
+    assert usage_arguments(doc, 'config') == [['set', 'get', 'unset'], []]
+    assert usage_arguments(doc, 'push') == []
+    assert usage_arguments(None, 'config') == []
+
+def test_completion_end_to_end(project):
+    completions, _ = run_completion(project, '--line', 'blt e:staging heroku.config ')
+    assert completions == ['get', 'set', 'unset']
+
+    completions, _ = run_completion(project, 'e:p')
+    assert completions == ['e:production']
+
+def test_completion_imports_nothing_heavy(project):
+    # completion runs on every TAB press, so rather than timing it (which is
+    # flaky on a loaded machine) check it never gets to import the bltenv or
+    # the tools. the first run builds the index, the second must answer from
+    # it
+    run_completion(project, '')
+    words, modules = run_completion(project, 'heroku.')
+    assert 'heroku.push' in words
+
+    heavy = [name for name in modules
+             if name.split('.')[0] in ('clint', 'boto', 'bltenv')
+             or name.startswith(('blt.tools', 'blt.environment'))]
+    assert heavy == []
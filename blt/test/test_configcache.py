@@ -0,0 +1,144 @@
+import os
+import sys
+
+import pytest
+
+from blt import configcache
+
+
+# -- Set Fixtures -------------------------------------------------------------
+@pytest.fixture
+def env_file(tmpdir, monkeypatch):
+    monkeypatch.setenv('BLT_CACHE_DIR', str(tmpdir.join('cache')))
+    path = tmpdir.join('bltenv.py')
+    path.write('CONFIG = {}\n')
+    return str(path)
+
+# -- Test Cases! --------------------------------------------------------------
+def test_recording_environ_records_reads(monkeypatch):
+    monkeypatch.setenv('BLT_TEST_SET', 'yes')
+    monkeypatch.delenv('BLT_TEST_UNSET', raising=False)
+
+    with configcache.recording_import() as record:
+        os.environ.get('BLT_TEST_SET')
+        os.getenv('BLT_TEST_UNSET')
+
+    assert record.environ.dependencies() == {'BLT_TEST_SET': 'yes',
+                                             'BLT_TEST_UNSET': None}
+    assert not record.environ.read_all
+    assert not isinstance(os.environ, configcache.RecordingEnviron)
+
+def test_recording_environ_writes_through(monkeypatch):
+    monkeypatch.delenv('BLT_TEST_WRITE', raising=False)
+
+    with configcache.recording_import() as record:
+        os.environ['BLT_TEST_WRITE'] = 'written'
+        os.environ.get('BLT_TEST_WRITE')
+
+    assert os.environ['BLT_TEST_WRITE'] == 'written'
+    assert record.environ.written == {'BLT_TEST_WRITE': 'written'}
+    assert record.environ.dependencies() == {}
+    del os.environ['BLT_TEST_WRITE']
+
+def test_recording_environ_iteration_reads_all():
+    with configcache.recording_import() as record:
+        dict(os.environ.items())
+
+    assert record.environ.read_all
+    assert record.environ.dependencies() == dict(os.environ)
+
+def test_recording_environ_copies():
+    with configcache.recording_import() as record:
+        copied = os.environ.copy()
+
+    assert copied == dict(os.environ)
+    assert record.environ.read_all
+
+def test_recording_import_records_files(tmpdir):
+    secrets = tmpdir.join('secrets.json')
+    secrets.write('{}')
+
+    with configcache.recording_import() as record:
+        open(str(secrets)).read()
+        open(str(tmpdir.join('out.txt')), 'w').close()
+        # already imported, still a dependency
+        import blt.index
+
+    assert str(secrets) in record.files
+    assert str(tmpdir.join('out.txt')) not in record.files
+    assert blt.index.__file__.rstrip('c') in record.files
+
+def test_config_round_trip(env_file, monkeypatch):
+    monkeypatch.setenv('BLT_TEST_APP', 'app')
+    with configcache.recording_import() as record:
+        os.environ.get('BLT_TEST_APP')
+
+    config = {'staging': {'app': 'app', 'steps': ('a', 'b')}}
+    assert configcache.save_config(env_file, config, record)
+    assert configcache.load_config(env_file) == config
+
+    monkeypatch.setenv('BLT_TEST_APP', 'other')
+    assert configcache.load_config(env_file) is None
+
+def test_config_goes_stale_with_opened_file(env_file, tmpdir):
+    secrets = tmpdir.join('secrets.json')
+    secrets.write('{"key": "one"}')
+
+    with configcache.recording_import() as record:
+        open(str(secrets)).read()
+
+    configcache.save_config(env_file, {'staging': {}}, record)
+    assert configcache.load_config(env_file) == {'staging': {}}
+
+    secrets.write('{"key": "other"}')
+    assert configcache.load_config(env_file) is None
+
+def test_config_replays_side_effects(env_file, tmpdir, monkeypatch):
+    monkeypatch.delenv('BLT_TEST_SETTINGS', raising=False)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    lib = str(tmpdir.join('lib'))
+
+    with configcache.recording_import() as record:
+        os.environ['BLT_TEST_SETTINGS'] = 'settings'
+        sys.path.insert(0, lib)
+
+    configcache.save_config(env_file, {'staging': {}}, record)
+    del os.environ['BLT_TEST_SETTINGS']
+    sys.path.remove(lib)
+
+    assert configcache.load_config(env_file) == {'staging': {}}
+    assert os.environ['BLT_TEST_SETTINGS'] == 'settings'
+    assert sys.path[0] == lib
+
+def test_config_cache_can_be_turned_off(env_file, monkeypatch):
+    with configcache.recording_import() as record:
+        pass
+
+    configcache.save_config(env_file, {'staging': {}}, record)
+    monkeypatch.setenv('BLT_CONFIG_CACHE', '0')
+    assert configcache.load_config(env_file) is None
+
+def test_config_goes_stale_with_env_file(env_file):
+    with configcache.recording_import() as record:
+        pass
+
+    configcache.save_config(env_file, {'staging': {}}, record)
+
+    stat = os.stat(env_file)
+    os.utime(env_file, (stat.st_atime, stat.st_mtime + 10))
+    assert configcache.load_config(env_file) is None
+
+def test_unmarshallable_config_is_not_cached(env_file):
+    with configcache.recording_import() as record:
+        pass
+
+    configcache.save_config(env_file, {'staging': {}}, record)
+    assert not configcache.save_config(env_file, {'staging': object()},
+                                       record)
+    assert configcache.load_config(env_file) is None
+
+def test_corrupt_config_cache(env_file):
+    with open(configcache.config_path(env_file), 'wb') as f:
+        f.write('not marshal')
+
+    assert configcache.load_config(env_file) is None
@@ -0,0 +1,143 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+from blt import daemon
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+BLTENV = '''
+import os
+from blt.environment import Commander
+
+class DaemonCommands(Commander):
+    def where(self, *args):
+        from blt import daemon
+        print 'daemon=%s app=%s cwd=%s args=%s' % (daemon.IN_DAEMON,
+            self.cfg['app'], os.getcwd(), ','.join(args))
+
+    def echo(self):
+        import sys
+        sys.stdout.write(sys.stdin.read().upper())
+
+    def fail(self):
+        from blt.helpers import abort
+        abort('failing on purpose')
+
+CONFIG = {
+    "staging": {"app": os.environ.get("BLT_TEST_APP", "{app}")},
+}
+'''
+
+# -- Set Fixtures -------------------------------------------------------------
+@pytest.fixture
+def project(request):
+    # unix socket paths are short, so keep the cache out of pytest's tmpdir
+    root = tempfile.mkdtemp(prefix='bltd-')
+    request.addfinalizer(lambda: shutil.rmtree(root, ignore_errors=True))
+
+    project = os.path.join(root, 'project')
+    os.mkdir(project)
+    write_bltenv(project, 'warm')
+    return project
+
+@pytest.fixture
+def environ(project, monkeypatch):
+    monkeypatch.setenv('BLT_CACHE_DIR', os.path.join(project, '..', 'cache'))
+    monkeypatch.setenv('PYTHONPATH', ROOT)
+    monkeypatch.delenv('BLT_TEST_APP', raising=False)
+    monkeypatch.delenv('BLT_NO_DAEMON', raising=False)
+    return dict(os.environ)
+
+@pytest.fixture
+def server(project, environ, request):
+    proc = subprocess.Popen([sys.executable, '-c',
+        'from blt.daemon import Server; Server("bltenv.py").serve()'],
+        cwd=project, env=environ)
+    request.addfinalizer(lambda: proc.poll() is None and proc.terminate())
+
+    env_file = os.path.join(project, 'bltenv.py')
+    deadline = time.time() + 10
+    while daemon.connect(env_file) is None:
+        assert time.time() < deadline and proc.poll() is None
+        time.sleep(0.05)
+
+    return proc
+
+def write_bltenv(project, app):
+    path = os.path.join(project, 'bltenv.py')
+    with open(path, 'w') as f:
+        f.write(BLTENV.replace("{app}", app))
+
+    # make sure a rewrite within the same second still looks different
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + len(app)))
+
+def run_blt(project, environ, *argv, **kwargs):
+    proc = subprocess.Popen([sys.executable, '-c',
+        'from blt.launcher import main; main()'] + list(argv),
+        cwd=project, env=dict(environ, **kwargs.get('env', {})),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(kwargs.get('input', ''))
+    return proc.returncode, out, err
+
+# -- Test Cases! --------------------------------------------------------------
+def test_channel_round_trip():
+    left, right = socket.socketpair()
+    message = {'argv': ['e:staging', '\xff\xfe'], 'environ': {'A': 'caf\xe9'}}
+
+    daemon.Channel(left).send(message)
+    assert daemon.Channel(right).receive() == message
+
+    left.close()
+    assert daemon.Channel(right).receive() is None
+
+def test_forward_without_server(project, environ):
+    assert daemon.forward(['list'], os.path.join(project, 'bltenv.py')) is None
+
+def test_daemon_runs_command(project, environ, server):
+    code, out, err = run_blt(project, environ, 'e:staging', 'where', 'a', 'b')
+
+    assert code == 0, err
+    assert 'daemon=True app=warm cwd=%s args=a,b' % os.path.realpath(project) in out
+
+def test_daemon_relays_stdin_and_exit_status(project, environ, server):
+    code, out, _ = run_blt(project, environ, 'e:staging', 'echo', input='hello\n')
+    assert (code, out.splitlines()[-1]) == (0, 'HELLO')
+
+    code, out, _ = run_blt(project, environ, 'e:staging', 'fail')
+    assert code == 1
+    assert 'failing on purpose' in out
+
+def test_daemon_uses_client_environment(project, environ, server):
+    code, out, _ = run_blt(project, environ, 'e:staging', 'where',
+                           env={'BLT_TEST_APP': 'from-client'})
+
+    assert 'app=from-client' in out
+
+def test_daemon_reloads_changed_bltenv(project, environ, server):
+    write_bltenv(project, 'reloaded')
+    code, out, _ = run_blt(project, environ, 'e:staging', 'where')
+
+    assert 'daemon=True app=reloaded' in out
+
+def test_daemon_can_be_bypassed(project, environ, server):
+    code, out, _ = run_blt(project, environ, 'e:staging', 'where',
+                           env={'BLT_NO_DAEMON': '1'})
+
+    assert 'daemon=False app=warm' in out
+
+def test_daemon_control(project, environ, server):
+    code, out, _ = run_blt(project, environ, 'daemon', 'status')
+    assert code == 0
+    assert 'running (pid %d)' % server.pid in out
+
+    run_blt(project, environ, 'daemon', 'stop')
+    assert server.wait() == 0
+    assert not os.path.exists(daemon.socket_path(os.path.join(project, 'bltenv.py')))
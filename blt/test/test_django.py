@@ -30,35 +30,39 @@ def teardown_function(function):
 def test_up(cmds):
     django.prompt = Mock(return_value='yes')
     cmds.up()
-    calls = [ call('pip install -r requirements.txt')
-            , call('python manage.py syncdb')
-            , call('python manage.py migrate')
-            , call('python manage.py loaddata initial')
-            , call('python manage.py collectstatic --noinput')
-            , call('python manage.py assets build') ]
+    calls = [ call(['pip', 'install', '-r', 'requirements.txt'])
+            , call(['python', 'manage.py', 'syncdb'])
+            , call(['python', 'manage.py', 'migrate'])
+            , call(['python', 'manage.py', 'loaddata', 'initial'])
+            , call(['python', 'manage.py', 'collectstatic', '--noinput'])
+            , call(['python', 'manage.py', 'assets', 'build']) ]
 
     django.local.assert_has_calls(calls)
 
 def test_runserver(cmds):
     cmds.runserver()
     django.cd.assert_called_once_with('djangoproj')
-    django.local.assert_called_once_with('python manage.py runserver 127.0.0.1:8000')
+    django.local.assert_called_once_with(['python', 'manage.py', 'runserver', '127.0.0.1:8000'])
 
 def test_run_gunicorn(cmds):
     cmds.gunicorn_server()
     django.cd.assert_called_once_with('djangoproj')
-    django.local.assert_called_once_with('gunicorn --access-logfile=- --error-logfile=- pubweb.wsgi:application')
+    django.local.assert_called_once_with(['gunicorn', '--access-logfile=-', '--error-logfile=-', 'pubweb.wsgi:application'])
+
+def test_run_gunicorn_with_args(cmds):
+    cmds.gunicorn_server('--workers=3', '--reload')
+    django.local.assert_called_once_with(['gunicorn', '--workers=3', '--reload', '--access-logfile=-', '--error-logfile=-', 'pubweb.wsgi:application'])
 
 def test_shell(cmds):
     cmds.shell()
     django.cd.assert_called_once_with('djangoproj')
-    django.local.assert_called_once_with('python manage.py shell')
+    django.local.assert_called_once_with(['python', 'manage.py', 'shell'])
 
 def test_test_no_args(cmds):
     cmds.test()
     calls = [
-        call('find . -name "*.pyc" -exec rm -f {} \;'),
-        call('py.test --ds pubweb.settings')
+        call(['find', '.', '-name', '*.pyc', '-delete']),
+        call(['py.test', '--ds', 'pubweb.settings'])
     ]
 
     django.cd.assert_called_once_with('djangoproj')
@@ -67,8 +71,8 @@ def test_test_no_args(cmds):
 def test_test_specific_apps(cmds):
     cmds.test('invest', 'payment')
     calls = [
-        call('find . -name "*.pyc" -exec rm -f {} \;'),
-        call('py.test --ds pubweb.settings  invest payment')
+        call(['find', '.', '-name', '*.pyc', '-delete']),
+        call(['py.test', '--ds', 'pubweb.settings', 'invest', 'payment'])
     ]
 
     django.cd.assert_called_once_with('djangoproj')
@@ -77,8 +81,8 @@ def test_test_specific_apps(cmds):
 def test_test_specific_tests(cmds):
     cmds.test('invest.test.commands_test')
     calls = [
-        call('find . -name "*.pyc" -exec rm -f {} \;'),
-        call('py.test --ds pubweb.settings  invest -k "test and commands_test"')
+        call(['find', '.', '-name', '*.pyc', '-delete']),
+        call(['py.test', '--ds', 'pubweb.settings', 'invest', '-k', 'test and commands_test'])
     ]
 
     django.cd.assert_called_once_with('djangoproj')
@@ -87,10 +91,10 @@ def test_test_specific_tests(cmds):
 def test_cov_no_args(cmds):
     cmds.cov()
     calls = [
-        call('find . -name "*.pyc" -exec rm -f {} \;'),
-        call('coverage run  -m py.test --ds pubweb.settings'),
-        call('coverage report'),
-        call('coverage html -d coverage_html')
+        call(['find', '.', '-name', '*.pyc', '-delete']),
+        call(['coverage', 'run', '-m', 'py.test', '--ds', 'pubweb.settings']),
+        call(['coverage', 'report']),
+        call(['coverage', 'html', '-d', 'coverage_html'])
     ]
 
     django.cd.assert_called_once_with('djangoproj')
@@ -99,10 +103,10 @@ def test_cov_no_args(cmds):
 def test_cov_specific_apps(cmds):
     cmds.cov('invest', 'payment')
     calls = [
-        call('find . -name "*.pyc" -exec rm -f {} \;'),
-        call('coverage run --source invest,payment  -m py.test --ds pubweb.settings invest payment'),
-        call('coverage report'),
-        call('coverage html -d coverage_html')
+        call(['find', '.', '-name', '*.pyc', '-delete']),
+        call(['coverage', 'run', '--source', 'invest,payment', '-m', 'py.test', '--ds', 'pubweb.settings', 'invest', 'payment']),
+        call(['coverage', 'report']),
+        call(['coverage', 'html', '-d', 'coverage_html'])
     ]
 
     django.cd.assert_called_once_with('djangoproj')
@@ -111,4 +115,4 @@ def test_cov_specific_apps(cmds):
 def test_covrpt(cmds):
     cmds.covrpt()
 
-    django.local.assert_called_once_with('open coverage_html/index.html')
+    django.local.assert_called_once_with(['open', 'coverage_html/index.html'])
@@ -1,10 +1,14 @@
 import pytest
 import os
+import sys
+import types
 from mock import patch, call, Mock, MagicMock
 
 import blt.environment as env
 
 class Commands(env.Commander):
+    options = {'stats': False, 'dry_run': False}
+
     def visible_command(self):
         pass
 
@@ -13,9 +17,13 @@ class Commands(env.Commander):
 
 # -- Set Fixtures -------------------------------------------------------------
 @pytest.fixture
-def cmd_center():
-    filepath = os.path.abspath(os.path.dirname(__file__) + '/beltenvtest.py')
-    return env.CommandCenter(filepath)
+def env_file():
+    return os.path.abspath(os.path.dirname(__file__) + '/beltenvtest.py')
+
+@pytest.fixture
+def cmd_center(env_file, tmpdir, monkeypatch):
+    monkeypatch.setenv('BLT_CACHE_DIR', str(tmpdir))
+    return env.CommandCenter(env_file)
 
 @pytest.fixture
 def commander_class():
@@ -43,19 +51,79 @@ def test_loaded_commands(cmd_center):
     # - siamese (alias to command_with_aliases)
     # - twin (alias to command_with_aliases)
     # - srl (alias to some_really_long_aliased_command)
-    # - importedtest
-    # == 7 total
-    assert len(cmd_center.commands) == 7
+    # - importedtest.imported_alias
+    # - importedtest.imported_command
+    # - importedtest.imported_default
+    # == 10 total
+    assert len(cmd_center.commands) == 10
 
     assert sorted(cmd_center.commands.keys()) == [ 'command_with_aliases'
                                                  , 'default_command'
                                                  , 'importedtest.imported_alias'
                                                  , 'importedtest.imported_command'
                                                  , 'importedtest.imported_default'
+                                                 , 'siamese'
                                                  , 'some_really_long_aliased_command'
+                                                 , 'srl'
                                                  , 'standard_command'
+                                                 , 'twin'
                                                  ]
 
+def test_aliases_share_command(cmd_center):
+    assert cmd_center.commands['twin'] is cmd_center.commands['command_with_aliases']
+    assert cmd_center.commands['srl'].name == 'some_really_long_aliased_command'
+
+def test_command_decorator_renames():
+    class Renamed(env.Commander):
+        @env.command(name='up', aliases=['u'])
+        def bring_up(self):
+            """Brings it up."""
+
+        def _helper(self):
+            pass
+
+    assert Renamed._commands == {
+        'up': env.CommandSpec('up', 'bring_up', ['u'], 'Brings it up.')}
+
+def test_command_registry_inherits():
+    class Base(env.Commander):
+        @env.command(aliases=['go'])
+        def run(self):
+            pass
+
+        def other(self):
+            pass
+
+    class Child(Base):
+        def run(self):
+            """Overridden."""
+
+    assert sorted(Child._commands) == ['other', 'run']
+    assert Child._commands['run'].aliases == ['go']
+    assert Child._commands['run'].summary == 'Overridden.'
+
+def test_command_registry_includes_mixins():
+    class Mixin(object):
+        def shared(self):
+            pass
+
+        def _private(self):
+            pass
+
+    class Mixed(Mixin, env.Commander):
+        def own(self):
+            pass
+
+    assert sorted(Mixed._commands) == ['own', 'shared']
+
+def test_list_shows_aliases(cmd_center):
+    with patch.object(env, 'puts') as puts:
+        cmd_center.list()
+
+    lines = [args[0] for args, kwargs in puts.call_args_list]
+    assert '- command_with_aliases (siamese, twin) ' in lines
+    assert not [line for line in lines if line.startswith('- twin')]
+
 def test_iscommander(commander_subclass):
     assert env.iscommander(commander_subclass)
 
@@ -65,8 +133,173 @@ def test_iscommander_skips_commander_base(commander_class):
 def test_iscommandmethod(commander_instance):
     assert env.iscommandmethod(commander_instance.visible_command)
 
+def test_commander_registry_records_modules():
+    assert __name__ in env.CommanderMeta.modules
+    assert env.Commander.__module__ not in env.CommanderMeta.modules
+
+def test_extract_commands_skips_unrelated_modules(cmd_center):
+    # a bltenv-like module that imports a tool package and some stdlib
+    tools = types.ModuleType('blt.test')
+    tools.test_environment = __import__(__name__, fromlist=['Commands'])
+    bltenv = types.ModuleType('fakebltenv')
+    bltenv.os = os
+    bltenv.types = types
+    bltenv.tools = tools
+
+    cmd_center.module_cache.clear()
+    commands = cmd_center._extract_commands(bltenv)
+
+    assert 'tools.test_environment.visible_command' in commands
+    assert sorted(cmd_center.module_cache.cache) == [
+        'blt.test', 'blt.test.test_environment']
+
+def test_extract_commands_follows_reexports(cmd_center):
+    # a module that imports a Commander defined elsewhere provides its
+    # commands too
+    reexp = types.ModuleType('reexp')
+    reexp.Commands = Commands
+    bltenv = types.ModuleType('fakebltenv')
+    bltenv.reexp = reexp
+
+    cmd_center.module_cache.clear()
+    commands = cmd_center._extract_commands(bltenv)
+
+    assert sorted(commands) == ['reexp.visible_command']
+
 def test_prod_check_run(cmd_center):
     env.prod_check = Mock()
     cmd_center.run('production', 'default_command')
 
     env.prod_check.assert_called_once_with('default_command')
+
+def test_split_options():
+    options, args = env.split_options(Commands.options,
+        ['src', '--stats', '--dry-run=yes', '--pdb', 'prefix/'])
+
+    assert options == {'stats': True, 'dry_run': 'yes'}
+    assert args == ['src', '--pdb', 'prefix/']
+
+def test_commander_options_default(commander_instance):
+    assert commander_instance.opts == {'stats': False, 'dry_run': False}
+
+def test_command_execute_passes_options():
+    with patch.object(Commands, 'visible_command') as visible_command:
+        env.Command(Commands, 'visible_command').execute({}, ['a', '--stats'])
+
+    visible_command.assert_called_once_with('a')
+
+def test_command_index_is_reused(cmd_center, env_file):
+    with patch.object(env, 'import_file') as import_file:
+        center = env.CommandCenter(env_file)
+
+        assert sorted(center.commands) == sorted(cmd_center.commands)
+        assert center.commands['standard_command'].summary_docstring == ''
+        assert not import_file.called
+
+def test_command_index_runs_command(cmd_center, env_file):
+    center = env.CommandCenter(env_file)
+    cmd = center.commands['importedtest.imported_command']
+
+    assert isinstance(cmd, env.IndexedCommand)
+    assert cmd.klass.__module__ == 'importedtest'
+    assert cmd.klass.__name__ == 'TestCommands'
+
+def test_command_index_goes_stale(cmd_center, env_file):
+    stat = os.stat(env_file)
+    try:
+        os.utime(env_file, (stat.st_atime, stat.st_mtime + 10))
+        with patch.object(env, 'import_file', wraps=env.import_file) as import_file:
+            center = env.CommandCenter(env_file)
+
+        assert import_file.called
+        assert len(center.commands) == len(cmd_center.commands)
+    finally:
+        os.utime(env_file, (stat.st_atime, stat.st_mtime))
+
+def test_run_leaves_config_untouched(cmd_center):
+    import beltenvtest
+
+    with patch.object(env.Command, 'execute') as execute:
+        cmd_center.run('staging', 'default_command')
+
+    assert execute.call_args[0][0]['blt_envtype'] == 'staging'
+    assert 'blt' not in beltenvtest.CONFIG
+    assert 'blt_envtype' not in beltenvtest.CONFIG['staging']
+
+def test_config_cache_skips_import(tmpdir, monkeypatch):
+    monkeypatch.setenv('BLT_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.delenv('BLT_TEST_APP', raising=False)
+    env_file = tmpdir.join('configcacheenv.py')
+    env_file.write('import os\n'
+                   'CONFIG = {"staging": {"app": os.environ.get("BLT_TEST_APP", "app")}}\n')
+
+    def load_center():
+        try:
+            return env.CommandCenter(str(env_file))
+        finally:
+            sys.modules.pop('configcacheenv', None)
+
+    assert load_center().config['staging']['app'] == 'app'
+
+    with patch.object(env, 'import_file') as import_file:
+        assert load_center().config['staging']['app'] == 'app'
+        assert not import_file.called
+
+    # CONFIG read the variable, changing it invalidates the cache
+    monkeypatch.setenv('BLT_TEST_APP', 'other')
+    assert load_center().config['staging']['app'] == 'other'
+
+def test_run_all_checks_production_once(cmd_center):
+    with patch.object(env, 'prod_check') as prod_check, \
+            patch.object(env.Command, 'execute') as execute:
+        cmd_center.run_all([('staging', 'standard_command', []),
+                            ('production', 'default_command', []),
+                            ('production', 'srl', ['x'])])
+
+    prod_check.assert_called_once_with('default_command, srl')
+    assert execute.call_count == 3
+
+    sessions = [args[0]['blt_session'] for args, kwargs in execute.call_args_list]
+    assert sessions[0] is sessions[1] is sessions[2] is cmd_center.session
+
+def test_run_all_checks_every_command_first(cmd_center):
+    with patch.object(env.Command, 'execute') as execute:
+        with pytest.raises(SystemExit):
+            cmd_center.run_all([('staging', 'standard_command', []),
+                                ('staging', 'no_such_command', [])])
+
+    assert not execute.called
+
+def test_run_all_fans_out_environments(cmd_center, capsys):
+    def execute(cfg, args):
+        os.write(1, '%s %s\n' % (cfg['blt_envtype'], ' '.join(args)))
+
+    with patch.object(env, 'prod_check') as prod_check, \
+            patch.object(env.Command, 'execute', side_effect=execute):
+        cmd_center.run_all([('staging,production', 'standard_command', ['a']),
+                            ('production', 'srl', ['b'])])
+
+    prod_check.assert_called_once_with('standard_command, srl')
+
+    out = capsys.readouterr()[0]
+    assert '[staging] staging a\n' in out
+    assert '[production] production a\n[production] production b\n' in out
+
+def test_run_all_fan_out_fails_if_any_environment_fails(cmd_center):
+    def execute(cfg, args):
+        if cfg['blt_envtype'] == 'staging':
+            sys.exit(2)
+
+    with patch.object(env, 'prod_check'), \
+            patch.object(env, 'abort', side_effect=SystemExit(1)) as abort, \
+            patch.object(env.Command, 'execute', side_effect=execute):
+        with pytest.raises(SystemExit):
+            cmd_center.run_all([('all', 'standard_command', [])])
+
+    abort.assert_called_once_with('1 of 2 environments failed: staging.')
+
+def test_environments(cmd_center):
+    assert cmd_center.environments('staging') == ['staging']
+    assert cmd_center.environments('staging,production') == ['staging',
+                                                              'production']
+    assert cmd_center.environments('all') == ['production', 'staging']
@@ -0,0 +1,55 @@
+import sys
+
+import pytest
+
+from blt.helpers import lazy_import, local, local_lines, local_many
+
+
+def test_lazy_import_defers_import():
+    sys.modules.pop('colorsys', None)
+    colorsys = lazy_import('colorsys')
+    assert 'colorsys' not in sys.modules
+
+    assert colorsys.rgb_to_hsv(0, 0, 0) == (0, 0, 0)
+    assert 'colorsys' in sys.modules
+
+def test_lazy_import_ignores_introspection():
+    missing = lazy_import('blt_no_such_module')
+
+    # discovery runs issubclass() on module attributes
+    try:
+        issubclass(missing, object)
+    except TypeError:
+        pass
+
+    try:
+        missing.anything
+    except ImportError:
+        pass
+    else:
+        assert False, 'expected an ImportError on first use'
+
+def test_local_collects_output():
+    assert local('echo hello', collect_output=True) == 'hello\n'
+
+def test_local_aborts_on_failure():
+    with pytest.raises(SystemExit):
+        local('exit 1')
+
+    assert local('echo partial; exit 1', collect_output=True,
+                 abort_on_stderr=False) == 'partial\n'
+
+def test_local_many_reports_every_command():
+    results = local_many(['exit 1', 'echo ok'], collect_output=True)
+
+    assert [(result.returncode, result.output) for result in results] == [
+        (1, ''), (0, 'ok\n')]
+
+def test_local_lines_streams_output():
+    assert list(local_lines('echo one; echo two')) == ['one\n', 'two\n']
+
+    with pytest.raises(SystemExit):
+        list(local_lines('echo one; exit 1'))
+
+    assert list(local_lines('echo one; exit 1', abort_on_stderr=False)) == [
+        'one\n']
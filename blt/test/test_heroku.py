@@ -1,6 +1,12 @@
+import time
+
 import pytest
 from mock import patch, call, Mock
 
+from blt.helpers import local, local_lines
+from blt.parallel import Job
+from blt.runner import CommandResult
+from blt.test.fakeheroku import FakeHerokuAPI
 from blt.tools import heroku
 
 # -- Set Fixtures -------------------------------------------------------------
@@ -38,10 +44,60 @@ def heroku_cmds():
 
     return heroku.HerokuCommands(config)
 
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmpdir):
+    monkeypatch.setenv('BLT_CACHE_DIR', str(tmpdir.join('cache')))
+
+@pytest.fixture
+def api(request, monkeypatch):
+    fake = FakeHerokuAPI(token='secret')
+    fake.add_app('pubweb-staging', config={'DEBUG': 'True', 'OLD': 'x'},
+                 addons=['papertrail:choklad'], domains=['app1.pubvest.com'])
+    fake.start()
+    request.addfinalizer(fake.stop)
+
+    monkeypatch.setenv('HEROKU_API_URL', fake.url)
+    heroku.api_token.return_value = 'secret'
+    return fake
+
 # -- Setup/Teardown -----------------------------------------------------------
 
+def finish(commands, limit, labels, after=None, failing=()):
+    """Fakes local_many, the commands for the labels in failing exit 1."""
+    results = []
+    for command, label in zip(commands, labels):
+        result = CommandResult(command, label)
+        result.returncode = 1 if label in failing else 0
+        results.append(result)
+
+    return results
+
+def in_order(stages, after=None, out=None, foreground=(), failing=()):
+    """Fakes parallel.run_graph, running the stages in process, one by one."""
+    jobs = []
+    for label, func in stages:
+        job = Job(label, func, (after or {}).get(label, ()))
+        if all(done.ok for done in jobs if done.label in job.after):
+            job.started = time.time()
+            func()
+            job.status = 1 if label in failing else 0
+            job.ended = time.time()
+        jobs.append(job)
+
+    return jobs
+
 # Setup Module-wide mocks
-heroku.local = Mock()
+heroku.local = Mock(return_value='')
+heroku.local_many = Mock(side_effect=finish)
+heroku.local_lines = Mock(side_effect=lambda *args, **kwargs: iter([]))
+no_lines = heroku.local_lines.side_effect
+
+# listings behave differently on a terminal, tests that show one say which
+heroku._on_terminal = Mock(return_value=False)
+
+# the toolbelt is used unless a test sets up the fake API
+api_token = heroku.api_token
+heroku.api_token = Mock(return_value=None)
 
 # def setup_function(function):
 #     """this is called before every test case runs"""
@@ -50,83 +106,491 @@ heroku.local = Mock()
 def teardown_function(function):
     """this is called after every test case runs"""
     heroku.local.reset_mock()
+    heroku.local.return_value = ''
+    heroku.local_many.reset_mock()
+    heroku.local_lines.reset_mock()
+    heroku.local_lines.side_effect = no_lines
+    heroku.local_many.side_effect = finish
+    heroku.api_token.return_value = None
+    heroku._on_terminal.return_value = False
 
 # -- Test Cases! --------------------------------------------------------------
 def test_info(heroku_cmds):
+    heroku._on_terminal.return_value = False
     heroku_cmds.info()
-    heroku.local.assert_called_once_with('heroku apps:info --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'apps:info', '--app', 'pubweb-staging'], collect_output=True)
 
 def test_destroy(heroku_cmds):
     heroku_cmds.destroy()
-    heroku.local.assert_called_once_with('heroku apps:destroy pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'apps:destroy', 'pubweb-staging'])
 
 def test_config_no_args(heroku_cmds):
+    heroku._on_terminal.return_value = False
     heroku_cmds.config()
-    heroku.local.assert_called_once_with('heroku config --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'config', '--app', 'pubweb-staging'], collect_output=True)
 
 def test_config_set_default(heroku_cmds):
     heroku_cmds.config('set')
-    heroku.local.assert_called_once_with('heroku config:set DEBUG=False SSL_ENABLED=False PRODUCTION=True --app pubweb-staging')
+    heroku.local.assert_has_calls([
+          call(['heroku', 'config', '--shell', '--app', 'pubweb-staging'], collect_output=True)
+        , call(['heroku', 'config:set', 'DEBUG=False', 'PRODUCTION=True', 'SSL_ENABLED=False', '--app', 'pubweb-staging'])])
+    assert heroku.local.call_count == 2
 
 def test_config_cmd_and_args(heroku_cmds):
-    heroku_cmds.config('set', 'Darth=Vader Han=Solo')
-    heroku.local.assert_called_once_with('heroku config:set Darth=Vader Han=Solo --app pubweb-staging')
+    heroku_cmds.config('set', 'Darth=Vader', 'Han=Solo')
+    heroku.local.assert_called_with(['heroku', 'config:set', 'Darth=Vader', 'Han=Solo', '--app', 'pubweb-staging'])
+
+def test_config_value_with_spaces(heroku_cmds):
+    heroku_cmds.config('set', 'GREETING=hello world')
+    heroku.local.assert_called_with(['heroku', 'config:set', 'GREETING=hello world', '--app', 'pubweb-staging'])
+
+def test_config_set_only_sends_changes(heroku_cmds):
+    heroku.local.return_value = "DEBUG=False\nPRODUCTION=True\nSSL_ENABLED=True\nOLD='to go'\n"
+    heroku_cmds.cfg['heroku']['config']['OLD'] = None
+    heroku_cmds.config('set')
+
+    heroku.local.assert_has_calls([
+          call(['heroku', 'config:set', 'SSL_ENABLED=False', '--app', 'pubweb-staging'])
+        , call(['heroku', 'config:unset', 'OLD', '--app', 'pubweb-staging'])])
+    assert heroku.local.call_count == 3
+
+def test_config_set_unchanged(heroku_cmds):
+    heroku.local.return_value = "DEBUG=False\nPRODUCTION=True\nSSL_ENABLED=False\nDATABASE_URL=postgres://db\n"
+    heroku_cmds.config('set')
+    assert heroku.local.call_count == 1
+
+def test_config_changes():
+    current = {'KEEP': '1', 'CHANGE': 'old', 'DROP': 'x', 'ADDON_URL': 'y'}
+    desired = {'KEEP': '1', 'CHANGE': 'new', 'DROP': None, 'GONE': None,
+               'NEW': True}
+    assert heroku.config_changes(current, desired) == {'CHANGE': 'new',
+                                                       'DROP': None,
+                                                       'NEW': 'True'}
+
+def test_config_changes_unicode():
+    current = {u'CITY': u'Z\xfcrich', u'NAME': u'caf\xe9'}
+    desired = {'CITY': 'Z\xc3\xbcrich', 'NAME': u'cr\xe8me'}
+    assert heroku.config_changes(current, desired) == {
+        'NAME': 'cr\xc3\xa8me'}
+
+def test_config_set_needs_key_value(heroku_cmds):
+    with patch.object(heroku, 'abort', side_effect=SystemExit(1)) as abort:
+        with pytest.raises(SystemExit):
+            heroku_cmds.config('set', 'Darth=Vader', 'Han')
+
+    abort.assert_called_once_with('config set takes KEY=VALUE pairs, got: Han')
+    assert not heroku.local.called
+
+def test_parse_config_shell():
+    output = "DEBUG=False\nGREETING='hello world'\nEMPTY=\n"
+    assert heroku.parse_config_shell(output) == {'DEBUG': 'False',
+                                                 'GREETING': 'hello world',
+                                                 'EMPTY': ''}
 
 def test_addon_no_args(heroku_cmds):
+    heroku._on_terminal.return_value = False
     heroku_cmds.addon()
-    heroku.local.assert_called_once_with('heroku addons --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'addons', '--app', 'pubweb-staging'], collect_output=True)
 
 def test_addon_add_default(heroku_cmds):
     heroku_cmds.addon('add')
-    calls = [call('heroku addons:add papertrail:choklad --app pubweb-staging')
-            , call('heroku addons:add newrelic:standard --app pubweb-staging')]
+    heroku.local_many.assert_called_once_with(
+        [['heroku', 'addons:add', 'papertrail:choklad', '--app', 'pubweb-staging']
+        , ['heroku', 'addons:add', 'newrelic:standard', '--app', 'pubweb-staging']]
+        , limit=heroku.BATCH_LIMIT, labels=['papertrail:choklad', 'newrelic:standard'])
+    assert not heroku.local.called
+
+def test_addon_batch_reports_every_failure(heroku_cmds):
+    heroku.local_many.side_effect = lambda commands, limit, labels: finish(
+        commands, limit, labels, failing=['a:1', 'c:3'])
+
+    with patch.object(heroku, 'abort', side_effect=SystemExit(1)) as abort:
+        with pytest.raises(SystemExit):
+            heroku_cmds.addon('add', 'a:1', 'b:2', 'c:3')
+
+    abort.assert_called_once_with('heroku add failed for 2 of 3: a:1, c:3')
+
+def test_addon_remove_runs_one_at_a_time(heroku_cmds):
+    heroku_cmds.addon('remove', 'a', 'b')
+    calls = [call(['heroku', 'addons:remove', 'a', '--app', 'pubweb-staging'])
+            , call(['heroku', 'addons:remove', 'b', '--app', 'pubweb-staging'])]
     heroku.local.assert_has_calls(calls)
+    assert not heroku.local_many.called
 
 def test_addon_cmd_and_args(heroku_cmds):
     heroku_cmds.addon('add', 'Darth:Vader')
-    heroku.local.assert_called_once_with('heroku addons:add Darth:Vader --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'addons:add', 'Darth:Vader', '--app', 'pubweb-staging'])
 
 def test_push(heroku_cmds):
     heroku_cmds.push()
-    heroku.local.assert_called_once_with('git push heroku-staging test-branch:master')
+    heroku.local_lines.assert_called_once_with(['git', 'push', '--progress', 'heroku-staging', 'test-branch:master'], merge_stderr=True)
 
 def test_push_with_force(heroku_cmds):
     heroku_cmds.push('force')
-    heroku.local.assert_called_once_with('git push heroku-staging test-branch:master --force')
+    heroku.local_lines.assert_called_once_with(['git', 'push', '--progress', 'heroku-staging', 'test-branch:master', '--force'], merge_stderr=True)
+
+def test_push_reports_size(heroku_cmds, capsys):
+    heroku.local_lines.side_effect = lambda *args, **kwargs: iter([
+        'Writing objects:  50% (1/2)\rWriting objects: 100% (2/2), 1.25 MiB | 2.00 MiB/s, done.\n'])
+    heroku_cmds.push()
+
+    assert 'Pushed 1.25 MiB to heroku-staging in ' in capsys.readouterr()[0]
+
+def test_push_skips_what_heroku_has(heroku_cmds, monkeypatch, tmpdir, capsys):
+    # a real repository, and a bare one standing in for heroku
+    monkeypatch.setattr(heroku, 'local', local)
+    monkeypatch.setattr(heroku, 'local_lines', local_lines)
+    for name, value in [('NAME', 'Dev'), ('EMAIL', 'dev@example.com')]:
+        monkeypatch.setenv('GIT_AUTHOR_' + name, value)
+        monkeypatch.setenv('GIT_COMMITTER_' + name, value)
+
+    remote = str(tmpdir.join('heroku.git'))
+    local(['git', 'init', '-q', '--bare', remote])
+    work = tmpdir.mkdir('work')
+    monkeypatch.chdir(work)
+    local(['git', 'init', '-q'])
+    for name in ['a', 'b']:
+        work.join(name).write(name)
+        local(['git', 'add', name])
+        local(['git', 'commit', '-q', '-m', name])
+    local(['git', 'branch', '-f', 'test-branch'])
+
+    heroku_cmds.cfg['heroku']['git_remote'] = remote
+    heroku_cmds.push()
+    assert 'Pushed ' in capsys.readouterr()[0]
+
+    heroku_cmds.push()
+    assert 'nothing to push' in capsys.readouterr()[0]
+
+    heroku_cmds.push('squash')
+    heroku_cmds.push('squash')
+    assert capsys.readouterr()[0].count('nothing to push') == 1
+
+    deployed = local(['git', '--git-dir', remote, 'rev-list', 'master'],
+                     collect_output=True).split()
+    assert deployed == [local(['git', 'rev-parse', 'refs/blt/deploy/pubweb-staging'],
+                              collect_output=True).strip()]
 
 def test_create(heroku_cmds):
     heroku.prompt = Mock(return_value='yes')
-    heroku_cmds.create()
-    calls = [call('heroku apps:create pubweb-staging --remote heroku-staging')
-            , call('heroku config:set DEBUG=False SSL_ENABLED=False PRODUCTION=True --app pubweb-staging')
-            , call('git push heroku-staging test-branch:master')
-            , call('heroku addons:add papertrail:choklad --app pubweb-staging')
-            , call('heroku addons:add newrelic:standard --app pubweb-staging')
-            , call('heroku domains:add app1.pubvest.com --app pubweb-staging')
-            , call('heroku domains:add app2.pubvest.com --app pubweb-staging')
-            , call('heroku run "python djangoproj/manage.py syncdb" --app pubweb-staging')
-            , call('heroku run "python djangoproj/manage.py migrate" --app pubweb-staging')]
+    with patch.object(heroku.parallel, 'run_graph', side_effect=in_order) as graph:
+        heroku_cmds.create()
+
+    stages, = graph.call_args[0]
+    assert [label for label, func in stages] == ['apps:create', 'config',
+        'push', 'addons', 'domains', 'post_deploy']
+    assert graph.call_args[1]['after'] == {
+          'config': ['apps:create'], 'push': ['apps:create']
+        , 'addons': ['apps:create'], 'domains': ['apps:create']
+        , 'post_deploy': ['config', 'push', 'addons']}
+    assert graph.call_args[1]['foreground'] == ['apps:create', 'push']
+
+    calls = [call(['heroku', 'apps:create', 'pubweb-staging', '--remote', 'heroku-staging'])
+            , call(['heroku', 'config', '--shell', '--app', 'pubweb-staging'], collect_output=True)
+            , call(['heroku', 'config:set', 'DEBUG=False', 'PRODUCTION=True', 'SSL_ENABLED=False', '--app', 'pubweb-staging'])
+            , call(['git', 'rev-parse', '--verify', 'test-branch^{commit}'], collect_output=True)
+            , call(['git', 'ls-remote', 'heroku-staging', 'refs/heads/master'], collect_output=True, abort_on_stderr=False)
+            , call(['heroku', 'run', 'python djangoproj/manage.py syncdb', '--app', 'pubweb-staging'])
+            , call(['heroku', 'run', 'python djangoproj/manage.py migrate', '--app', 'pubweb-staging'])]
 
     heroku.local.assert_has_calls(calls)
+    heroku.local_lines.assert_called_once_with(['git', 'push', '--progress', 'heroku-staging', 'test-branch:master'], merge_stderr=True)
+
+    batches = [args[0] for args, kwargs in heroku.local_many.call_args_list]
+    assert batches == [
+        [['heroku', 'addons:add', 'papertrail:choklad', '--app', 'pubweb-staging']
+        , ['heroku', 'addons:add', 'newrelic:standard', '--app', 'pubweb-staging']]
+        , [['heroku', 'domains:add', 'app1.pubvest.com', '--app', 'pubweb-staging']
+        , ['heroku', 'domains:add', 'app2.pubvest.com', '--app', 'pubweb-staging']]]
+
+def test_create_reports_failed_stages(heroku_cmds):
+    heroku.prompt = Mock(return_value='yes')
+    push_fails = lambda stages, after, foreground: in_order(stages, after,
+        failing=['push'])
+
+    with patch.object(heroku.parallel, 'run_graph', side_effect=push_fails):
+        with patch.object(heroku, 'abort', side_effect=SystemExit(1)) as abort:
+            with pytest.raises(SystemExit):
+                heroku_cmds.create()
+
+    abort.assert_called_once_with('heroku create failed for 2 of 6: push, post_deploy')
 
 def test_run(heroku_cmds):
     heroku_cmds.run('python manage.py runserver')
-    heroku.local.assert_called_once_with('heroku run "python manage.py runserver" --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'run', 'python manage.py runserver', '--app', 'pubweb-staging'])
 
 def test_domain_no_args(heroku_cmds):
+    heroku._on_terminal.return_value = False
     heroku_cmds.domain()
-    heroku.local.assert_called_once_with('heroku domains --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'domains', '--app', 'pubweb-staging'], collect_output=True)
 
 def test_domain_add_default(heroku_cmds):
     heroku_cmds.domain('add')
-    calls = [call('heroku domains:add app1.pubvest.com --app pubweb-staging')
-            , call('heroku domains:add app2.pubvest.com --app pubweb-staging')]
-    heroku.local.assert_has_calls(calls)
+    heroku.local_many.assert_called_once_with(
+        [['heroku', 'domains:add', 'app1.pubvest.com', '--app', 'pubweb-staging']
+        , ['heroku', 'domains:add', 'app2.pubvest.com', '--app', 'pubweb-staging']]
+        , limit=heroku.BATCH_LIMIT, labels=['app1.pubvest.com', 'app2.pubvest.com'])
 
 def test_domain_cmd_and_args(heroku_cmds):
     heroku_cmds.domain('add', 'app3.pubvest.com')
-    heroku.local.assert_called_once_with('heroku domains:add app3.pubvest.com --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'domains:add', 'app3.pubvest.com', '--app', 'pubweb-staging'])
+
+def test_run_plain_commands_in_order(heroku_cmds):
+    heroku_cmds.run('python manage.py syncdb', 'python manage.py migrate')
+
+    heroku.local.assert_has_calls([
+          call(['heroku', 'run', 'python manage.py syncdb', '--app', 'pubweb-staging'])
+        , call(['heroku', 'run', 'python manage.py migrate', '--app', 'pubweb-staging'])])
+    assert not heroku.local_many.called
+
+def test_run_independent_steps_concurrently(heroku_cmds):
+    heroku_cmds.run('migrate', ['collectstatic', 'compress'],
+                    {'name': 'warm', 'run': 'warm_cache', 'after': 'migrate'})
+
+    heroku.local_many.assert_called_once_with(
+        [['heroku', 'run', '--no-tty', 'migrate', '--app', 'pubweb-staging']
+        , ['heroku', 'run', '--no-tty', 'collectstatic', '--app', 'pubweb-staging']
+        , ['heroku', 'run', '--no-tty', 'compress', '--app', 'pubweb-staging']
+        , ['heroku', 'run', '--no-tty', 'warm_cache', '--app', 'pubweb-staging']]
+        , limit=heroku.BATCH_LIMIT
+        , labels=['migrate', 'collectstatic', 'compress', 'warm']
+        , after=[[], [0], [0], [0]])
+    assert not heroku.local.called
+
+def test_run_reports_failed_steps(heroku_cmds):
+    heroku.local_many.side_effect = lambda commands, limit, labels, after: \
+        finish(commands, limit, labels, failing=['compress'])
+
+    with patch.object(heroku, 'abort', side_effect=SystemExit(1)) as abort:
+        with pytest.raises(SystemExit):
+            heroku_cmds.run(['collectstatic', 'compress'])
+
+    abort.assert_called_once_with('heroku run failed for 1 of 2: compress')
+
+def test_plan_steps():
+    names, commands, after = heroku.plan_steps(
+        ['syncdb', {'name': 'seed', 'run': 'loaddata', 'after': []}, 'migrate',
+         ['a', {'run': 'b', 'after': ['seed', 'syncdb']}], 'done'])
+
+    assert names == ['syncdb', 'seed', 'migrate', 'a', 'b', 'done']
+    assert after == [[], [], [1], [2], [1, 0], [3, 4]]
+
+def test_plan_steps_rejects_bad_references():
+    with patch.object(heroku, 'abort', side_effect=SystemExit(1)) as abort:
+        with pytest.raises(SystemExit):
+            heroku.plan_steps([{'run': 'a', 'after': 'nope'}])
+        abort.assert_called_with('heroku step "nope" waits for an unknown step')
+
+        with pytest.raises(SystemExit):
+            heroku.plan_steps([{'run': 'a', 'after': 'b'},
+                               {'run': 'b', 'after': 'a'}])
+        abort.assert_called_with('heroku steps wait for each other: a, b')
 
 def test_migrate(heroku_cmds):
     heroku_cmds.migrate()
-    heroku.local.assert_called_once_with('heroku run "python djangoproj/manage.py migrate" --app pubweb-staging')
+    heroku.local.assert_called_once_with(['heroku', 'run', 'python djangoproj/manage.py migrate', '--app', 'pubweb-staging'])
+
+def test_api_token(monkeypatch, tmpdir):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.delenv('HEROKU_API_KEY', raising=False)
+    assert api_token() is None
+
+    netrc = tmpdir.join('.netrc')
+    netrc.write('machine api.heroku.com\n  login me@example.com\n  password from-netrc\n')
+    netrc.chmod(0600)
+    assert api_token() == 'from-netrc'
+
+    monkeypatch.setenv('HEROKU_API_KEY', 'from-env')
+    assert api_token() == 'from-env'
+
+def test_api_info(heroku_cmds, api, capsys):
+    heroku_cmds.info()
+
+    out = capsys.readouterr()[0]
+    assert '=== pubweb-staging' in out
+    assert 'Web URL:   https://pubweb-staging.herokuapp.com/' in out
+    assert not heroku.local.called
+
+def test_api_config_set_and_unset(heroku_cmds, api):
+    heroku_cmds.config('set', 'GREETING=hello world')
+    heroku_cmds.config('unset', 'OLD')
+
+    assert api.apps['pubweb-staging']['config'] == {'DEBUG': 'True',
+                                                    'GREETING': 'hello world'}
+
+def test_api_config_set_sends_only_the_delta(heroku_cmds, api):
+    heroku_cmds.cfg['heroku']['config']['OLD'] = None
+    heroku_cmds.config('set')
+    heroku_cmds.config('set')
+
+    patches = [body for method, path, body in api.requests if method == 'PATCH']
+    assert patches == [{'DEBUG': 'False', 'PRODUCTION': 'True',
+                        'SSL_ENABLED': 'False', 'OLD': None}]
+
+def test_api_reuses_one_connection(heroku_cmds, api):
+    heroku_cmds.config()
+    heroku_cmds.addon()
+    heroku_cmds.domain()
+
+    # a chained command shares the session, and with it the connection
+    heroku.HerokuCommands(heroku_cmds.cfg, {'refresh': True}).config()
+
+    assert len(api.requests) == 4
+    assert api.connections == 1
+
+def test_listings_are_cached(heroku_cmds):
+    heroku._on_terminal.return_value = False
+    heroku.local.return_value = 'Web URL: https://pubweb-staging.herokuapp.com/\n'
+    heroku_cmds.info()
+    heroku_cmds.info()
+    assert heroku.local.call_count == 1
+
+    heroku.HerokuCommands(heroku_cmds.cfg, {'refresh': True}).info()
+    assert heroku.local.call_count == 2
+
+    heroku_cmds.cfg['heroku']['cache_ttl'] = 0
+    heroku_cmds.info()
+    assert heroku.local.call_count == 3
+
+def test_api_changes_drop_cached_listings(heroku_cmds, api, capsys):
+    heroku_cmds.domain()
+    heroku_cmds.config()
+    heroku_cmds.domain('add', 'app3.pubvest.com')
+    heroku_cmds.domain()
+    heroku_cmds.config()
+
+    gets = [path for method, path, body in api.requests if method == 'GET']
+    assert gets == ['/apps/pubweb-staging/domains',
+                    '/apps/pubweb-staging/config-vars',
+                    '/apps/pubweb-staging/domains']
+    assert capsys.readouterr()[0].count('app3.pubvest.com') == 2
+
+    heroku_cmds.config('set', 'DEBUG=False')
+    heroku_cmds.config('get', 'DEBUG')
+    assert capsys.readouterr()[0].endswith('False\n')
+
+def test_config_is_not_cached_on_disk(heroku_cmds, api):
+    heroku_cmds.config()
+    heroku_cmds.domain()
+    heroku_cmds.config()
+
+    with open(heroku_cmds._cache_path()) as f:
+        cached = f.read()
+    assert 'api domains' in cached
+    assert 'config' not in cached and 'DEBUG' not in cached
+
+    gets = [path for method, path, body in api.requests if method == 'GET']
+    assert gets.count('/apps/pubweb-staging/config-vars') == 1
+
+def test_config_get_always_asks_heroku(heroku_cmds, api, capsys):
+    heroku_cmds.config()
+    api.apps['pubweb-staging']['config']['DEBUG'] = 'False'
+    heroku_cmds.config('get', 'DEBUG')
+
+    assert capsys.readouterr()[0].endswith('False\n')
+
+def test_toolbelt_listing_on_a_terminal(heroku_cmds):
+    heroku._on_terminal.return_value = True
+    heroku_cmds.addon()
+    heroku_cmds.addon()
+
+    assert heroku.local.call_args_list == [
+        call(['heroku', 'addons', '--app', 'pubweb-staging'])] * 2
+
+def test_api_repeats_only_idempotent_requests():
+    client = heroku.HerokuAPI('secret', 'https://api.example.com')
+    response = Mock(status=200, read=Mock(return_value='{}'))
+    fresh = Mock(getresponse=Mock(return_value=response))
+    client._connect = Mock(return_value=fresh)
+
+    def dropped():
+        # sent on a kept alive connection, which the server had closed
+        return Mock(getresponse=Mock(side_effect=heroku.httplib.BadStatusLine('')))
+
+    client.connection = dropped()
+    assert client.request('GET', '/apps/app') == {}
+    assert fresh.request.call_count == 1
+
+    client.connection = dropped()
+    with pytest.raises(heroku.httplib.BadStatusLine):
+        client.create_domain('app', 'app.example.com')
+    assert fresh.request.call_count == 1
+
+def test_api_addon_add_reports_every_failure(heroku_cmds, api):
+    with patch.object(heroku, 'abort', side_effect=SystemExit(1)) as abort:
+        with pytest.raises(SystemExit):
+            heroku_cmds.addon('add', 'newrelic:standard', 'bogus:broken',
+                              'redis:mini')
+
+    abort.assert_called_once_with('heroku add failed for 1 of 3: bogus:broken')
+    plans = [addon['plan']['name'] for addon in api.apps['pubweb-staging']['addons']]
+    assert sorted(plans) == ['newrelic:standard', 'papertrail:choklad', 'redis:mini']
+
+def test_api_addon_upgrade_and_remove_by_service(heroku_cmds, api):
+    heroku_cmds.addon('upgrade', 'papertrail:fixa')
+    assert api.apps['pubweb-staging']['addons'][0]['plan']['name'] == 'papertrail:fixa'
+
+    with patch.object(heroku, 'prompt', return_value='pubweb-staging'):
+        heroku_cmds.addon('remove', 'papertrail')
+    assert api.apps['pubweb-staging']['addons'] == []
+
+def test_api_addon_remove_default(heroku_cmds, api):
+    heroku_cmds.addon('add', 'newrelic:standard')
+
+    # the beltenv lists "service:plan", removal goes by the service
+    with patch.object(heroku, 'prompt', return_value='pubweb-staging'):
+        heroku_cmds.addon('remove')
+    assert api.apps['pubweb-staging']['addons'] == []
+
+def test_api_batch_lists_addons_once(heroku_cmds, api):
+    heroku_cmds.addon('add', 'newrelic:standard', 'redis:mini')
+    heroku_cmds.addon('upgrade', 'newrelic:pro', 'redis:premium')
+
+    listings = [path for method, path, body in api.requests
+                if (method, path) == ('GET', '/apps/pubweb-staging/addons')]
+    assert len(listings) == 1
+    plans = [addon['plan']['name'] for addon in api.apps['pubweb-staging']['addons']]
+    assert sorted(plans) == ['newrelic:pro', 'papertrail:choklad', 'redis:premium']
+
+def test_api_batch_connection_per_worker(heroku_cmds, api):
+    domains = ['app%d.pubvest.com' % n for n in range(2, 10)]
+    heroku_cmds.domain('add', *domains)
+
+    # the session's client plus one per extra worker, whatever the batch size
+    assert 1 <= api.connections <= heroku.BATCH_LIMIT
+    added = [domain['hostname'] for domain in api.apps['pubweb-staging']['domains']]
+    assert sorted(added[2:]) == sorted(domains)
+
+def test_api_domain_clear_keeps_heroku_domain(heroku_cmds, api):
+    heroku_cmds.domain('add', 'app2.pubvest.com')
+    heroku_cmds.domain('clear')
+
+    assert [domain['hostname'] for domain in api.apps['pubweb-staging']['domains']] == [
+        'pubweb-staging.herokuapp.com']
+
+def test_api_destroy_asks_for_app_name(heroku_cmds, api):
+    with patch.object(heroku, 'prompt', return_value='nope'):
+        with pytest.raises(SystemExit):
+            heroku_cmds.destroy()
+    assert 'pubweb-staging' in api.apps
+
+    with patch.object(heroku, 'prompt', return_value='pubweb-staging'):
+        heroku_cmds.destroy()
+    assert 'pubweb-staging' not in api.apps
+
+def test_api_errors_abort(heroku_cmds, api):
+    heroku_cmds.cfg['heroku']['app'] = 'missing'
+
+    with patch.object(heroku, 'abort', side_effect=SystemExit(1)) as abort:
+        with pytest.raises(SystemExit):
+            heroku_cmds.info()
+
+    abort.assert_called_once_with("heroku API: Couldn't find that app. (HTTP 404)")
+
+def test_api_can_be_turned_off(heroku_cmds, api):
+    heroku._on_terminal.return_value = False
+    heroku_cmds.cfg['heroku']['api'] = False
+    heroku_cmds.info()
+
+    assert api.requests == []
+    heroku.local.assert_called_once_with(['heroku', 'apps:info', '--app', 'pubweb-staging'], collect_output=True)
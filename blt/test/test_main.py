@@ -0,0 +1,157 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+# modules that only commands should load, never listing or help. blt list and
+# help run with a cold command index here (the worst case), so anything on
+# this list showing up means a tool pays for it at import time
+HEAVY_MODULES = ('boto', 'brotli', 'httplib', 'mimetypes', 'multiprocessing')
+
+BLTENV = '''
+from blt.tools import aws, bundle, django, heroku, south
+
+CONFIG = {
+    "staging": {},
+    "production": {},
+}
+'''
+
+# runs blt.main in-process and reports the imported modules on exit
+SCRIPT = '''
+import atexit, sys
+atexit.register(lambda: sys.stderr.write(" ".join(sys.modules)))
+sys.argv = ["blt"] + sys.argv[1:]
+from blt.main import main
+main()
+'''
+
+# runs the blt launcher with a daemon that takes every command, the modules
+# it imported are whatever a forwarded command costs the client
+LAUNCHER_SCRIPT = '''
+import atexit, sys
+atexit.register(lambda: sys.stderr.write(" ".join(sys.modules)))
+sys.argv = ["blt"] + sys.argv[1:]
+from blt import daemon
+daemon.forward = lambda argv: 0
+from blt.launcher import main
+main()
+'''
+
+# -- Set Fixtures -------------------------------------------------------------
+@pytest.fixture
+def project(tmpdir):
+    tmpdir.join('bltenv.py').write(BLTENV)
+    return tmpdir
+
+def run_blt(project, *argv, **kwargs):
+    """
+    Runs blt with a cold command index.
+
+    Args:
+        script: The code to run blt with, SCRIPT by default.
+
+    Returns:
+        The names of the modules it imported.
+    """
+    cache_dir = project.join('cache')
+    if cache_dir.check():
+        cache_dir.remove()
+
+    env = dict(os.environ, PYTHONPATH=ROOT, BLT_CACHE_DIR=str(cache_dir))
+    script = kwargs.get('script', SCRIPT)
+    proc = subprocess.Popen([sys.executable, '-c', script] + list(argv),
+                            cwd=str(project), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+
+    assert proc.returncode == 0, err
+    return err.split()
+
+# -- Test Cases! --------------------------------------------------------------
+@pytest.mark.parametrize('argv', [
+    ('list',),
+    ('help', 'aws.sync_s3'),
+])
+def test_startup_skips_heavy_imports(project, argv):
+    modules = run_blt(project, *argv)
+
+    loaded = [name for name in modules if name.split('.')[0] in HEAVY_MODULES]
+    assert loaded == []
+
+def test_launcher_forwards_before_heavy_imports(project):
+    modules = run_blt(project, 'e:staging', 'heroku.push',
+                      script=LAUNCHER_SCRIPT)
+
+    assert 'blt.launcher' in modules
+    loaded = [name for name in modules
+              if name.split('.')[0] in ('clint', 'boto', 'bltenv')
+              or name.startswith(('blt.tools', 'blt.environment', 'blt.main'))]
+    assert loaded == []
+
+def steps_of(steps):
+    return [(envtype, args.all) for envtype, args in steps]
+
+def test_parse_steps_chains_commands():
+    from blt.main import parse_steps
+
+    steps = parse_steps(['e:s', 'heroku.push', '+', 'heroku.migrate', '+',
+                         'e:p', 'aws.sync_s3', 'src', '+'])
+
+    assert steps_of(steps) == [('staging', ['heroku.push']),
+                               ('staging', ['heroku.migrate']),
+                               ('production', ['aws.sync_s3', 'src'])]
+
+def test_parse_steps_single_command():
+    from blt.main import parse_steps
+
+    assert steps_of(parse_steps(['django.runserver', 'e:l', '0.0.0.0'])) == [
+        ('local', ['django.runserver', '0.0.0.0'])]
+
+def test_parse_steps_several_environments():
+    from blt.main import parse_steps
+
+    assert steps_of(parse_steps(['e:s,p', 'heroku.push', '+', 'e:all',
+                                 'heroku.migrate'])) == [
+        ('staging,production', ['heroku.push']),
+        ('all', ['heroku.migrate'])]
+
+def test_pop_timing_flags():
+    from blt.main import pop_timing_flags
+
+    assert pop_timing_flags(['e:s', 'heroku.push', '--force']) == (
+        ['e:s', 'heroku.push', '--force'], None)
+    assert pop_timing_flags(['--timings', 'heroku.push']) == (
+        ['heroku.push'], '')
+    assert pop_timing_flags(['e:s', '--profile', 'heroku.push']) == (
+        ['e:s', 'heroku.push'], 'blt-profile.folded')
+    assert pop_timing_flags(['--profile=push.folded', 'heroku.push']) == (
+        ['heroku.push'], 'push.folded')
+
+def test_pop_timing_flags_leaves_command_args_alone():
+    from blt.main import pop_timing_flags
+
+    # django.test hands its args to py.test, which has a --profile of its own
+    assert pop_timing_flags(['django.test', '--profile']) == (
+        ['django.test', '--profile'], None)
+    assert pop_timing_flags(['--timings', 'e:s', 'heroku.push', '+',
+                             'heroku.run', '--timings']) == (
+        ['e:s', 'heroku.push', '+', 'heroku.run', '--timings'], '')
+
+def test_read_batch(tmpdir):
+    from blt.main import read_batch
+
+    batch = tmpdir.join('deploy.blt')
+    batch.write('# deploy staging, then sync production\n'
+                'heroku.push\n'
+                '\n'
+                'heroku.config set "GREETING=hello world"  # quoted\n'
+                'e:production aws.sync_s3\n')
+
+    assert steps_of(read_batch(str(batch), 'staging')) == [
+        ('staging', ['heroku.push']),
+        ('staging', ['heroku.config', 'set', 'GREETING=hello world']),
+        ('production', ['aws.sync_s3'])]
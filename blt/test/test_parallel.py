@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+from StringIO import StringIO
+
+import pytest
+
+from blt import parallel
+from blt.helpers import abort
+
+
+def say(text):
+    return lambda: os.write(1, text)
+
+def fail_with(error):
+    def job():
+        raise error
+    return job
+
+# -- Test Cases! --------------------------------------------------------------
+def test_run_forked_prefixes_lines():
+    out = StringIO()
+    statuses = parallel.run_forked([('staging', say('one\ntwo\nno newline')),
+                                    ('production', say('three\n'))], out)
+
+    assert statuses == {'staging': 0, 'production': 0}
+    assert sorted(out.getvalue().splitlines()) == ['[production] three',
+                                                   '[staging] no newline',
+                                                   '[staging] one',
+                                                   '[staging] two']
+
+def test_run_forked_exit_statuses():
+    out = StringIO()
+    statuses = parallel.run_forked([
+        ('ok', lambda: None),
+        ('exit', lambda: sys.exit(3)),
+        ('abort', lambda: abort('nope')),
+        ('error', fail_with(ValueError('broken'))),
+    ], out)
+
+    assert statuses == {'ok': 0, 'exit': 3, 'abort': 1, 'error': 1}
+
+def test_run_forked_relays_stderr():
+    out = StringIO()
+    parallel.run_forked([('a', lambda: os.write(2, 'oops\n'))], out)
+
+    assert out.getvalue() == '[a] oops\n'
+
+def test_run_forked_runs_concurrently():
+    start = time.time()
+    parallel.run_forked([('a', lambda: time.sleep(0.3)),
+                         ('b', lambda: time.sleep(0.3))], StringIO())
+
+    assert time.time() - start < 0.5
+
+def test_run_forked_jobs_get_no_stdin():
+    out = StringIO()
+    parallel.run_forked([('a', lambda: os.write(1, repr(os.read(0, 10))))], out)
+
+    assert out.getvalue() == "[a] ''\n"
+
+def test_run_graph_waits_for_dependencies():
+    jobs = parallel.run_graph([('create', lambda: time.sleep(0.2)),
+                               ('push', lambda: time.sleep(0.2)),
+                               ('addons', lambda: time.sleep(0.2)),
+                               ('deploy', lambda: None)],
+                              after={'push': ['create'],
+                                     'addons': ['create'],
+                                     'deploy': ['push', 'addons']},
+                              out=StringIO())
+    create, push, addons, deploy = jobs
+
+    assert all(job.ok for job in jobs)
+    assert push.started >= create.ended and addons.started >= create.ended
+    assert abs(push.started - addons.started) < 0.15
+    assert deploy.started >= max(push.ended, addons.ended)
+
+def test_run_graph_skips_dependents_of_failures():
+    out = StringIO()
+    jobs = parallel.run_graph([('create', lambda: sys.exit(2)),
+                               ('push', say('pushing\n')),
+                               ('deploy', say('deploying\n')),
+                               ('docs', say('docs\n'))],
+                              after={'push': ['create'], 'deploy': ['push']},
+                              out=out)
+
+    assert [job.status for job in jobs] == [2, None, None, 0]
+    assert jobs[1].started is None
+    assert out.getvalue() == '[docs] docs\n'
+
+def test_run_graph_runs_foreground_jobs_here():
+    out = StringIO()
+    ran_in = []
+    jobs = parallel.run_graph([('create', lambda: None),
+                               ('push', lambda: ran_in.append(os.getpid())),
+                               ('config', say('configured\n'))],
+                              after={'push': ['create'],
+                                     'config': ['create']},
+                              out=out, foreground=['push'])
+    create, push, config = jobs
+
+    assert all(job.ok for job in jobs)
+    assert ran_in == [os.getpid()]
+    assert config.started <= push.started
+    assert out.getvalue() == '[config] configured\n'
+
+def test_run_graph_foreground_failures():
+    jobs = parallel.run_graph([('push', lambda: abort('rejected')),
+                               ('deploy', lambda: None)],
+                              after={'deploy': ['push']},
+                              out=StringIO(), foreground=['push'])
+
+    assert [job.status for job in jobs] == [1, None]
+
+def test_run_graph_rejects_bad_dependencies():
+    with pytest.raises(ValueError):
+        parallel.run_graph([('a', lambda: None)], after={'a': ['b']})
+
+    with pytest.raises(ValueError):
+        parallel.run_graph([('a', lambda: None), ('b', lambda: None)],
+                           after={'a': ['b'], 'b': ['a']})
@@ -0,0 +1,146 @@
+import sys
+import time
+
+import pytest
+from mock import Mock
+
+from blt import runner
+
+
+# -- Test Cases! --------------------------------------------------------------
+def test_run_captures_output():
+    result = runner.run('echo one; echo two', capture=True)
+
+    assert (result.returncode, result.output) == (0, 'one\ntwo\n')
+
+def test_run_reports_exit_status():
+    result = runner.run('exit 3')
+
+    assert (result.ok, result.returncode, result.output) == (False, 3, None)
+
+def test_run_with_environment():
+    result = runner.run(['sh', '-c', 'echo $BLT_TEST_VALUE'], capture=True,
+                        env={'BLT_TEST_VALUE': 'set'})
+
+    assert result.output == 'set\n'
+
+def test_lists_skip_the_shell():
+    assert runner.use_shell('echo a | wc -l')
+    assert not runner.use_shell(['echo', 'a'])
+    assert runner.use_shell(['echo a'], shell=True)
+
+    assert runner.run(['echo', 'a;b'], capture=True).output == 'a;b\n'
+    assert runner.command_line(['git', 'commit', '-m', "it's done"]) == \
+        'git commit -m \'it\'"\'"\'s done\''
+
+def test_run_without_shell():
+
+    result = runner.run(['blt-no-such-command'], shell=False)
+    assert result.returncode == 127
+    assert result.error
+
+def test_run_many_prefixes_output(capsys):
+    results = runner.run_many(['echo one; echo two >&2; printf three',
+                               'exit 2'], labels=['a', 'b'])
+
+    assert [result.returncode for result in results] == [0, 2]
+
+    out, err = capsys.readouterr()
+    assert out == '[a] one\n[a] three'
+    assert err == '[a] two\n'
+
+def test_run_many_labelled_commands_get_no_stdin():
+    script = ('import os; '
+              'print os.path.samefile("/dev/stdin", os.devnull)')
+    results = runner.run_many([[sys.executable, '-c', script]], capture=True,
+                              labels=['a'], shell=False)
+
+    assert results[0].output == 'True\n'
+
+def test_run_many_captures_per_command():
+    results = runner.run_many(['echo %d' % n for n in range(6)], capture=True)
+
+    assert [result.output for result in results] == ['%d\n' % n for n in range(6)]
+
+def test_run_many_limits_concurrency():
+    start = time.time()
+    runner.run_many(['sleep 0.2'] * 4, limit=4)
+    assert time.time() - start < 0.6
+
+    start = time.time()
+    runner.run_many(['sleep 0.2'] * 2, limit=1)
+    assert time.time() - start >= 0.4
+
+def test_run_many_refills_slots_without_pipes():
+    # nothing is piped, the third command starts when the second exits, not
+    # once the first one does
+    results = runner.run_many(['sleep 0.6', 'sleep 0.1', 'true'], limit=2)
+
+    assert results[2].started - results[0].started < 0.4
+
+def test_run_many_waits_for_dependencies():
+    # b and c only need a, d needs both of them
+    results = runner.run_many(['sleep 0.2', 'sleep 0.2', 'sleep 0.2', 'true'],
+                              after=[[], [0], [0], [1, 2]])
+    a, b, c, d = results
+
+    assert all(result.ok for result in results)
+    assert b.started >= a.ended and c.started >= a.ended
+    assert abs(b.started - c.started) < 0.15
+    assert d.started >= max(b.ended, c.ended)
+    assert 0.2 <= b.duration < 0.4
+
+def test_run_many_skips_dependents_of_failures():
+    results = runner.run_many(['exit 1', 'true', 'true', 'true'],
+                              labels=['a', 'b', 'c', 'd'],
+                              after=[[], [0], [1], []])
+
+    assert [result.returncode for result in results] == [1, None, None, 0]
+    assert results[1].error == 'skipped, a failed'
+    assert results[2].error == 'skipped, b failed'
+    assert results[1].duration is None
+
+def test_run_many_rejects_cycles():
+    with pytest.raises(ValueError):
+        runner.run_many(['true', 'true'], after=[[1], [0]])
+
+def test_run_many_cancels_running_commands(monkeypatch):
+    started = []
+    start = runner._Job.start
+
+    def record(job):
+        started.append(job)
+        return start(job)
+
+    monkeypatch.setattr(runner._Job, 'start', record)
+    monkeypatch.setattr(runner, '_pump', Mock(side_effect=KeyboardInterrupt))
+
+    begin = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        runner.run_many([['sleep', '30']] * 3, limit=2, shell=False)
+
+    assert len(started) == 2
+    assert all(job.proc.poll() is not None for job in started)
+    assert time.time() - begin < runner.CANCEL_TIMEOUT
+
+def test_capture_spills_to_disk(monkeypatch):
+    monkeypatch.setattr(runner, 'SPILL_SIZE', 1000)
+    result = runner.run('seq 1 1000', capture=True)
+
+    assert result.captured.spilled
+    assert next(result.lines()) == '1\n'
+    assert result.output.splitlines()[-1] == '1000'
+
+def test_stream_yields_lines():
+    output = runner.stream('echo one; echo two; exit 4')
+
+    assert list(output) == ['one\n', 'two\n']
+    assert output.returncode == 4
+
+def test_stream_stops_command_when_abandoned():
+    output = runner.stream(['yes'], shell=False)
+    lines = iter(output)
+
+    assert next(lines) == 'y\n'
+    lines.close()
+    assert output.returncode is not None
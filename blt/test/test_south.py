@@ -19,18 +19,21 @@ def cmds():
 
 # Setup Module-wide mocks
 south.local = Mock()
+south.local_lines = Mock()
 south.cd = MagicMock()
 
 def teardown_function(function):
     """this is called after every test case runs"""
     south.local.reset_mock()
+    south.local_lines.reset_mock()
+    south.local_lines.side_effect = None
     south.cd.reset_mock()
 
 # -- Test Cases! --------------------------------------------------------------
 def test_delta(cmds):
     cmds.delta('invest', 'payment')
-    calls = [ call('python manage.py schemamigration invest --auto')
-            , call('python manage.py schemamigration payment --auto')]
+    calls = [ call(['python', 'manage.py', 'schemamigration', 'invest', '--auto'])
+            , call(['python', 'manage.py', 'schemamigration', 'payment', '--auto'])]
 
     south.cd.assert_called_once_with('djangoproj')
     south.local.assert_has_calls(calls)
@@ -38,4 +41,35 @@ def test_delta(cmds):
 def test_migrate(cmds):
     cmds.migrate('invest')
     south.cd.assert_called_once_with('djangoproj')
-    south.local.assert_called_once_with('python manage.py migrate invest')
+    south.local.assert_called_once_with(['python', 'manage.py', 'migrate', 'invest'])
+
+def lines_of(*outputs):
+    """Fakes the output of consecutive local_lines calls."""
+    return [(line for line in output) for output in outputs]
+
+def test_status_in_sync(cmds):
+    south.local_lines.side_effect = lines_of(
+        ['Nothing seems to have changed.\n'],
+        ['invest\n', ' (*) 0001_initial\n'])
+
+    with patch.object(south, 'puts') as puts:
+        cmds.status('invest')
+
+    south.local_lines.assert_has_calls([
+        call(['python', 'manage.py', 'schemamigration', 'invest', '--auto', '--stdout'],
+             abort_on_stderr=False, merge_stderr=True),
+        call(['python', 'manage.py', 'migrate', 'invest', '--list'])])
+    assert call("Model is in sync with migrations") in puts.call_args_list
+    assert call("All migrations have been applied to db") in puts.call_args_list
+
+def test_status_streams_model_changes(cmds):
+    south.local_lines.side_effect = lines_of(
+        ['class Migration:\n', '    pass\n'],
+        ['invest\n', ' (*) 0001_initial\n', ' ( ) 0002_auto\n'])
+
+    with patch.object(south, 'puts') as puts:
+        cmds.status('invest')
+
+    printed = [args[0] for args, kwargs in puts.call_args_list]
+    assert printed[1:4] == ["Model changes found:\n", 'class Migration:', '    pass']
+    assert "Migrations need to be applied to db:\ninvest\n ( ) 0002_auto" in printed
@@ -0,0 +1,73 @@
+import time
+from StringIO import StringIO
+
+import pytest
+
+from blt import timing
+
+
+# -- Set Fixtures -------------------------------------------------------------
+@pytest.fixture
+def recording(request):
+    timing.reset()
+    timing.enable()
+    request.addfinalizer(timing.reset)
+
+def fake_clock(monkeypatch, *ticks):
+    ticks = list(ticks)
+    monkeypatch.setattr(time, 'time', lambda: ticks.pop(0))
+
+# -- Test Cases! --------------------------------------------------------------
+def test_span_records_nothing_when_disabled():
+    timing.reset()
+    with timing.span('load bltenv'):
+        pass
+
+    assert timing.folded() == []
+
+def test_record_adds_overlapping_children(recording, monkeypatch):
+    fake_clock(monkeypatch, 0, 3)
+
+    with timing.span('heroku.run', kind='command'):
+        timing.record('syncdb', 2, kind='subprocess')
+        timing.record('collectstatic', 2.5, kind='subprocess')
+
+    assert timing.folded() == [
+        'heroku.run;collectstatic 2500000',
+        'heroku.run;syncdb 2000000']
+
+def test_folded_stacks_hold_own_time(recording, monkeypatch):
+    fake_clock(monkeypatch, 0, 1, 3, 3.5, 4, 10)
+
+    with timing.span('e:staging heroku.create', kind='command'):
+        with timing.span('heroku apps:create; echo', kind='subprocess'):
+            pass
+        with timing.span('git push', kind='subprocess'):
+            pass
+
+    assert timing.folded() == [
+        'e:staging heroku.create 7500000',
+        'e:staging heroku.create;git push 500000',
+        'e:staging heroku.create;heroku apps:create, echo 2000000']
+
+def test_summary_adds_up_repeated_spans(recording, monkeypatch):
+    fake_clock(monkeypatch, 0, 1, 1, 3, 3, 3.5)
+
+    for command in ('git push', 'git push', 'heroku ps'):
+        with timing.span(command, kind='subprocess'):
+            pass
+
+    lines = timing.summary()
+    assert lines[1].split() == ['subprocess', '2', '3.000s', 'git', 'push']
+    assert lines[2].split() == ['subprocess', '1', '0.500s', 'heroku', 'ps']
+
+def test_report_writes_profile(recording, tmpdir):
+    with timing.span('load bltenv'):
+        time.sleep(0.01)
+
+    out = StringIO()
+    profile = tmpdir.join('blt.folded')
+    timing.report(str(profile), out)
+
+    assert 'load bltenv' in out.getvalue()
+    assert profile.read().startswith('load bltenv ')
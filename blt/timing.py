@@ -0,0 +1,158 @@
+"""
+Wall clock timings of what a blt run spends its time on.
+
+Phases, commands and the subprocesses they shell out to are wrapped in
+``span``. Spans don't record anything unless timing was turned on with
+``enable``, which blt does for the ``--timings`` and ``--profile`` flags.
+
+Two reports are available: a summary table, and a file in the "folded
+stacks" format flame graph tools read, e.g.:
+
+    blt --profile=create.folded e:staging heroku.create
+    flamegraph.pl create.folded > create.svg
+
+Note that this module must only import from the standard library.
+"""
+from contextlib import contextmanager
+import sys
+import time
+
+# default file name for --profile
+DEFAULT_PROFILE = 'blt-profile.folded'
+
+_enabled = False
+_stack = []
+_records = []
+
+
+def enable():
+    """Turns recording on, spans are free until this is called."""
+    global _enabled
+    _enabled = True
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """Turns recording off and forgets everything recorded so far."""
+    global _enabled
+    _enabled = False
+    del _stack[:]
+    del _records[:]
+
+@contextmanager
+def span(name, kind='phase'):
+    """
+    Records the wall time spent inside the block.
+
+    Spans nest, a span opened inside another one is recorded as its child.
+
+    Args:
+        name: what is being timed, e.g. the command line of a subprocess
+        kind: one of "phase", "command" or "subprocess"
+
+    Usage:
+        with timing.span('heroku.create', kind='command'):
+            cmd.execute(cfg, args)
+    """
+    if not _enabled:
+        yield
+        return
+
+    _stack.append(_frame_name(name))
+    start = time.time()
+    try:
+        yield
+    finally:
+        _records.append((tuple(_stack), kind, time.time() - start))
+        _stack.pop()
+
+def record(name, elapsed, kind='phase'):
+    """
+    Records a span that was timed elsewhere, as a child of the open span.
+
+    This is for work that overlaps, like commands running concurrently,
+    which ``span`` can't wrap one at a time. Overlapping children may add up
+    to more than their parent, the parent then has no time of its own.
+
+    Args:
+        name: what was timed
+        elapsed: the wall time it took, in seconds
+        kind: one of "phase", "command" or "subprocess"
+    """
+    if _enabled:
+        _records.append((tuple(_stack) + (_frame_name(name),), kind, elapsed))
+
+def folded():
+    """
+    Returns the recorded spans in the folded stacks format.
+
+    Every line holds a stack of span names joined by semicolons, followed by
+    the microseconds spent in the innermost span itself (its children not
+    included).
+    """
+    totals = {}
+    for path, kind, elapsed in _records:
+        totals[path] = totals.get(path, 0) + elapsed
+
+    own = dict(totals)
+    for path, elapsed in totals.items():
+        if len(path) > 1 and path[:-1] in own:
+            own[path[:-1]] -= elapsed
+
+    lines = []
+    for path in sorted(own):
+        micros = int(round(own[path] * 1e6))
+        if micros > 0:
+            lines.append('%s %d' % (';'.join(path), micros))
+
+    return lines
+
+def summary():
+    """
+    Returns the summary table as a list of lines.
+
+    Spans with the same kind and name are added up, the slowest come first.
+    """
+    rows = {}
+    for path, kind, elapsed in _records:
+        calls, total = rows.get((kind, path[-1]), (0, 0))
+        rows[(kind, path[-1])] = (calls + 1, total + elapsed)
+
+    lines = ['{0:12} {1:>6} {2:>10}  {3}'.format('kind', 'calls', 'total',
+        'name')]
+    for (kind, name), (calls, total) in sorted(rows.items(),
+            key=lambda row: -row[1][1]):
+        lines.append('{0:12} {1:6d} {2:9.3f}s  {3}'.format(kind, calls, total,
+            name))
+
+    return lines
+
+def write_folded(path):
+    """Writes the recorded spans to a folded stacks file."""
+    with open(path, 'w') as f:
+        for line in folded():
+            f.write(line + '\n')
+
+def report(profile=None, out=None):
+    """
+    Prints the summary table, and writes the folded stacks file if asked to.
+
+    Args:
+        profile: path of the folded stacks file (optional)
+        out: stream for the summary (optional, defaults to sys.stderr so it
+            stays out of piped command output)
+    """
+    out = out or sys.stderr
+
+    out.write('\nTimings (wall clock):\n')
+    for line in summary():
+        out.write('    %s\n' % line)
+
+    if profile:
+        write_folded(profile)
+        out.write('\nFlame graph data written to %s\n' % profile)
+
+def _frame_name(name):
+    # semicolons separate frames and newlines separate stacks
+    return ' '.join(str(name).replace(';', ',').split())
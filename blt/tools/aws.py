@@ -8,25 +8,56 @@ may be added down the road for other AWS services.
 
 Author: @dencold (Dennis Coldwell)
 """
+import base64
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+import datetime
 import gzip
 import hashlib
-import mimetypes
+import json
 import os
-from StringIO import StringIO
+import tempfile
+import threading
+import time
+import zlib
 
-# boto may not be available before initializing requirements, just ignore
-# the exception in that case.
-try:
-    import boto
-except ImportError:
-    pass
+from clint.textui import puts
 
+from blt import cache
 from blt.environment import Commander
-from blt.helpers import local
+from blt.helpers import local, abort, lazy_import, preload
 
-# The list of content types to gzip, add more if needed
-COMPRESSIBLE = [ 'text/plain', 'text/csv', 'application/xml',
-                'application/javascript', 'text/css' ]
+# these are only needed once a command runs and are slow to import, loading
+# them lazily keeps them off the startup path of every blt invocation. boto
+# may not be available before initializing requirements, in that case the
+# ImportError surfaces when an S3 command first uses it. brotli is optional,
+# it is only needed when the BROTLI setting is enabled.
+boto = lazy_import('boto')
+brotli = lazy_import('brotli')
+mimetypes = lazy_import('mimetypes')
+multiprocessing_pool = lazy_import('multiprocessing.pool')
+
+# The default list of content types to compress, environments can override
+# this with the COMPRESS_TYPES setting.
+COMPRESSIBLE = [ 'text/plain', 'text/csv', 'text/html', 'text/css',
+                'text/javascript', 'application/javascript',
+                'application/json', 'application/xml', 'image/svg+xml' ]
+
+# Suffix of the brotli variant that is uploaded next to a compressed key
+BROTLI_SUFFIX = '.br'
+
+# Compressed data is kept in memory up to this size before spilling to disk
+SPOOL_SIZE = 2**23
+
+# Suffix of the temporary file a download is written to until it is verified
+PARTIAL_SUFFIX = '.blt-part'
+
+# S3 returns at most this many keys per LIST request
+LIST_PAGE_SIZE = 1000
+
+# The result of streaming a file through gzip, see ``gzip_file``
+GzipResult = namedtuple('GzipResult',
+    ['fileobj', 'md5', 'size', 'source_md5', 'source_size'])
 
 class AmazonCommands(Commander):
     """
@@ -35,7 +66,16 @@ class AmazonCommands(Commander):
     Exposes general push/pull and listing functionality to S3 buckets. The
     class authenticates with AWS using the AWS_ACCESS_KEY_ID and
     AWS_SECRET_ACCESS_KEY configuration settings from blt.
+
+    The sync_s3, pull_s3 and list_changes commands accept two options:
+
+        * --stats: prints per-phase timings, request counts, bytes transferred
+          and cache hit rates once the command finishes.
+        * --metrics=path: appends the same numbers as a line of JSON to the
+          given file. the METRICS_FILE aws setting does the same for every
+          run.
     """
+    options = {'stats': False, 'metrics': None}
 
     def sync_s3(self, source_folder=None, prefix=None):
         """
@@ -51,7 +91,9 @@ class AmazonCommands(Commander):
         * adds headers and permissions
 
         It will then upload it directly to the S3 bucket that was configured
-        in the beltenv file.
+        in the beltenv file. Compression and uploads run on a pool of
+        UPLOAD_WORKERS threads, see ``CompressionPolicy`` for the settings
+        that control how (and if) files are compressed.
 
         Args:
             source_folder: a string representing the path of the folder to sync
@@ -61,35 +103,53 @@ class AmazonCommands(Commander):
                 bucket, but we want to isolate to a specific subdirectory like
                 "dencold". In this case we would pass a prefix of "dencold/"
         Usage:
-            blt e:[env] aws.sync_s3 [source_folder] [prefix]
+            blt e:[env] aws.sync_s3 [source_folder] [prefix] [--stats]
 
         Examples:
             blt e:s aws.sync_s3 - default uses config settings
             blt e:s aws.sync_s3 /Users/coldwd/my_dir - uses runtime source_folder
             blt e:s aws.sync_s3 /Users/coldwd/my_dir dencold/ - uses runtime
                 source_folder and prefix
+            blt e:s aws.sync_s3 --stats - prints transfer stats at the end
         """
+        stats = TransferStats()
         config = self._get_config(source_folder, prefix)
+        policy = config['compression']
 
-        file_hashes = get_hashes_from_dirtree(config['source_folder'])
-        s3_hashes = get_hashes_from_s3bucket(config['bucket'], config['prefix'])
+        file_hashes = get_hashes_from_dirtree(config['source_folder'],
+            stats,
+            config['cache'])
+        s3_hashes = get_hashes_from_s3bucket(config['bucket'],
+            config['prefix'],
+            policy,
+            config['cache'],
+            stats)
 
         namelist = get_changed_files(file_hashes, s3_hashes)
 
-        for name in namelist:
+        def upload(name):
             upload_file(config['source_folder'],
                 name,
                 config['bucket'],
-                config['prefix'])
+                config['prefix'],
+                policy,
+                config['cache'],
+                stats)
+
+        run_in_pool(upload, namelist, policy.workers)
+        config['cache'].save()
 
         print '%d files uploaded to bucket %s' % (len(namelist),
             config['bucket'].name)
+        self._report_stats('sync_s3', stats)
 
     def pull_s3(self, source_folder=None, prefix=None):
         """
         Pulls files from an AWS S3 bucket to a given source folder.
 
-        The logic is the same as ``sync_s3``, just in reverse.
+        The logic is the same as ``sync_s3``, just in reverse. Every file is
+        verified against its S3 hash as it is written, a download that does
+        not match is discarded and the pull is aborted.
 
         Args:
             source_folder: a string representing the path of the folder to sync
@@ -97,7 +157,7 @@ class AmazonCommands(Commander):
             prefix: the root folder within the S3 bucket to pull from.
 
         Usage:
-            blt e:[env] aws.pull_s3 [source_folder] [prefix]
+            blt e:[env] aws.pull_s3 [source_folder] [prefix] [--stats]
 
         Examples:
             blt e:s aws.pull_s3 - default uses config settings
@@ -105,20 +165,38 @@ class AmazonCommands(Commander):
             blt e:s aws.pull_s3 /Users/coldwd/my_dir dencold/ - uses runtime
                 source_folder and prefix
         """
+        stats = TransferStats()
         config = self._get_config(source_folder, prefix)
 
-        file_hashes = get_hashes_from_dirtree(config['source_folder'])
-        s3_hashes = get_hashes_from_s3bucket(config['bucket'], config['prefix'])
+        file_hashes = get_hashes_from_dirtree(config['source_folder'],
+            stats,
+            config['cache'])
+        s3_hashes = get_hashes_from_s3bucket(config['bucket'],
+            config['prefix'],
+            config['compression'],
+            config['cache'],
+            stats)
+        config['cache'].save()
 
         namelist = get_changed_files(s3_hashes, file_hashes)
 
-        for name in namelist:
-            prep_path(os.path.join(config['source_folder'], name))
-
-            download_file(config['source_folder'],
-                name,
-                s3_hashes[name]['s3_key'],
-                s3_hashes[name]['is_compressed'])
+        try:
+            for name in namelist:
+                prep_path(os.path.join(config['source_folder'], name))
+
+                download_file(config['source_folder'],
+                    name,
+                    s3_hashes[name]['s3_key'],
+                    s3_hashes[name]['is_compressed'],
+                    s3_hashes[name]['hash'],
+                    config['cache'],
+                    stats)
+        except IOError as e:
+            abort(e)
+        finally:
+            config['cache'].save()
+
+        self._report_stats('pull_s3', stats)
 
     def list_s3(self, prefix=None):
         """
@@ -153,7 +231,7 @@ class AmazonCommands(Commander):
                 we default to an empty string ''.
 
         Usage:
-            blt e:[env] aws.list_changes [source_folder] [prefix]
+            blt e:[env] aws.list_changes [source_folder] [prefix] [--stats]
 
         Examples:
             blt e:s aws.list_changes - default uses config settings
@@ -161,14 +239,53 @@ class AmazonCommands(Commander):
             blt e:s aws.list_changes /Users/coldwd/my_dir dencold/ - uses
                 runtime source_folder and prefix
         """
+        stats = TransferStats()
         config = self._get_config(source_folder, prefix)
 
-        file_hashes = get_hashes_from_dirtree(config['source_folder'])
-        s3_hashes = get_hashes_from_s3bucket(config['bucket'], config['prefix'])
+        file_hashes = get_hashes_from_dirtree(config['source_folder'],
+            stats,
+            config['cache'])
+        s3_hashes = get_hashes_from_s3bucket(config['bucket'],
+            config['prefix'],
+            config['compression'],
+            config['cache'],
+            stats)
+        config['cache'].save()
 
         for f in get_changed_files(file_hashes, s3_hashes):
             print "- %s" % f
 
+        self._report_stats('list_changes', stats)
+
+    def _report_stats(self, command, stats):
+        """
+        Prints and/or saves the transfer stats of a command.
+
+        The summary is printed if the command was run with --stats. If a
+        metrics file was given with --metrics, or the METRICS_FILE setting,
+        the stats are appended to it as a single line of JSON.
+
+        Args:
+            command: the name of the command the stats were collected for
+            stats: the TransferStats object
+        """
+        if self.opts['stats']:
+            puts('')
+            for line in stats.summary():
+                puts(line)
+
+        path = self.opts['metrics'] or self.cfg['aws'].get('METRICS_FILE')
+        if path:
+            record = stats.as_dict()
+            record.update({
+                'command': 'aws.%s' % command,
+                'environment': self.cfg.get('blt_envtype'),
+                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            })
+
+            with open(path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
     def _get_config(self, source_folder=None, prefix=None):
         """
         Populates a config dict for access to AWS.
@@ -188,12 +305,16 @@ class AmazonCommands(Commander):
                 * bucket
                 * source_folder
                 * prefix
+                * compression
+                * cache
         """
         ret_dict = dict()
 
         ret_dict['bucket'] = self._get_s3_bucket()
         ret_dict['source_folder'] = self._get_source_folder(source_folder)
         ret_dict['prefix'] = self._get_folder_prefix(prefix)
+        ret_dict['compression'] = CompressionPolicy.from_config(self.cfg['aws'])
+        ret_dict['cache'] = self._get_hash_cache(ret_dict['bucket'])
 
         return ret_dict
 
@@ -201,13 +322,39 @@ class AmazonCommands(Commander):
         """
         Retrieves the S3 bucket from the blt config file.
 
+        The bucket (and its connection) is kept in the session, so chained
+        aws commands connect only once.
+
         Returns:
             A boto S3 bucket object.
         """
         AWS_ACCESS_KEY_ID = self.cfg['aws']['AWS_ACCESS_KEY_ID']
         AWS_SECRET_ACCESS_KEY = self.cfg['aws']['AWS_SECRET_ACCESS_KEY']
-        conn = boto.connect_s3(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
-        return conn.get_bucket(self.cfg['aws']['AWS_BUCKET_NAME'])
+        bucket_name = self.cfg['aws']['AWS_BUCKET_NAME']
+
+        key = ('aws.bucket', AWS_ACCESS_KEY_ID, bucket_name)
+        if key not in self.session:
+            conn = boto.connect_s3(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+            self.session[key] = conn.get_bucket(bucket_name)
+
+        return self.session[key]
+
+    def _get_hash_cache(self, bucket):
+        """
+        Loads the local hash cache for an S3 bucket, once per session.
+
+        Args:
+            bucket: the boto S3 bucket object
+
+        Returns:
+            A HashCache object.
+        """
+        key = ('aws.hash_cache', bucket.name)
+        if key not in self.session:
+            self.session[key] = HashCache(
+                cache.cache_path('aws', '%s.json' % bucket.name))
+
+        return self.session[key]
 
     def _get_folder_prefix(self, prefix=None):
         """
@@ -249,6 +396,291 @@ class AmazonCommands(Commander):
         """
         return folder if folder else self.cfg['aws']['SOURCE_FOLDER']
 
+class CompressionPolicy(object):
+    """
+    Describes how files are compressed before they are pushed to S3.
+
+    The policy is built from the ``aws`` section of the bltenv configuration,
+    so each environment can make its own trade off between CPU time and bytes
+    on the wire. The following settings are recognized, all are optional:
+
+        * COMPRESS_TYPES: list of content types to compress. defaults to
+          ``COMPRESSIBLE``.
+        * COMPRESS_MIN_SIZE: files smaller than this many bytes are uploaded
+          uncompressed. defaults to 0.
+        * GZIP_LEVEL: gzip compression level from 1 (fastest) to 9 (smallest).
+          defaults to 9.
+        * COMPRESS_MIN_SAVINGS: fraction of the original size that gzip must
+          save for the compressed version to be uploaded, otherwise the file
+          is uploaded as-is. defaults to 0.1 (10%).
+        * BROTLI: if True, a brotli encoded variant of every compressed file
+          is uploaded next to it with a ``.br`` suffix. requires the brotli
+          package. defaults to False.
+        * BROTLI_QUALITY: brotli quality from 0 to 11. defaults to 11.
+        * UPLOAD_WORKERS: number of threads used to compress and upload
+          files. defaults to 4.
+    """
+    def __init__(self, types=None, min_size=0, gzip_level=9, min_savings=0.1,
+                 brotli=False, brotli_quality=11, workers=4):
+        self.types = COMPRESSIBLE if types is None else types
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.min_savings = min_savings
+        self.brotli = brotli
+        self.brotli_quality = brotli_quality
+        self.workers = max(1, workers)
+
+    @classmethod
+    def from_config(cls, aws_cfg):
+        """
+        Creates a policy from the ``aws`` section of a blt configuration.
+
+        Args:
+            aws_cfg: the dict of aws settings for the current environment
+
+        Returns:
+            A CompressionPolicy object.
+        """
+        policy = cls(types=aws_cfg.get('COMPRESS_TYPES'),
+                     min_size=int(aws_cfg.get('COMPRESS_MIN_SIZE', 0)),
+                     gzip_level=int(aws_cfg.get('GZIP_LEVEL', 9)),
+                     min_savings=float(aws_cfg.get('COMPRESS_MIN_SAVINGS', 0.1)),
+                     brotli=bool(aws_cfg.get('BROTLI', False)),
+                     brotli_quality=int(aws_cfg.get('BROTLI_QUALITY', 11)),
+                     workers=int(aws_cfg.get('UPLOAD_WORKERS', 4)))
+
+        if policy.brotli:
+            try:
+                preload(brotli)
+            except ImportError:
+                abort('BROTLI is enabled but the brotli package is not '
+                      'installed, try: pip install brotli')
+
+        return policy
+
+    def is_compressible(self, filetype):
+        """Returns True if files of the given content type are compressed."""
+        return filetype in self.types
+
+    def should_compress(self, filetype, size):
+        """
+        Determines if a file should be compressed before upload.
+
+        Args:
+            filetype: the content type of the file
+            size: the size of the file in bytes
+
+        Returns:
+            True if the file should be compressed.
+        """
+        return self.is_compressible(filetype) and size >= self.min_size
+
+class HashCache(object):
+    """
+    Persistent record of what blt knows about the keys in an S3 bucket.
+
+    Bucket listings only carry a key's ETag, which for a gzipped key is the
+    md5 of the compressed bytes. The cache maps those ETags to the md5 of the
+    original file and the encoding it was stored with, so we only need to
+    fetch key metadata for keys blt has never seen before.
+
+    It also remembers the md5 of local files by path, size and mtime. Files
+    that haven't changed since they were last hashed, uploaded or downloaded
+    are not read again.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.etags = {}
+        self.files = {}
+        self.dirty = False
+
+        if path:
+            data = cache.load(path, {})
+            self.etags = data.get('etags', {})
+            self.files = data.get('files', {})
+
+    def lookup(self, etag):
+        """
+        Returns the cached ``{'md5': ..., 'encoding': ...}`` dict for an
+        ETag, or None if the ETag is unknown.
+        """
+        return self.etags.get(etag.strip('"'))
+
+    def record(self, etag, md5, encoding):
+        """
+        Records the original md5 and encoding for an ETag.
+
+        Args:
+            etag: the S3 ETag of the key (quoted or not)
+            md5: the md5 hexdigest of the uncompressed content
+            encoding: either 'gzip' or 'identity'
+        """
+        self.etags[etag.strip('"')] = {'md5': md5, 'encoding': encoding}
+        self.dirty = True
+
+    def lookup_file(self, path, stat=None):
+        """
+        Returns the cached md5 of a local file, or None if the file is unknown
+        or has changed since it was recorded.
+
+        Args:
+            path: the path of the local file
+            stat: the result of ``os.stat`` for the file (optional)
+        """
+        stat = stat or os.stat(path)
+        entry = self.files.get(os.path.abspath(path))
+
+        if entry and entry[:2] == [stat.st_size, stat.st_mtime]:
+            return entry[2]
+
+        return None
+
+    def record_file(self, path, md5, stat=None):
+        """
+        Records the md5 of a local file along with its current size and mtime.
+        """
+        stat = stat or os.stat(path)
+        self.files[os.path.abspath(path)] = [stat.st_size, stat.st_mtime, md5]
+        self.dirty = True
+
+    def save(self):
+        """Writes the cache back to disk if anything was recorded."""
+        if self.path and self.dirty:
+            cache.dump(self.path, {'etags': self.etags, 'files': self.files})
+            self.dirty = False
+
+class TransferStats(object):
+    """
+    Collects timings, request counts and byte totals for an aws command.
+
+    Phase timings are exclusive, time spent in a nested phase (hashing while
+    walking the source tree, for instance) only counts against the inner
+    phase. Phases that run on the worker pool add up the time of every
+    thread, so they can exceed the wall time of the command.
+    """
+    # the order phases are reported in
+    PHASES = ['walk', 'hash', 'list', 'head', 'compress', 'upload', 'download']
+
+    # the order byte counters are reported in
+    BYTES = ['read', 'compressed', 'sent', 'received', 'written']
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = defaultdict(float)
+        self.requests = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.caches = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def phase(self, name):
+        """Times the wrapped block as part of the given phase."""
+        stack = self._local.__dict__.setdefault('stack', [])
+        nested = [0.0]
+        stack.append(nested)
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+
+            with self._lock:
+                self.phases[name] += elapsed - nested[0]
+
+    def request(self, method, count=1):
+        """Counts S3 requests of the given type (LIST, HEAD, GET, PUT)."""
+        with self._lock:
+            self.requests[method] += count
+
+    def add_bytes(self, kind, count):
+        """Adds to one of the byte counters, see ``BYTES``."""
+        with self._lock:
+            self.bytes[kind] += count
+
+    def cache_lookup(self, cache_name, hit):
+        """Records a hit or a miss on one of blt's caches."""
+        with self._lock:
+            self.caches[cache_name]['hits' if hit else 'misses'] += 1
+
+    @property
+    def wall_time(self):
+        return time.time() - self.started
+
+    def as_dict(self):
+        caches = {}
+        for name, counts in self.caches.items():
+            lookups = counts['hits'] + counts['misses']
+            caches[name] = dict(counts,
+                hit_rate=float(counts['hits']) / lookups if lookups else None)
+
+        return {
+            'wall_time': self.wall_time,
+            'phases': dict(self.phases),
+            'requests': dict(self.requests),
+            'bytes': dict(self.bytes),
+            'caches': caches,
+        }
+
+    def summary(self):
+        """Returns the stats as a list of human readable lines."""
+        stats = self.as_dict()
+        lines = ['-- Transfer Stats ' + '-' * 58,
+                 '{0:12} {1:.3f}s'.format('wall time', stats['wall_time'])]
+
+        for name in self.PHASES:
+            if name in stats['phases']:
+                lines.append('{0:12} {1:.3f}s'.format(name,
+                                                      stats['phases'][name]))
+
+        lines.append('{0:12} {1}'.format('requests', ' '.join(
+            '%s=%d' % item for item in sorted(stats['requests'].items()))
+            or 'none'))
+        lines.append('{0:12} {1}'.format('bytes', ', '.join(
+            '%s %s' % (kind, format_bytes(stats['bytes'][kind]))
+            for kind in self.BYTES if kind in stats['bytes']) or 'none'))
+
+        for name, cache_stats in sorted(stats['caches'].items()):
+            lines.append('{0:12} {1} hits, {2} misses ({3:.0%})'.format(
+                name + ' cache',
+                cache_stats['hits'],
+                cache_stats['misses'],
+                cache_stats['hit_rate'] or 0))
+
+        return lines
+
+def format_bytes(count):
+    """Formats a byte count for humans, e.g. 2048 => 2KB."""
+    for unit in ['B', 'KB', 'MB']:
+        if count < 1024:
+            return '%d%s' % (count, unit)
+        count /= 1024.0
+
+    return '%.1fGB' % count
+
+def run_in_pool(func, items, workers):
+    """
+    Calls ``func`` for every item on a pool of ``workers`` threads.
+
+    gzip and brotli release the GIL while compressing and the uploads are
+    network bound, so threads are enough to keep higher compression levels
+    from slowing down a sync.
+    """
+    if workers <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    pool = multiprocessing_pool.ThreadPool(min(workers, len(items)))
+    try:
+        # a plain map() blocks signals in python 2, using get() with a
+        # timeout keeps the pool interruptible with ctrl-c.
+        return pool.map_async(func, items).get(2**31)
+    finally:
+        pool.terminate()
+
 def compute_md5(filename, block_size=2**20):
     md5 = hashlib.md5()
 
@@ -261,38 +693,66 @@ def compute_md5(filename, block_size=2**20):
 
     return md5.hexdigest()
 
-def get_hashes_from_dirtree(src_folder):
+def get_hashes_from_dirtree(src_folder, stats=None, hash_cache=None):
+    stats = stats or TransferStats()
+    hash_cache = hash_cache or HashCache()
     ret = dict()
-    for root, dirs, files in os.walk(src_folder):
-        if files and not '.webassets-cache' in root:
-            path = os.path.relpath(root, src_folder)
 
-            for f in files:
-                name = os.path.normpath(os.path.join(path, f))
+    with stats.phase('walk'):
+        for root, dirs, files in os.walk(src_folder):
+            if files and not '.webassets-cache' in root:
+                path = os.path.relpath(root, src_folder)
 
-                # skip any files with a resource fork (such as Icon\r)
-                if name.endswith('\r'):
-                    continue
+                for f in files:
+                    name = os.path.normpath(os.path.join(path, f))
 
-                # aws only provides md5 hashes in their boto api, let's
-                # calculate our local md5 and compare to see if anything
-                # has changed
-                local_md5 = compute_md5(os.path.join(src_folder, name))
+                    # skip any files with a resource fork (such as Icon\r)
+                    # and downloads that are still in progress
+                    if name.endswith('\r') or name.endswith(PARTIAL_SUFFIX):
+                        continue
 
-                ret[name] = {'file_path': os.path.join(src_folder, name),
-                            'hash': local_md5}
+                    # aws only provides md5 hashes in their boto api, let's
+                    # calculate our local md5 and compare to see if anything
+                    # has changed
+                    file_path = os.path.join(src_folder, name)
+                    stat = os.stat(file_path)
+                    local_md5 = hash_cache.lookup_file(file_path, stat)
+                    stats.cache_lookup('file', local_md5 is not None)
+
+                    if local_md5 is None:
+                        with stats.phase('hash'):
+                            local_md5 = compute_md5(file_path)
+                        stats.add_bytes('read', stat.st_size)
+                        hash_cache.record_file(file_path, local_md5, stat)
+
+                    ret[name] = {'file_path': file_path,
+                                'hash': local_md5}
 
     return ret
 
-def get_hashes_from_s3bucket(bucket, prefix=''):
+def get_hashes_from_s3bucket(bucket, prefix='', policy=None, hash_cache=None,
+                             stats=None):
+    policy = policy or CompressionPolicy()
+    hash_cache = hash_cache or HashCache()
+    stats = stats or TransferStats()
+
+    with stats.phase('list'):
+        keys = list(list_keys(bucket, prefix, stats))
+        names = set(key.key for key in keys)
+
     ret = dict()
-    for key in bucket.list(prefix=prefix):
+    for key in keys:
         compressed = False
 
         # ignore Icon files, they have a resource fork that screws things up
         if os.path.basename(key.key) in ['Icon\n']:
             continue
 
+        # brotli variants are managed alongside their source key, they are
+        # not files in their own right.
+        if is_brotli_variant(key.key, names):
+            continue
+
         # [dmc] boto is really really shitty.  the iterated keys coming from
         # bucket.list do not include metadata (whereas if you issue a
         # bucket.get_key() you *do* get your metadata) extremely frustrating
@@ -300,16 +760,30 @@ def get_hashes_from_s3bucket(bucket, prefix=''):
         # data and then pull the key directly to avoid this.  blarg.
         # more info on the failings of bucket.list:
         # https://github.com/boto/boto/blob/2.9.1/boto/s3/bucket.py#L228
+        #
+        # the compression decision is recorded in the key metadata on upload
+        # and remembered in the hash cache, so we only have to pull the key
+        # for ETags we have never seen.
         filetype, encoding = mimetypes.guess_type(key.key)
-        if filetype in COMPRESSIBLE:
-
-            # explicity get the key so we can get at metadata
-            md_key = bucket.get_key(key.key)
-            if is_key_compressed(md_key):
-                key_md5 = md_key.get_metadata('uncompressed_md5')
-                compressed = True
-            else:
-                key_md5 = key.etag.strip('"')
+        if policy.is_compressible(filetype):
+            info = hash_cache.lookup(key.etag)
+            stats.cache_lookup('etag', info is not None)
+
+            if info is None:
+                # explicity get the key so we can get at metadata
+                with stats.phase('head'):
+                    md_key = bucket.get_key(key.key)
+                stats.request('HEAD')
+                if is_key_compressed(md_key):
+                    info = {'md5': md_key.get_metadata('uncompressed_md5'),
+                            'encoding': 'gzip'}
+                else:
+                    info = {'md5': key.etag.strip('"'), 'encoding': 'identity'}
+
+                hash_cache.record(key.etag, info['md5'], info['encoding'])
+
+            key_md5 = info['md5']
+            compressed = info['encoding'] == 'gzip'
         else:
             # note that the HTTP ETag standard requires a quoted
             # value.  our local md5 is not quoted, this is why we
@@ -325,6 +799,27 @@ def get_hashes_from_s3bucket(bucket, prefix=''):
 
     return ret
 
+def list_keys(bucket, prefix='', stats=None):
+    """
+    Iterates over the keys of a bucket, a LIST request per page.
+
+    Unlike ``bucket.list`` this counts the requests as they are made.
+    """
+    stats = stats or TransferStats()
+    marker = ''
+
+    while True:
+        page = bucket.get_all_keys(prefix=prefix, marker=marker,
+                                   max_keys=LIST_PAGE_SIZE)
+        stats.request('LIST')
+
+        for key in page:
+            yield key
+
+        if not page.is_truncated or not len(page):
+            break
+        marker = page[-1].key
+
 def handle_prefix(path, prefix):
     if prefix:
         # we must remove prefix from our key so we can properly compare
@@ -353,20 +848,195 @@ def get_changed_files(src_hashes, target_hashes):
 def is_key_compressed(key):
     return key.get_metadata('gzipped') == 'true'
 
-def compress_and_upload(key, filename, headers):
-    compressed = StringIO()
-    headers['Content-Encoding'] = 'gzip'
+def is_brotli_variant(keyname, keynames):
+    return (keyname.endswith(BROTLI_SUFFIX) and
+            keyname[:-len(BROTLI_SUFFIX)] in keynames)
+
+class _HashingWriter(object):
+    """
+    File-like wrapper that hashes and counts everything written through it.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+class _GunzipWriter(object):
+    """
+    File-like wrapper that decompresses gzipped data as it is written.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        # 16 + MAX_WBITS tells zlib to expect a gzip header and trailer
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
-    with open(filename, 'r') as f_in:
-        gz = gzip.GzipFile(fileobj=compressed, mode='wb')
-        gz.writelines(f_in)
-        gz.close()
+    def write(self, data):
+        self.fileobj.write(self.decompressor.decompress(data))
 
+    def flush(self):
+        self.fileobj.flush()
+
+    def finish(self):
+        """Writes out whatever is left in the decompressor."""
+        self.fileobj.write(self.decompressor.flush())
+
+def md5_header(hexdigest):
+    """
+    Returns the (hexdigest, base64 digest) pair boto expects for its md5
+    argument, which it sends as the Content-MD5 header.
+    """
+    return (hexdigest, base64.b64encode(hexdigest.decode('hex')))
+
+def gzip_file(filename, level=9, min_savings=0.0, block_size=2**20):
+    """
+    Streams a file through gzip, measuring the savings as it goes.
+
+    The compressed output is written to a spooled temporary file, so memory
+    use stays bounded for large files. Once the first block has been
+    compressed we check the ratio and bail out early if the data is clearly
+    not compressible (images hiding behind a text extension, minified and
+    already packed assets, etc.), the final ratio is checked at the end.
+
+    Args:
+        filename: path of the file to compress
+        level: the gzip compression level
+        min_savings: the fraction of the original size compression must save
+        block_size: the number of bytes to read at a time
+
+    The source is hashed in the same pass, bailing out only stops the
+    compression, so the source md5 is at hand for an uncompressed upload
+    without reading the file again.
+
+    Returns:
+        A GzipResult with the rewound compressed file. If compression saved
+        less than min_savings, its fileobj and md5 are None and only the
+        source fields are set.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    out = _HashingWriter(spooled)
+    source_md5 = hashlib.md5()
+    source_size = 0
+
+    # a fixed mtime and no filename in the gzip header keep the output, and
+    # therefore the S3 ETag, stable for identical content.
+    gz = gzip.GzipFile(filename='', fileobj=out, mode='wb',
+                       compresslevel=level, mtime=0)
+
+    bailed = False
+    with open(filename, 'rb') as f_in:
+        while True:
+            data = f_in.read(block_size)
+            if not data:
+                break
+
+            source_md5.update(data)
+            source_size += len(data)
+            if bailed:
+                continue
+
+            gz.write(data)
+            if source_size == len(data) and len(data) == block_size:
+                gz.flush(zlib.Z_SYNC_FLUSH)
+                bailed = savings(source_size, out.size) < min_savings
+
+    gz.close()
+
+    if bailed or savings(source_size, out.size) < min_savings:
+        spooled.close()
+        return GzipResult(None, None, None, source_md5.hexdigest(),
+                          source_size)
+
+    spooled.seek(0)
+    return GzipResult(spooled, out.md5.hexdigest(), out.size,
+                      source_md5.hexdigest(), source_size)
+
+def savings(original_size, compressed_size):
+    """Returns the fraction of ``original_size`` saved by compression."""
+    if not original_size:
+        return 0.0
+
+    return 1.0 - float(compressed_size) / original_size
+
+def compress_and_upload(key, filename, headers, level=9, min_savings=0.0,
+                        stats=None):
+    """
+    Gzips a file and uploads it to S3, unless compression does not pay off.
+
+    Args:
+        key: the boto key to upload to
+        filename: path of the file to upload
+        headers: dict of HTTP headers for the upload
+        level: the gzip compression level
+        min_savings: the fraction of the original size compression must save
+        stats: TransferStats to record the work in (optional)
+
+    Returns:
+        The GzipResult from ``gzip_file``. Nothing is uploaded if its md5 is
+        None, the savings were below min_savings then.
+    """
+    stats = stats or TransferStats()
+
+    with stats.phase('compress'):
+        result = gzip_file(filename, level, min_savings)
+
+    stats.add_bytes('read', result.source_size)
+    if result.md5 is None:
+        return result
+
+    stats.add_bytes('compressed', result.size)
+
+    headers = dict(headers, **{'Content-Encoding': 'gzip'})
     key.set_metadata('gzipped', 'true')
-    key.set_metadata('uncompressed_md5', compute_md5(filename))
-    key.set_contents_from_string(compressed.getvalue(), headers)
+    key.set_metadata('uncompressed_md5', result.source_md5)
+
+    # S3 verifies the upload against the md5 we computed while compressing
+    try:
+        with stats.phase('upload'):
+            key.set_contents_from_file(result.fileobj, headers,
+                                       md5=md5_header(result.md5))
+    finally:
+        result.fileobj.close()
+
+    stats.request('PUT')
+    stats.add_bytes('sent', result.size)
+
+    return result
+
+def brotli_and_upload(key, filename, headers, quality=11, stats=None,
+                      source_md5=None):
+    stats = stats or TransferStats()
+    headers = dict(headers, **{'Content-Encoding': 'br'})
+
+    with stats.phase('compress'):
+        with open(filename, 'rb') as f_in:
+            compressed = brotli.compress(f_in.read(), quality=quality)
+
+    stats.add_bytes('read', os.path.getsize(filename))
+    stats.add_bytes('compressed', len(compressed))
+
+    key.set_metadata('brotli', 'true')
+    key.set_metadata('uncompressed_md5', source_md5 or compute_md5(filename))
 
-def upload_file(source_folder, name, bucket, prefix=''):
+    with stats.phase('upload'):
+        key.set_contents_from_string(compressed, headers,
+            md5=md5_header(hashlib.md5(compressed).hexdigest()))
+
+    stats.request('PUT')
+    stats.add_bytes('sent', len(compressed))
+
+def upload_file(source_folder, name, bucket, prefix='', policy=None,
+                hash_cache=None, stats=None):
+    policy = policy or CompressionPolicy()
+    hash_cache = hash_cache or HashCache()
+    stats = stats or TransferStats()
     filetype, encoding = mimetypes.guess_type(name)
     filetype = filetype or 'application/octet-stream'
     headers = { 'Content-Type': filetype, 'x-amz-acl': 'public-read' }
@@ -401,33 +1071,130 @@ def upload_file(source_folder, name, bucket, prefix=''):
     key = bucket.new_key(prefix + name)
     filename = os.path.join(source_folder, name)
 
-    if filetype in COMPRESSIBLE:
-        states.append('gzipped')
-        compress_and_upload(key, filename, headers)
+    compressed = None
+    if policy.should_compress(filetype, os.path.getsize(filename)):
+        compressed = compress_and_upload(key,
+            filename,
+            headers,
+            policy.gzip_level,
+            policy.min_savings,
+            stats)
+
+    if compressed and compressed.md5:
+        states.append('gzipped, %d%% smaller' %
+            (100 * savings(compressed.source_size, compressed.size)))
+        hash_cache.record(compressed.md5, compressed.source_md5, 'gzip')
+
+        if policy.brotli:
+            states.append('brotli')
+            brotli_and_upload(bucket.new_key(prefix + name + BROTLI_SUFFIX),
+                filename,
+                headers,
+                policy.brotli_quality,
+                stats,
+                compressed.source_md5)
     else:
-        with open(filename, 'rb') as f:
-            key.set_contents_from_file(f, headers)
-
-    states = ', '.join(states)
-    print '- %s (%s)' % (name, states)
-
-def download_file(source_folder, name, key, compressed):
+        # the md5 was computed when the source tree was hashed (or while
+        # trying to compress), it goes out as the Content-MD5 header so S3
+        # can verify the upload
+        stat = os.stat(filename)
+        md5 = hash_cache.lookup_file(filename, stat)
+        if md5 is None and compressed:
+            md5 = compressed.source_md5
+            hash_cache.record_file(filename, md5, stat)
+        elif md5 is None:
+            with stats.phase('hash'):
+                md5 = compute_md5(filename)
+            stats.add_bytes('read', stat.st_size)
+            hash_cache.record_file(filename, md5, stat)
+
+        if policy.is_compressible(filetype):
+            # record that we decided against compression, so readers of the
+            # key don't have to guess.
+            states.append('not compressed')
+            key.set_metadata('gzipped', 'false')
+            hash_cache.record(md5, md5, 'identity')
+
+        with stats.phase('upload'):
+            with open(filename, 'rb') as f:
+                key.set_contents_from_file(f, headers, md5=md5_header(md5))
+
+        # the upload pass shows up as sent, not read again
+        stats.request('PUT')
+        stats.add_bytes('sent', stat.st_size)
+
+    # the upload runs on a worker thread, puts writes the whole line at once
+    # so output from concurrent uploads does not get interleaved.
+    puts('- %s (%s)' % (name, ', '.join(states)))
+
+def download_file(source_folder, name, key, compressed, md5=None,
+                  hash_cache=None, stats=None):
+    """
+    Downloads a key from S3, verifying it as it is written.
+
+    The data is streamed to a temporary file next to the target, gunzipping
+    on the fly for compressed keys, while the md5 of both the received bytes
+    and the written file are computed. The temporary file only replaces the
+    target once both match, and the verified md5 is recorded in the hash
+    cache so the next sync doesn't have to read the file again.
+
+    Args:
+        source_folder: the folder to download into
+        name: the path of the file relative to source_folder
+        key: the boto key to download
+        compressed: True if the key is stored gzipped
+        md5: the expected md5 of the uncompressed file (optional)
+        hash_cache: HashCache to record the downloaded file in (optional)
+        stats: TransferStats to record the work in (optional)
+
+    Raises:
+        IOError: if the downloaded data doesn't match the expected hashes.
+    """
+    hash_cache = hash_cache or HashCache()
+    stats = stats or TransferStats()
     path = os.path.join(source_folder, name)
 
-    if compressed:
-        filestr = StringIO(key.get_contents_as_string())
-        with open(path, 'w') as fileptr:
-            gz = gzip.GzipFile(fileobj=filestr, mode='rb')
-            file_content = gz.read()
-            fileptr.write(file_content)
-            gz.close()
-
-        print 'downloaded: %s' % name
-    elif os.path.basename(path):
-        with open(path, 'w') as fileptr:
-            key.get_contents_to_file(fileptr)
-
-        print 'downloaded: %s' % name
+    if not os.path.basename(path):
+        return
+
+    partial = path + PARTIAL_SUFFIX
+
+    try:
+        with stats.phase('download'):
+            with open(partial, 'wb') as fileptr:
+                written = _HashingWriter(fileptr)
+                gunzip = _GunzipWriter(written) if compressed else None
+                received = _HashingWriter(gunzip or written)
+
+                key.get_contents_to_file(received)
+                if gunzip:
+                    gunzip.finish()
+
+        stats.request('GET')
+        stats.add_bytes('received', received.size)
+        stats.add_bytes('written', written.size)
+
+        # the ETag of a multipart upload is not an md5 of the content
+        etag = (key.etag or '').strip('"')
+        if etag and '-' not in etag and received.md5.hexdigest() != etag:
+            raise IOError('%s is corrupt, received md5 %s but S3 sent %s' %
+                (name, received.md5.hexdigest(), etag))
+
+        if md5 and written.md5.hexdigest() != md5:
+            raise IOError('%s is corrupt, wrote md5 %s but expected %s' %
+                (name, written.md5.hexdigest(), md5))
+
+        os.rename(partial, path)
+    except zlib.error as e:
+        os.unlink(partial)
+        raise IOError('%s is corrupt, could not gunzip it: %s' % (name, e))
+    except:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+
+    hash_cache.record_file(path, written.md5.hexdigest())
+    print 'downloaded: %s' % name
 
 def prep_path(path):
     dirname = os.path.dirname(path)
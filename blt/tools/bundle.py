@@ -42,8 +42,8 @@ class BundleCommands(Commander):
         self._prep_bundle_dir(path.split(fixture_file)[0])
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
-            local('python manage.py bundle dump %s %s' % (deal_slug,
-                                                          fixture_file))
+            local(['python', 'manage.py', 'bundle', 'dump', deal_slug,
+                   fixture_file])
 
     def load(self, deal_slug, database):
         """
@@ -69,7 +69,7 @@ class BundleCommands(Commander):
         fixture_file = self._fixture_file(deal_slug)
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
-            local('python manage.py bundle load %s' % fixture_file)
+            local(['python', 'manage.py', 'bundle', 'load', fixture_file])
 
     def delete(self, deal_slug, database):
         """
@@ -93,7 +93,7 @@ class BundleCommands(Commander):
         environ['DATABASE_URL'] = self.cfg['bundle'][database]
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
-            local('python manage.py bundle delete %s' % (deal_slug))
+            local(['python', 'manage.py', 'bundle', 'delete', deal_slug])
 
     def _fixture_file(self, deal_slug):
         """
@@ -40,12 +40,12 @@ class DjangoCommands(Commander):
         django_root = self.cfg['django']['DJANGO_ROOT']
 
         # install packages from pip's requirements.txt
-        local('pip install -r requirements.txt')
+        local(['pip', 'install', '-r', 'requirements.txt'])
 
         with cd(django_root):
             try:
-                local('python manage.py syncdb')
-                local('python manage.py migrate')
+                local(['python', 'manage.py', 'syncdb'])
+                local(['python', 'manage.py', 'migrate'])
             except:
                 msg = '\n'.join(["ERROR: Python couldn't find django.  Are you in a virtualenv?"
                                 , "Try workon MY_SWEET_VIRTENV_HERE"])
@@ -53,13 +53,13 @@ class DjangoCommands(Commander):
 
         with cd(django_root):
             # Load dev data
-            local('python manage.py loaddata initial')
+            local(['python', 'manage.py', 'loaddata', 'initial'])
 
             # collect static files
-            local('python manage.py collectstatic --noinput')
+            local(['python', 'manage.py', 'collectstatic', '--noinput'])
 
             # Compile static asset bundles
-            local('python manage.py assets build')
+            local(['python', 'manage.py', 'assets', 'build'])
 
     def runserver(self, ip='127.0.0.1', port='8000'):
         """
@@ -80,27 +80,27 @@ class DjangoCommands(Commander):
         with cd(self.cfg['django']['DJANGO_ROOT']):
             print "Setting ASSETS_DEBUG=True"
             environ['ASSETS_DEBUG'] = "True"
-            local('python manage.py runserver %s:%s' % (ip, port))
+            local(['python', 'manage.py', 'runserver', '%s:%s' % (ip, port)])
 
     def gunicorn_server(self, *args):
         "Runs Gunicorn server for pseudo-production testing."
         project = self.cfg['django']['PROJECT_DIR']
-        args_str = ''.join(args)
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
-            flag_str = '%s --access-logfile=- --error-logfile=-' % args_str
-            local('gunicorn %s %s.wsgi:application' % (flag_str, project))
+            local(['gunicorn'] + list(args) +
+                  ['--access-logfile=-', '--error-logfile=-',
+                   '%s.wsgi:application' % project])
 
     def collectstatic(self):
         """Runs django's collectstatic and the webassets build in one command"""
         with cd(self.cfg['django']['DJANGO_ROOT']):
-            local('python manage.py collectstatic --noinput')
-            local('python manage.py assets build')
+            local(['python', 'manage.py', 'collectstatic', '--noinput'])
+            local(['python', 'manage.py', 'assets', 'build'])
 
     def shell(self):
         """Opens a session to django's shell"""
         with cd(self.cfg['django']['DJANGO_ROOT']):
-            local('python manage.py shell')
+            local(['python', 'manage.py', 'shell'])
 
     def test(self, *apps):
         """
@@ -133,12 +133,11 @@ class DjangoCommands(Commander):
         # bad test results.  example: you import a module in your test case,
         # but have deleted it on the filesystem.  if the .pyc file still
         # exists, the test will still pass.
-        local('find . -name "*.pyc" -exec rm -f {} \;')
+        local(['find', '.', '-name', '*.pyc', '-delete'])
 
         test_names = []
         app_names = []
         flags = []
-        args = []
 
         for n in apps:
             if n.startswith('-'):
@@ -150,11 +149,10 @@ class DjangoCommands(Commander):
             else:
                 app_names.append(n)
 
-        args.append(' '.join(flags))
-        args.append(' '.join(app_names))
-        args.append('-k "%s"' % ' and '.join(test_names) if len(test_names) else '')
-        command = 'py.test --ds {0}.settings {1}'.format(project,
-                                                         ' '.join(args)).strip()
+        command = ['py.test', '--ds', '%s.settings' % project] + flags + app_names
+
+        if test_names:
+            command += ['-k', ' and '.join(test_names)]
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
             local(command)
@@ -180,12 +178,10 @@ class DjangoCommands(Commander):
         # bad test results.  example: you import a module in your test case,
         # but have deleted it on the filesystem.  if the .pyc file still
         # exists, the test will still pass.
-        local('find . -name "*.pyc" -exec rm -f {} \;')
+        local(['find', '.', '-name', '*.pyc', '-delete'])
 
         app_names = []
         flags = []
-        pytest_args = []
-        cov_args = []
 
         for n in apps:
             if n.startswith('-'):
@@ -193,26 +189,17 @@ class DjangoCommands(Commander):
             else:
                 app_names.append(n)
 
-        # setup py.test args
-        pytest_args = ' '.join(app_names)
-        cov_args = ','.join(app_names)
+        cmd = ['coverage', 'run']
 
         if app_names:
-            cmd = 'coverage run --source {0} {1} -m py.test --ds {2}.settings {3}'.format(
-                cov_args,
-                ' '.join(flags),
-                project,
-                pytest_args).strip()
-        else:
-            cmd = 'coverage run {0} -m py.test --ds {1}.settings'.format(
-                ' '.join(flags),
-                project).strip()
+            cmd += ['--source', ','.join(app_names)]
 
+        cmd += flags + ['-m', 'py.test', '--ds', '%s.settings' % project] + app_names
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
             local(cmd)
-            local('coverage report')
-            local('coverage html -d coverage_html')
+            local(['coverage', 'report'])
+            local(['coverage', 'html', '-d', 'coverage_html'])
 
     def covrpt(self):
         """
@@ -224,4 +211,4 @@ class DjangoCommands(Commander):
         project = self.cfg['django']['PROJECT_DIR']
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
-            local('open coverage_html/index.html')
+            local(['open', 'coverage_html/index.html'])
@@ -4,24 +4,476 @@ Toolset module for interfacing with Heroku.
 Makes heavy use of the heroku toolbelt and makes several of the common
 operations more user friendly and intuitive.
 
+Commands that boil down to a single API call (info, config, addons, domains,
+destroy) talk to the Heroku Platform API directly when an API token is
+around, which saves starting the toolbelt for each of them. The token comes
+from HEROKU_API_KEY or the ~/.netrc entry ``heroku login`` writes. Without one
+(or with ``"api": False`` in the heroku config) the toolbelt is used.
+
+The listings (info, config, addons and domains) are cached per app for
+``CACHE_TTL`` seconds, as scripts and shell prompts ask for them all the time.
+``--refresh`` skips the cache, and blt drops the cached listings itself
+whenever it changes them. The config holds secrets, so it is only cached in
+memory, for the commands of one blt invocation, and ``config get`` always
+asks heroku. Toolbelt listings shown on a terminal aren't cached either, the
+toolbelt prints them itself, in its own layout and colors.
+
 Author: @dencold (Dennis Coldwell)
 """
+from contextlib import contextmanager
+import json
+import netrc
+import os
+import Queue
+import re
+import shlex
+import socket
+import sys
+import time
+import urllib
+import urlparse
+
 from clint.textui.colored import blue, red, green
 
+from blt import cache, parallel, timing
 from blt.environment import Commander
-from blt.helpers import local, prompt, abort
+from blt.helpers import (local, local_lines, local_many, prompt, abort,
+    lazy_import)
+
+# only the API client needs these, and they are slow to import (httplib
+# drags in ssl)
+httplib = lazy_import('httplib')
+multiprocessing_pool = lazy_import('multiprocessing.pool')
+
+# how many heroku toolbelt commands (or API calls) a batch runs at once
+BATCH_LIMIT = 4
+
+# the toolbelt asks for confirmation on these, so they run one at a time
+INTERACTIVE_ACTIONS = ('remove',)
+
+# the Heroku Platform API, HEROKU_API_URL points blt at another one
+DEFAULT_API_URL = 'https://api.heroku.com'
+
+# seconds a listing is served from the cache, "cache_ttl" in the heroku
+# config overrides it (0 turns the cache off)
+CACHE_TTL = 60
+
+# listings holding secrets, which are never written to the disk cache
+PRIVATE_LISTINGS = ('config',)
+
+# what git push --progress says it sent, e.g. "(3/3), 1.02 MiB | 4.00 MiB/s"
+PUSH_SIZE = re.compile(r'Writing objects:.*\(\d+/\d+\), ([\d.]+ (?:bytes|[KMGT]iB))')
+
+# requests that may be sent again when it isn't known whether the first one
+# made it, doing them twice ends up the same as doing them once (blt only
+# PATCHes to set values)
+IDEMPOTENT_METHODS = ('GET', 'PATCH', 'DELETE')
+
+# fields of an app that heroku.info shows
+APP_INFO_FIELDS = (
+      ('Git URL', ('git_url',))
+    , ('Owner', ('owner', 'email'))
+    , ('Region', ('region', 'name'))
+    , ('Stack', ('stack', 'name'))
+    , ('Web URL', ('web_url',))
+)
+
+
+class HerokuAPIError(Exception):
+    """Raised when the Heroku Platform API answers with an error."""
+    def __init__(self, status, message):
+        Exception.__init__(self, '%s (HTTP %d)' % (message, status))
+        self.status = status
+
+
+class HerokuAPI(object):
+    """
+    Minimal client for the Heroku Platform API.
+
+    All requests go over a single keep-alive connection, which is opened on
+    the first request and reopened if the server closed it in between.
+
+    Args:
+        token: the API token
+        url: base url of the API (optional)
+
+    Usage:
+        api = HerokuAPI(api_token())
+        api.config_vars('pubweb-staging')
+    """
+    def __init__(self, token, url=DEFAULT_API_URL):
+        parts = urlparse.urlsplit(url)
+
+        self.token = token
+        self.url = url
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.connection = None
+        self.connections = 0
+
+    def request(self, method, path, body=None):
+        """
+        Sends a request to the API.
+
+        Args:
+            method: the HTTP method
+            path: the path of the resource, e.g. /apps/pubweb-staging
+            body: data to send as json (optional)
+
+        Returns:
+            The decoded json response.
+
+        Raises:
+            HerokuAPIError: the API answered with an error status.
+        """
+        headers = {
+              'Accept': 'application/vnd.heroku+json; version=3'
+            , 'Authorization': 'Bearer %s' % self.token
+            , 'Content-Type': 'application/json'
+        }
+        payload = json.dumps(body) if body is not None else None
+
+        reused = self.connection is not None
+        sent = []
+        try:
+            response, data = self._send(method, path, payload, headers, sent)
+        except (httplib.HTTPException, socket.error):
+            # the server may have closed the connection while it sat idle,
+            # a fresh one gets one more try. a request that went out may
+            # have been acted on though, only idempotent ones are repeated
+            self.close()
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+            response, data = self._send(method, path, payload, headers)
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get('message')
+            except (ValueError, AttributeError):
+                message = data
+            raise HerokuAPIError(response.status, message or response.reason)
+
+        return json.loads(data) if data else None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def copy(self):
+        """Returns a client for the same API, with a connection of its own."""
+        return HerokuAPI(self.token, self.url)
+
+    def app(self, app):
+        return self.request('GET', _path('apps', app))
+
+    def delete_app(self, app):
+        return self.request('DELETE', _path('apps', app))
+
+    def config_vars(self, app):
+        return self.request('GET', _path('apps', app, 'config-vars'))
+
+    def update_config_vars(self, app, changes):
+        """Sets config vars, the ones mapped to None are removed."""
+        return self.request('PATCH', _path('apps', app, 'config-vars'), changes)
+
+    def addons(self, app):
+        return self.request('GET', _path('apps', app, 'addons'))
+
+    def create_addon(self, app, plan):
+        return self.request('POST', _path('apps', app, 'addons'),
+            {'plan': plan})
+
+    def update_addon(self, app, addon, plan):
+        return self.request('PATCH', _path('apps', app, 'addons', addon),
+            {'plan': plan})
+
+    def delete_addon(self, app, addon):
+        return self.request('DELETE', _path('apps', app, 'addons', addon))
+
+    def domains(self, app):
+        return self.request('GET', _path('apps', app, 'domains'))
+
+    def create_domain(self, app, hostname):
+        return self.request('POST', _path('apps', app, 'domains'),
+            {'hostname': hostname})
+
+    def delete_domain(self, app, hostname):
+        return self.request('DELETE', _path('apps', app, 'domains', hostname))
+
+    def _send(self, method, path, payload, headers, sent=None):
+        """
+        Makes a request and reads the response. ``sent`` (a list) gets an
+        entry once the request went out.
+        """
+        if self.connection is None:
+            self.connection = self._connect()
+            self.connections += 1
+
+        self.connection.request(method, path, payload, headers)
+        if sent is not None:
+            sent.append(True)
+
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc)
+
+        return httplib.HTTPConnection(self.netloc)
+
+
+def api_token(url=DEFAULT_API_URL):
+    """
+    Finds the Heroku API token.
+
+    Returns:
+        The token from HEROKU_API_KEY, or the password of the ~/.netrc entry
+        for the API host, None if there is neither.
+    """
+    if os.environ.get('HEROKU_API_KEY'):
+        return os.environ['HEROKU_API_KEY']
+
+    try:
+        auth = netrc.netrc().authenticators(urlparse.urlsplit(url).hostname)
+    except (IOError, netrc.NetrcParseError):
+        return None
+
+    return auth[2] if auth else None
+
+def addon_id(addons, name):
+    """
+    Finds the id of an addon, given its name or the name of its service
+    (e.g. "newrelic").
+
+    Args:
+        addons: the app's addons, as listed by the API
+        name: the name to look for
+
+    Raises:
+        HerokuAPIError: the app has no such addon.
+    """
+    for addon in addons:
+        if name in (addon['name'], addon['addon_service']['name']):
+            return addon['id']
+
+    raise HerokuAPIError(404, 'no %s addon' % name)
+
+def remote_head(remote):
+    """The commit master points to on a git remote, None if it has none."""
+    output = local(['git', 'ls-remote', remote, 'refs/heads/master'],
+                   collect_output=True, abort_on_stderr=False)
+
+    fields = (output or '').split()
+    return fields[0] if fields else None
+
+def squash_commit(commit):
+    """
+    Makes a commit holding the tree of ``commit``, without any parents.
+
+    The new commit takes its author, committer and dates from ``commit``, so
+    squashing the same commit always gives the same commit.
+
+    Returns:
+        The hash of the squashed commit.
+    """
+    fields = local(['git', 'log', '-1', '--date=raw',
+                    '--format=%an%n%ae%n%ad%n%cn%n%ce%n%cd', commit],
+                   collect_output=True).splitlines()
+    names = ['GIT_AUTHOR_NAME', 'GIT_AUTHOR_EMAIL', 'GIT_AUTHOR_DATE',
+             'GIT_COMMITTER_NAME', 'GIT_COMMITTER_EMAIL', 'GIT_COMMITTER_DATE']
+    env = dict(os.environ, **dict(zip(names, fields)))
+
+    return local(['git', 'commit-tree', '%s^{tree}' % commit,
+                  '-m', 'Deploy of %s' % commit],
+                 collect_output=True, env=env).strip()
+
+def config_changes(current, desired):
+    """
+    Works out what needs to change to get from one config to another.
+
+    Args:
+        current: the config on heroku
+        desired: the config wanted, keys mapped to None should be removed.
+            Keys missing from it are left alone, heroku and its addons set
+            config of their own (DATABASE_URL and the like).
+
+    Returns:
+        A dict of the keys to set, mapped to their new value, and the keys to
+        remove, mapped to None.
+    """
+    changes = {}
+    for key, value in desired.items():
+        if value is None:
+            if key in current:
+                changes[key] = None
+        elif key not in current or \
+                config_value(current[key]) != config_value(value):
+            changes[key] = config_value(value)
+
+    return changes
+
+def config_value(value):
+    """
+    Returns a config value as a string, the way heroku stores it.
+
+    Unicode is utf-8 encoded (the API hands out unicode, the toolbelt and
+    most beltenv files plain strings), anything else goes through str().
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+def parse_config_shell(output):
+    """Parses the output of ``heroku config --shell`` into a dict."""
+    config = {}
+    for line in output.splitlines():
+        if '=' in line:
+            key, value = line.split('=', 1)
+            # values are quoted for the shell where needed
+            config[key] = ''.join(shlex.split(value)) if value else ''
+
+    return config
+
+def plan_steps(steps):
+    """
+    Works out which post_deploy/migrate steps wait for which.
+
+    Args:
+        steps: list of steps, see ``HerokuCommands.run`` for the format
+
+    Returns:
+        A (names, commands, after) tuple of lists, with an entry per step.
+        ``after`` holds the indexes of the steps each step waits for.
+    """
+    names, commands, after = [], [], []
+    previous = []
+
+    for entry in steps:
+        group = entry if isinstance(entry, (list, tuple)) else [entry]
+        current = []
+
+        for step in group:
+            if isinstance(step, basestring):
+                step = {'run': step}
+            elif not isinstance(step, dict) or 'run' not in step:
+                abort('heroku step %r should be a command or a dict with a '
+                      '"run" command' % (step,))
+
+            current.append(len(commands))
+            names.append(step.get('name', step['run']))
+            commands.append(step['run'])
+
+            if 'after' in step:
+                waits = step['after']
+                after.append([waits] if isinstance(waits, basestring)
+                             else list(waits))
+            else:
+                after.append(list(previous))
+
+        previous = current
+
+    # steps are referred to by name, unless they simply follow the entry
+    # before them
+    indexes = {}
+    for index, name in enumerate(names):
+        indexes.setdefault(name, []).append(index)
+
+    for waits in after:
+        for position, wait in enumerate(waits):
+            if isinstance(wait, int):
+                continue
+            if wait not in indexes:
+                abort('heroku step "%s" waits for an unknown step' % wait)
+            if len(indexes[wait]) > 1:
+                abort('heroku step "%s" is ambiguous, give the steps a name'
+                      % wait)
+            waits[position] = indexes[wait][0]
+
+    done = set()
+    while len(done) < len(names):
+        ready = [index for index in range(len(names))
+                 if index not in done and set(after[index]) <= done]
+        if not ready:
+            abort('heroku steps wait for each other: %s' % ', '.join(
+                names[index] for index in range(len(names))
+                if index not in done))
+        done.update(ready)
+
+    return names, commands, after
+
+def timeline(rows, width=40):
+    """
+    Prints when each step ran, relative to the first one to start.
+
+    Args:
+        rows: list of (name, started, ended) tuples, times in seconds since
+            the epoch. Steps that never started have None for both.
+        width: how many characters the bars span (optional)
+    """
+    rows = [row for row in rows if row[1] is not None]
+    if not rows:
+        return
+
+    origin = min(started for name, started, ended in rows)
+    total = max(ended for name, started, ended in rows) - origin
+    scale = width / total if total else 0
+
+    print '\nTimeline (%.1fs):' % total
+    for name, started, ended in sorted(rows, key=lambda row: row[1]):
+        offset = int((started - origin) * scale)
+        bar = max(int((ended - started) * scale), 1)
+        print '    %-*s %6.1fs  %s' % (width, ' ' * offset + '#' * bar,
+                                        ended - started, name)
+
+def _failure(result):
+    """Says why a ``CommandResult`` failed, None if it didn't."""
+    if result.ok:
+        return None
+
+    return result.error or 'exit %d' % result.returncode
+
+def _on_terminal():
+    """Tells whether blt's output goes to a terminal."""
+    try:
+        return sys.stdout.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+def _path(*parts):
+    return '/' + '/'.join(urllib.quote(part, safe='') for part in parts)
 
 
 class HerokuCommands(Commander):
-    """Commander class for Heroku"""
+    """
+    Commander class for Heroku
+
+    The info, config, addon and domain listings accept --refresh to fetch
+    them from heroku rather than the cache.
+    """
+    options = {'refresh': False}
+
     def info(self):
         """
         Shows the info for your current heroku environment
 
         Usage:
-            blt e:[env] heroku.info
+            blt e:[env] heroku.info [--refresh]
         """
-        local('heroku apps:info --app %s' % self.cfg['heroku']['app'])
+        if not self.api:
+            self._show('info', ['heroku', 'apps:info',
+                '--app', self.cfg['heroku']['app']])
+            return
+
+        app = self._cached('info', lambda: self._call(self.api.app,
+            self.cfg['heroku']['app']))
+
+        print '=== %s' % app['name']
+        for label, keys in APP_INFO_FIELDS:
+            value = reduce(lambda data, key: (data or {}).get(key), keys, app)
+            print '{0:10} {1}'.format(label + ':', value or '')
 
     def create(self):
         """
@@ -40,6 +492,13 @@ class HerokuCommands(Commander):
         easily accomplished with the heroku toolbelt. This is driven from the
         bltenv configuration.
 
+        Once the app exists, the config, addons and domains are set up while
+        the code is being pushed, the post deploy hooks run when all but the
+        domains are done. Creating the app and pushing happen on the
+        terminal, as they may ask for credentials, the output of the other
+        stages shows once the push is done. A timeline of the stages is
+        printed at the end.
+
         Usage:
             blt e:[env] heroku.create
         """
@@ -52,18 +511,30 @@ class HerokuCommands(Commander):
         if proceed.lower() != 'yes' and proceed.lower() != 'y':
             abort('Aborting heroku creation.')
 
-        local('heroku apps:create %s --remote %s' % (self.cfg['heroku']['app']
-                                            , self.cfg['heroku']['git_remote']))
-        self.config('set')
-        self.push()
-        self.addon('add')
+        stages = [
+              ('apps:create', lambda: local(['heroku', 'apps:create',
+                  self.cfg['heroku']['app'],
+                  '--remote', self.cfg['heroku']['git_remote']]))
+            , ('config', lambda: self.config('set'))
+            , ('push', self.push)
+            , ('addons', lambda: self.addon('add'))
+        ]
 
         # if we have domains configured, add them
         if 'domains' in self.cfg['heroku']:
-            self.domain('add')
+            stages.append(('domains', lambda: self.domain('add')))
 
-        # handle post deploy steps
-        self.run(*self.cfg['heroku']['post_deploy'])
+        # handle post deploy steps, once the code, its config and the addons
+        # it relies on are in place
+        stages.append(('post_deploy',
+            lambda: self.run(*self.cfg['heroku']['post_deploy'])))
+
+        after = dict((label, ['apps:create']) for label, stage in stages[1:])
+        after['post_deploy'] = ['config', 'push', 'addons']
+
+        with self._changing():
+            self._pipeline('create', stages, after,
+                           foreground=['apps:create', 'push'])
 
         print '\nHeroku Deploy Complete!'
         url = '==> http://%s.herokuapp.com/' % self.cfg['heroku']['app']
@@ -73,12 +544,21 @@ class HerokuCommands(Commander):
         """
         Destroys a heroku app.
 
-        The heroku toolbelt will verify this operation before executing.
+        The heroku toolbelt will verify this operation before executing. When
+        going through the API, blt asks for the app name itself.
 
         Usage:
             blt e:[env] heroku.destroy
         """
-        local('heroku apps:destroy %s' % self.cfg['heroku']['app'])
+        with self._changing():
+            if not self.api:
+                local(['heroku', 'apps:destroy', self.cfg['heroku']['app']])
+                return
+
+            self._confirm('This will destroy %s and all of its add-ons.'
+                % self.cfg['heroku']['app'])
+            self._call(self.api.delete_app, self.cfg['heroku']['app'])
+            print 'Destroyed %s' % self.cfg['heroku']['app']
 
     def push(self, git_arg=''):
         """
@@ -87,8 +567,17 @@ class HerokuCommands(Commander):
         We handle pushing from a non-master branch for you, just set
         ``git_branch`` in your beltenv configuration.
 
+        Nothing is pushed when heroku already runs the commit. To save
+        shipping the whole history of a big repository, ``squash`` pushes a
+        single commit holding the tree of the branch instead (set ``squash``
+        to True in your beltenv configuration to always do so). Squashing the
+        same commit again gives the same commit back, so that is skipped too.
+        The squashed commit is kept as refs/blt/deploy/<app> for reference.
+
+        Once done, blt reports how much was sent and how long it took.
+
         Args:
-            git_arg: any valid argument to git push (optional)
+            git_arg: any valid argument to git push, or squash (optional)
 
         Usage:
             blt e:[env] heroku.push [arg]
@@ -97,25 +586,58 @@ class HerokuCommands(Commander):
             blt e:s heroku.push - pushes branch to heroku staging environment
             blt e:s heroku.push force - forces a push to heroku staging
             blt e:p heroku.push verbose - pushes to production in verbose mode
+            blt e:s heroku.push squash - pushes the branch without its history
         """
-        if git_arg:
-            local('git push %s %s:master --%s' % (self.cfg['heroku']['git_remote']
-                                                    , self.cfg['heroku']['git_branch']
-                                                    , git_arg))
+        remote = self.cfg['heroku']['git_remote']
+        branch = self.cfg['heroku']['git_branch']
+        squash = git_arg == 'squash' or self.cfg['heroku'].get('squash', False)
+
+        target = local(['git', 'rev-parse', '--verify', '%s^{commit}' % branch],
+                       collect_output=True).strip()
+
+        if squash:
+            target = squash_commit(target)
+            local(['git', 'update-ref',
+                   'refs/blt/deploy/%s' % self.cfg['heroku']['app'], target])
+            command = ['git', 'push', '--progress', remote,
+                       '%s:refs/heads/master' % target, '--force']
         else:
-            local('git push %s %s:master' % (self.cfg['heroku']['git_remote']
-                                            , self.cfg['heroku']['git_branch']))
+            command = ['git', 'push', '--progress', remote,
+                       '%s:master' % branch]
+
+        if git_arg and git_arg != 'squash':
+            command.append('--%s' % git_arg)
+
+        if remote_head(remote) == target:
+            print '%s already runs %s, nothing to push.' % (remote, target[:7])
+            return
+
+        start = time.time()
+        size = None
+        for line in local_lines(command, merge_stderr=True):
+            print line.rstrip('\n')
+            match = PUSH_SIZE.search(line)
+            if match:
+                size = match.group(1)
+
+        print 'Pushed %sto %s in %.1fs' % (size + ' ' if size else '', remote,
+                                          time.time() - start)
 
     def config(self, action='', *configs):
         """
         Executes a set/get/unset action to the remote heroku config.
 
+        ``set`` only sends the values that differ from the remote config, all
+        in one go, and doesn't touch heroku at all when nothing changed (every
+        config change restarts the dynos). Keys set to None in the beltenv
+        configuration are removed from heroku.
+
         Args:
             action: string config action. either set, get, or unset
             configs: list of configurations
 
         Usage:
-            blt e:[env] heroku.config [set|get|unset] ["Key=Value"]
+            blt e:[env] heroku.config [set|get|unset] ["Key=Value"] [--refresh]
 
         Examples:
             blt e:s heroku.config - default lists the current config on staging
@@ -126,8 +648,41 @@ class HerokuCommands(Commander):
             blt e:p heroku.config unset SSL_ENABLED - unsets the SSL_ENABLED
                 config setting
         """
+        app = self.cfg['heroku']['app']
+
         if not action:
-            local('heroku config --app %s' % self.cfg['heroku']['app'])
+            if not self.api:
+                self._show('config', ['heroku', 'config', '--app', app])
+                return
+
+            current = self._cached('config',
+                lambda: self._call(self.api.config_vars, app))
+            for key, value in sorted(current.items()):
+                print '%s: %s' % (key, value)
+        elif self.api and action == 'get':
+            # asked for one by one, so they'd better not be stale
+            current = self._call(self.api.config_vars, app)
+            for key in configs:
+                print current.get(key, '')
+        elif action == 'set':
+            if configs:
+                invalid = [config for config in configs if '=' not in config]
+                if invalid:
+                    abort('config set takes KEY=VALUE pairs, got: %s'
+                        % ', '.join(invalid))
+                desired = dict(config.split('=', 1) for config in configs)
+            else:
+                desired = self.cfg['heroku']['config']
+
+            with self._changing('config'):
+                self._set_config(desired)
+        elif self.api and action == 'unset':
+            with self._changing('config'):
+                self._call(self.api.update_config_vars, app,
+                    dict((key, None) for key in configs))
+            print 'Config removed on %s: %s' % (app, ', '.join(configs))
+        elif action == 'get':
+            local(['heroku', 'config:get'] + list(configs) + ['--app', app])
         else:
             if not configs:
                 # if we don't have any runtime configs from the commandline,
@@ -135,11 +690,12 @@ class HerokuCommands(Commander):
                 # items in the beltenv configuration dict into a list of
                 # "key=value" strings:
                 configs = [''.join([k,'=',v])
-                    for k,v in self.cfg['heroku']['config'].iteritems()]
+                    for k,v in self.cfg['heroku']['config'].iteritems()
+                    if v is not None]
 
-            local('heroku config:%s %s --app %s' % (action
-                                                    , ' '.join(configs)
-                                                    , self.cfg['heroku']['app']))
+            with self._changing('config'):
+                local(['heroku', 'config:%s' % action] + list(configs) +
+                      ['--app', app])
 
     def addon(self, action='', *addons):
         """
@@ -150,7 +706,7 @@ class HerokuCommands(Commander):
             addons: list of addons
 
         Usage:
-            blt e:[env] heroku.addon [add|remove|upgrade] ["addon:level"]
+            blt e:[env] heroku.addon [add|remove|upgrade] ["addon:level"] [--refresh]
 
         Examples:
             blt e:s heroku.addon - default lists the current addons on staging
@@ -160,8 +716,16 @@ class HerokuCommands(Commander):
                 version of newrelic in production
             blt e:p heroku.addon remove newrelic - removes newrelic from prod
         """
+        app = self.cfg['heroku']['app']
+
         if not action:
-            local('heroku addons --app %s' % self.cfg['heroku']['app'])
+            if not self.api:
+                self._show('addons', ['heroku', 'addons', '--app', app])
+                return
+
+            for addon in self._cached('addons',
+                    lambda: self._call(self.api.addons, app)):
+                print addon['plan']['name']
         else:
             if not addons:
                 # much like the "config" command above, we want to convert the
@@ -169,10 +733,33 @@ class HerokuCommands(Commander):
                 addons = [''.join([k,':',v])
                     for k,v in self.cfg['heroku']['addons'].iteritems()]
 
-            for addon in addons:
-                local('heroku addons:%s %s --app %s' % (action,
-                                                        addon,
-                                                        self.cfg['heroku']['app']))
+            # addons bring config vars of their own
+            with self._changing('addons', 'config'):
+                if self.api and action in ('add', 'upgrade', 'remove'):
+                    if action == 'remove':
+                        self._confirm('This will remove %s from %s.'
+                            % (', '.join(addons), app))
+
+                    # upgrades and removals need the ids of the installed
+                    # addons, one listing serves the whole batch
+                    installed = []
+                    if action != 'add':
+                        installed = self._call(self.api.addons, app)
+
+                    # addons are found by service, "papertrail:choklad" (as
+                    # the beltenv lists them) means papertrail
+                    api_actions = {
+                          'add': lambda api, addon: api.create_addon(app, addon)
+                        , 'upgrade': lambda api, addon: api.update_addon(app,
+                            addon_id(installed, addon.split(':')[0]), addon)
+                        , 'remove': lambda api, addon: api.delete_addon(app,
+                            addon_id(installed, addon.split(':')[0]))
+                    }
+                    self._api_batch(action, api_actions[action], addons)
+                else:
+                    self._batch(action, [['heroku', 'addons:%s' % action,
+                                          addon, '--app', app]
+                                         for addon in addons], addons)
 
     def domain(self, action=None, *domains):
         """
@@ -183,7 +770,7 @@ class HerokuCommands(Commander):
             domains: list of domains
 
         Usage:
-            blt e:[env] heroku.domain [add|clear|remove] [domain]
+            blt e:[env] heroku.domain [add|clear|remove] [domain] [--refresh]
 
         Examples:
             blt e:s heroku.domain - default, lists the current domains on staging
@@ -193,21 +780,62 @@ class HerokuCommands(Commander):
                 domain to the production heroku app
             blt e:p heroku.domain clear - clears all domains in production
         """
+        app = self.cfg['heroku']['app']
+        api_actions = {
+              'add': lambda api, domain: api.create_domain(app, domain)
+            , 'remove': lambda api, domain: api.delete_domain(app, domain)
+        }
+
         if not action:
-            local('heroku domains --app %s' % self.cfg['heroku']['app'])
+            if not self.api:
+                self._show('domains', ['heroku', 'domains', '--app', app])
+                return
+
+            for domain in self._cached('domains',
+                    lambda: self._call(self.api.domains, app)):
+                print domain['hostname']
+        elif self.api and action == 'clear':
+            # the app's own herokuapp.com domain can't be removed
+            domains = [domain['hostname']
+                for domain in self._call(self.api.domains, app)
+                if domain.get('kind') != 'heroku']
+            with self._changing('domains'):
+                self._api_batch(action, api_actions['remove'], domains)
         else:
             if not domains:
                 domains = self.cfg['heroku']['domains']
 
-            for domain in domains:
-                local('heroku domains:%s %s --app %s' % (action,
-                                                        domain,
-                                                        self.cfg['heroku']['app']))
+            with self._changing('domains'):
+                if self.api and action in api_actions:
+                    self._api_batch(action, api_actions[action], domains)
+                else:
+                    self._batch(action, [['heroku', 'domains:%s' % action,
+                                          domain, '--app', app]
+                                         for domain in domains], domains)
 
     def run(self, *commands):
         """
         Runs a given command on heroku.
 
+        Plain commands run one after another, on the terminal. The
+        ``post_deploy`` and ``migrate`` steps in beltenv may also say which
+        steps are independent, those run side by side in their own one-off
+        dynos, with their output prefixed by the step name:
+
+            "post_deploy": [
+                  "python manage.py migrate"
+                , ["python manage.py collectstatic --noinput",
+                   "python manage.py compress"]
+                , {"name": "warm cache", "run": "python manage.py warm",
+                   "after": ["python manage.py migrate"]}
+            ]
+
+        A nested list is a group of steps that run concurrently. A dict names
+        its step (steps are named by their command otherwise) and lists the
+        steps it comes ``after``. Every other step comes after the entry
+        before it. Steps whose dependencies failed are skipped, and blt prints
+        how long each step took.
+
         Args:
             commands: list of shell commands to be run on the heroku instance
 
@@ -218,10 +846,24 @@ class HerokuCommands(Commander):
             blt e:s heroku.run bash - opens a bash session on heroku staging
             blt e:p heroku.run "ls -altr" - runs ls -altr on heroku prod
         """
+        app = self.cfg['heroku']['app']
+
+        if all(isinstance(command, basestring) for command in commands):
+            for command in commands:
+                local(['heroku', 'run', command, '--app', app])
+            return
 
-        for command in commands:
-           local('heroku run "%s" --app %s' % (command
-                                            , self.cfg['heroku']['app']))
+        # concurrent dynos can't share the terminal, --no-tty keeps the
+        # toolbelt from trying
+        names, steps, after = plan_steps(commands)
+        results = local_many([['heroku', 'run', '--no-tty', step, '--app', app]
+                              for step in steps],
+                             limit=BATCH_LIMIT, labels=names, after=after)
+
+        timeline([(result.label, result.started, result.ended)
+                  for result in results])
+        self._report('run', [(result.label, _failure(result))
+                             for result in results])
 
     def migrate(self):
         """
@@ -235,5 +877,289 @@ class HerokuCommands(Commander):
         """
         self.run(*self.cfg['heroku']['migrate'])
 
+    def _cached(self, listing, fetch):
+        """
+        Returns a listing of the app, from the cache if it is fresh enough.
+
+        Listings in ``PRIVATE_LISTINGS`` are kept in the session rather than
+        on disk.
+
+        Args:
+            listing: which listing, one of info, config, addons or domains
+            fetch: gets the listing from heroku, what it returns must be
+                json serializable
+        """
+        ttl = self.cfg['heroku'].get('cache_ttl', CACHE_TTL)
+        if not ttl:
+            return fetch()
+
+        # the API and the toolbelt answer differently
+        key = '%s %s' % ('api' if self.api else 'toolbelt', listing)
+        private = listing in PRIVATE_LISTINGS
+        if private:
+            listings = self._memory_cache()
+        else:
+            path = self._cache_path()
+            listings = cache.load(path, {})
+
+        entry = listings.get(key)
+        if (entry and not self.opts['refresh']
+                and 0 <= time.time() - entry['time'] < ttl):
+            return entry['data']
+
+        data = fetch()
+        listings[key] = {'time': time.time(), 'data': data}
+        if not private:
+            cache.dump(path, listings)
+        return data
+
+    def _show(self, listing, command):
+        """
+        Prints a toolbelt listing.
+
+        On a terminal the toolbelt prints it itself, keeping its layout and
+        colors. Otherwise (scripts, shell prompts) the output goes through
+        the cache.
+        """
+        if _on_terminal():
+            local(command)
+            return
+
+        print self._cached(listing, lambda: local(command,
+            collect_output=True)).rstrip('\n')
+
+    @contextmanager
+    def _changing(self, *listings):
+        """
+        Drops the cached listings a change makes stale once it is done (or
+        failed halfway), all of them if none are given.
+        """
+        try:
+            yield
+        finally:
+            memory = self._memory_cache()
+            for key in list(memory):
+                if not listings or key.split(' ', 1)[1] in listings:
+                    del memory[key]
+
+            path = self._cache_path()
+            cached = cache.load(path, {})
+            fresh = dict((key, entry) for key, entry in cached.items()
+                if listings and key.split(' ', 1)[1] not in listings)
+
+            if fresh != cached:
+                cache.dump(path, fresh)
+
+    def _cache_path(self):
+        return cache.cache_path('heroku', '%s.json' % self.cfg['heroku']['app'])
+
+    def _memory_cache(self):
+        return self.session.setdefault(
+            ('heroku.listings', self.cfg['heroku']['app']), {})
+
+    def _set_config(self, desired):
+        """
+        Brings the remote config in line with ``desired`` with as few calls
+        as possible: one through the API, at most a config:set and a
+        config:unset through the toolbelt, none if nothing changed.
+        """
+        app = self.cfg['heroku']['app']
+
+        if self.api:
+            current = self._call(self.api.config_vars, app)
+        else:
+            current = parse_config_shell(local(['heroku', 'config', '--shell',
+                '--app', app], collect_output=True))
+
+        changes = config_changes(current, desired)
+        if not changes:
+            print 'Config on %s is up to date, nothing to set.' % app
+            return
+
+        if self.api:
+            self._call(self.api.update_config_vars, app, changes)
+        else:
+            updates = ['%s=%s' % (key, value)
+                for key, value in sorted(changes.items()) if value is not None]
+            removals = sorted(key for key, value in changes.items()
+                if value is None)
+
+            if updates:
+                local(['heroku', 'config:set'] + updates + ['--app', app])
+            if removals:
+                local(['heroku', 'config:unset'] + removals + ['--app', app])
+
+        for key in sorted(changes):
+            if changes[key] is None:
+                print '%s: %s' % (key, red('removed'))
+            elif key in current:
+                print '%s: %s' % (key, blue('changed'))
+            else:
+                print '%s: %s' % (key, green('added'))
+
+    def _pipeline(self, action, stages, after, foreground=()):
+        """
+        Runs stages of a command side by side, each once the stages it comes
+        after are done, and prints a timeline of them.
+
+        Stages run in forked processes (see ``blt.parallel``) with their
+        output prefixed by the stage name, foreground stages run in blt's own
+        process, on the terminal. blt aborts once they are all done if any of
+        them failed, stages waiting for a failed stage are skipped.
+
+        Args:
+            action: the command being run
+            stages: list of (name, func) tuples
+            after: dict of name => names of the stages it waits for
+            foreground: names of the stages that may need the terminal
+                (optional)
+        """
+        if self.api:
+            # the children each need a connection of their own
+            self.api.close()
+
+        with timing.span('%s stages' % action):
+            jobs = parallel.run_graph(stages, after=after,
+                                      foreground=foreground)
+
+            for job in jobs:
+                if job.started is not None:
+                    timing.record(job.label, job.ended - job.started)
+
+        timeline([(job.label, job.started, job.ended) for job in jobs])
+
+        outcomes = []
+        for job in jobs:
+            if job.ok:
+                outcomes.append((job.label, None))
+            elif job.status is None:
+                outcomes.append((job.label, 'skipped'))
+            else:
+                outcomes.append((job.label, 'exit %d' % job.status))
+
+        self._report(action, outcomes)
+
+    def _batch(self, action, commands, items):
+        """
+        Runs one toolbelt command per item, concurrently.
+
+        Every item gets a line saying how it went, a failure on one item
+        doesn't stop the others. blt aborts once all of them are done if any
+        failed. Single items and interactive actions run on the terminal as
+        usual.
+
+        Args:
+            action: the addon/domain action being run
+            commands: list of commands, one for each item
+            items: the addons/domains the commands are for
+        """
+        if len(commands) == 1 or action in INTERACTIVE_ACTIONS:
+            for command in commands:
+                local(command)
+            return
+
+        results = local_many(commands, limit=BATCH_LIMIT, labels=list(items))
+
+        self._report(action, [(result.label, _failure(result))
+                              for result in results])
+
+    def _api_batch(self, action, call, items):
+        """
+        Makes one API call per item, reporting how each one went like
+        ``_batch`` does.
+
+        Up to ``BATCH_LIMIT`` calls are made at once, each worker thread with
+        a connection of its own (the session's client serves one of them).
+
+        Args:
+            action: the addon/domain action being run
+            call: function making the call for an item, given an API client
+                and the item
+            items: the addons/domains to make the calls for
+        """
+        workers = max(min(BATCH_LIMIT, len(items)), 1)
+        clients = Queue.Queue()
+        clients.put(self.api)
+        for _ in range(workers - 1):
+            clients.put(self.api.copy())
+
+        def attempt(item):
+            api = clients.get()
+            try:
+                call(api, item)
+                return item, None
+            except HerokuAPIError as e:
+                return item, str(e)
+            finally:
+                clients.put(api)
+
+        if workers == 1:
+            outcomes = map(attempt, items)
+        else:
+            pool = multiprocessing_pool.ThreadPool(workers)
+            try:
+                # get() with a timeout keeps the pool interruptible with
+                # ctrl-c, a plain map() blocks signals in python 2
+                outcomes = pool.map_async(attempt, items).get(2**31)
+            finally:
+                pool.terminate()
+
+        while not clients.empty():
+            api = clients.get()
+            if api is not self.api:
+                api.close()
+
+        self._report(action, outcomes)
+
+    def _report(self, action, outcomes):
+        """
+        Prints a line per item and aborts if any of them failed.
+
+        Args:
+            action: the action that was run
+            outcomes: list of (item, error) tuples, error is None for items
+                that went fine
+        """
+        for item, error in outcomes:
+            if error is None:
+                print '%s: %s' % (item, green('ok'))
+            else:
+                print '%s: %s' % (item, red('failed (%s)' % error))
+
+        failed = [item for item, error in outcomes if error is not None]
+        if failed:
+            abort('heroku %s failed for %d of %d: %s' % (action, len(failed),
+                len(outcomes), ', '.join(failed)))
+
+    @property
+    def api(self):
+        """
+        The Heroku Platform API client, None if the toolbelt should be used.
+
+        The client lives in the session, so chained commands share its
+        connection.
+        """
+        if self.cfg['heroku'].get('api') is False:
+            return None
+
+        key = ('heroku.api',)
+        if key not in self.session:
+            url = os.environ.get('HEROKU_API_URL', DEFAULT_API_URL)
+            token = api_token(url)
+            self.session[key] = HerokuAPI(token, url) if token else None
+
+        return self.session[key]
 
+    def _call(self, method, *args):
+        """Makes an API call, aborting with the API's message on errors."""
+        try:
+            return method(*args)
+        except HerokuAPIError as e:
+            abort('heroku API: %s' % e)
 
+    def _confirm(self, message):
+        """Asks for the app name before a destructive API call."""
+        app = self.cfg['heroku']['app']
+        print red(message)
+        if prompt('To proceed, type "%s" ==>' % app) != app:
+            abort('Confirmation did not match %s.' % app)
@@ -8,7 +8,7 @@ resolve that by wrapping into a set of normalized commands.
 Author: @dencold (Dennis Coldwell)
 """
 from blt.environment import Commander
-from blt.helpers import local, prompt, cd, abort
+from blt.helpers import local, local_lines, prompt, cd, abort
 from clint.textui import puts, indent
 
 class SouthCommands(Commander):
@@ -43,18 +43,28 @@ class SouthCommands(Commander):
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
             puts("-- Model Check -----------------------------------------------------------")
-            out = local('python manage.py schemamigration %s --auto --stdout 2>&1' % app,
-                collect_output=True, abort_on_stderr=False)
-
-            if out.strip() == 'Nothing seems to have changed.':
+            # the migration classes can be long, they are printed as they
+            # come in rather than collected first
+            out = local_lines(['python', 'manage.py', 'schemamigration', app,
+                               '--auto', '--stdout'],
+                abort_on_stderr=False, merge_stderr=True)
+            first = next(out, '')
+
+            if first.strip() == 'Nothing seems to have changed.':
                 puts("Model is in sync with migrations")
             else:
-                puts("Model changes found:\n\n%s" % out)
+                puts("Model changes found:\n")
+                puts(first.rstrip('\n'))
+                for line in out:
+                    puts(line.rstrip('\n'))
                 puts("\n==> Run `blt south.delta %s` to create a migration set." % app)
+            out.close()
 
             puts("\n-- Unapplied Migrations --------------------------------------------------")
-            out = local('python manage.py migrate %s --list | grep -v "*" 2>&1' % app,
-                collect_output=True)
+            # applied migrations are marked with a "*"
+            out = ''.join(line for line in
+                local_lines(['python', 'manage.py', 'migrate', app, '--list'])
+                if '*' not in line)
 
             if out.strip() == app:
                 puts("All migrations have been applied to db")
@@ -84,7 +94,7 @@ class SouthCommands(Commander):
 
         with cd(self.cfg['django']['DJANGO_ROOT']):
             for app in apps:
-                local('python manage.py schemamigration %s --auto' % app)
+                local(['python', 'manage.py', 'schemamigration', app, '--auto'])
 
     def migrate(self, *apps):
         """
@@ -108,7 +118,7 @@ class SouthCommands(Commander):
         """
         with cd(self.cfg['django']['DJANGO_ROOT']):
             if not apps:
-                local('python manage.py migrate')
+                local(['python', 'manage.py', 'migrate'])
             else:
                 for app in apps:
-                    local('python manage.py migrate %s' % app)
+                    local(['python', 'manage.py', 'migrate', app])
@@ -16,6 +16,9 @@ settings = {
         'blt.test',
         'blt.tools'
     ],
+    'scripts': [
+        'bin/blt-complete'
+    ],
     'install_requires': [
         'clint==0.3.3',
         'mock==1.0.1',
@@ -32,7 +35,7 @@ settings = {
     ),
     'entry_points': {
         'console_scripts': [
-            'blt = blt.main:main'
+            'blt = blt.launcher:main'
         ]
     }
 }